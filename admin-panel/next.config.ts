@@ -11,6 +11,10 @@ const nextConfig: NextConfig = {
         source: '/ai-photos/:path*',
         destination: '/api/static/ai-photos/:path*',
       },
+      {
+        source: '/ai-videos/:path*',
+        destination: '/api/static/ai-videos/:path*',
+      },
     ];
   },
 };
@@ -1,105 +1,383 @@
-from fastapi import FastAPI, HTTPException
+import time
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import os
+import json
+import hashlib
+import hmac
+import re
 import uuid
-import requests
-from dashscope import MultiModalConversation
 from dotenv import load_dotenv
 from urllib.parse import urlparse
-import time
 import random
-from PIL import Image
 from io import BytesIO
 import threading
 import signal
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable
+
+# 先加载.env：下面的服务模块和配置在导入时就读取环境变量（PREWARM_SDKS、LOCAL_CARTOON、PREFLIGHT_*等）
+load_dotenv()
+
+from app.services.bandit import VariantBandit
+from app.services.cartoon import LOCAL_CARTOON, cartoon_snapshot, submit_cartoon
+from app.services.batch import BatchCheckpoint, BatchRunner, item_key
+from app.services.budget import BudgetTracker, ProviderBudget
+from app.services.clients.dashscope_tasks import DashScopeTaskEngine
+from app.services.clients.lazy import LazyModule, is_available, load_timings, prewarm
+from app.services.concurrency import ConcurrencyController, ProviderLimiter
+from app.services.deadline import CallTimeout, Deadline, call_with_timeout
+from app.services.deadline import snapshot as isolation_snapshot
+from app.services.dedup import DuplicateIndex
+from app.services.drain import DrainController
+from app.services import errors
+from app.services.eta import EtaEstimator
+from app.services.events import EventLog
+from app.services.gallery import GalleryFeed
+from app.services.imaging import normalize_for_providers, subject_crop_snapshot
+from app.services.imaging import submit as submit_to_image_pool
+from app.services.layout import MANIFEST_NAME, ShardedStore
+from app.services.profiler import Profiler, current_tag, tag_thread
+from app.services.prompt_batch import PromptBatcher
+from app.services.retention import RetentionManager, RetentionPolicy
+from app.services.storage import S3Storage, create_original_storage
+from app.services.validation import OutputRejected, OutputValidator
 
-try:
-    from google import genai
-    from google.genai import types
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
+# provider SDK和重量级依赖延迟加载：第一次使用或后台预热时才真正导入
+requests = LazyModule("requests")
+dashscope = LazyModule("dashscope")
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+Image = LazyModule("PIL.Image")
+
+GEMINI_AVAILABLE = is_available("google.genai")
+if not GEMINI_AVAILABLE:
     print("⚠️ Gemini不可用，请运行: pip install google-genai")
 
-load_dotenv()
+# 服务启动后在后台预热的模块（设置PREWARM_SDKS=0关闭）
+PREWARM_SDKS = os.getenv("PREWARM_SDKS", "1") == "1"
+PREWARM_MODULES = ["requests", "PIL.Image", "dashscope"] + (["google.genai"] if GEMINI_AVAILABLE else [])
 
-app = FastAPI(title="GOSIM Wonderland AI Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PREWARM_SDKS:
+        # 不阻塞启动：端口绑定后SDK在后台线程中加载
+        prewarm(PREWARM_MODULES, delay=0.1)
+    retention_manager.start()
+    install_drain_handler()
+    resume_checkpointed_jobs()
+    event_log.start()
+    yield
+    retention_manager.stop()
+    dashscope_engine.stop()
+    event_log.stop()
+    prompt_bandit.flush()
+
+app = FastAPI(title="GOSIM Wonderland AI Service", lifespan=lifespan)
 
 # 定义目录路径
 AI_PHOTOS_DIR = "../ai-photos"
+AI_VIDEOS_DIR = "../ai-videos"
 ORIGINAL_PHOTOS_DIR = "../original-photos-cache"
+ORIGINAL_UPLOADS_DIR = "../original-photos"  # photo-app上传的原图
+BATCH_CHECKPOINT_DIR = "../batch-checkpoints"
+BUDGET_LEDGER_DIR = "../budget-ledger"
+DEDUP_INDEX_PATH = "../dedup-index/hashes.jsonl"
+DRAIN_CHECKPOINT_PATH = "../drain-checkpoint/pending.jsonl"
+EVENT_LOG_DIR = "../event-log"
+PROMPT_BANDIT_PATH = "../prompt-bandit/state.json"
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+ORIGINAL_IMAGES_PUBLIC_URL = os.getenv("ORIGINAL_IMAGES_PUBLIC_URL", "http://us.liyao.space:8080/original-images")
+# 上传provider之前是否对原图做预处理（EXIF方向、去元数据、缩小、重新编码）
+PREFLIGHT_NORMALIZE = os.getenv("PREFLIGHT_NORMALIZE", "1") == "1"
+PROVIDERS = ["tongyi", "gemini", "vidu"]
+# 所有provider都失败（或超时、原图不被接受）时用本地卡通预览作为结果；最多再等这么久让预览完成
+LOCAL_FALLBACK_STATUSES = {500, 502, 504, 422}
+LOCAL_CARTOON_WAIT_SECONDS = float(os.getenv("LOCAL_CARTOON_WAIT_SECONDS", "5"))
 
-# 创建目录
-os.makedirs(AI_PHOTOS_DIR, exist_ok=True)  
-os.makedirs(ORIGINAL_PHOTOS_DIR, exist_ok=True)
+# 按哈希前缀分片存储，并维护manifest索引（同时负责创建目录）
+ai_photos_store = ShardedStore(AI_PHOTOS_DIR, "/ai-photos")
+ai_videos_store = ShardedStore(AI_VIDEOS_DIR, "/ai-videos")
+# /gallery 增量feed的缩略图，放在ai-photos下，沿用同一个静态文件路由
+ai_thumbnails_store = ShardedStore(os.path.join(AI_PHOTOS_DIR, "thumbs"), "/ai-photos/thumbs")
+gallery_feed = GalleryFeed(
+    ai_photos_store, thumbnails=ai_thumbnails_store, videos=ai_videos_store,
+    thumbnail_side=int(os.getenv("GALLERY_THUMBNAIL_SIDE", "320")), submit=submit_to_image_pool,
+)
+GALLERY_MAX_LIMIT = 500
+GALLERY_MAX_WAIT_SECONDS = float(os.getenv("GALLERY_MAX_WAIT_SECONDS", "30"))
+# 原图存储后端：local走8080端口静态服务，s3由provider通过预签名URL直接拉取
+original_storage = create_original_storage(ORIGINAL_PHOTOS_DIR, ORIGINAL_IMAGES_PUBLIC_URL)
 
 # 全局任务管理
 running_tasks = {}  # 存储正在运行的任务
 task_lock = threading.Lock()
 
+# SIGTERM后的平滑下线：在途任务最多再执行DRAIN_SECONDS秒，未完成的写入checkpoint由下一个进程恢复；
+# 负载均衡后面部署时把DRAIN_READINESS_GRACE_SECONDS设为探活间隔以上，/health先变为503再停止监听
+drain_controller = DrainController(
+    DRAIN_CHECKPOINT_PATH,
+    drain_seconds=float(os.getenv("DRAIN_SECONDS", "30")),
+    readiness_grace=float(os.getenv("DRAIN_READINESS_GRACE_SECONDS", "0")),
+)
+
+def get_protected_files() -> set:
+    """正在执行的任务引用的缓存原图（文件名），清理时跳过"""
+    with task_lock:
+        return {name for task_info in running_tasks.values() for name in task_info.get("files", ())}
+
+# 磁盘配额与过期清理：原图缓存默认2GB/24小时未访问即清理，AI图片默认不清理；
+# S3后端的原图按manifest列出，清理时删除bucket中的对象
+retention_manager = RetentionManager(
+    [
+        RetentionPolicy(
+            "original_photos_cache", ORIGINAL_PHOTOS_DIR,
+            max_bytes=int(os.getenv("ORIGINAL_CACHE_QUOTA_MB", "2048")) * 1024 * 1024,
+            max_age=float(os.getenv("ORIGINAL_CACHE_MAX_AGE_HOURS", "24")) * 3600,
+            skip_names=(MANIFEST_NAME,), delete_fn=original_storage.delete,
+            entries_fn=original_storage.entries if isinstance(original_storage, S3Storage) else None,
+        ),
+        RetentionPolicy(
+            "ai_photos", AI_PHOTOS_DIR,
+            max_bytes=int(os.getenv("AI_PHOTOS_QUOTA_MB", "0")) * 1024 * 1024,
+            max_age=float(os.getenv("AI_PHOTOS_MAX_AGE_HOURS", "0")) * 3600,
+            # 缩略图也在这个目录下，两个manifest都要更新（路径不属于某个store时forget什么也不做）
+            skip_names=(MANIFEST_NAME,), on_evict=lambda path: (ai_photos_store.forget(path), ai_thumbnails_store.forget(path)),
+        ),
+    ],
+    protected_fn=get_protected_files,
+    interval=float(os.getenv("RETENTION_INTERVAL_SECONDS", "60")),
+)
+
+# DashScope异步任务（万相图像编辑、图生视频）共用一个轮询线程
+dashscope_engine = DashScopeTaskEngine(
+    {"image": ai_photos_store, "video": ai_videos_store},
+    min_interval=float(os.getenv("DASHSCOPE_POLL_MIN_SECONDS", "1")),
+    max_interval=float(os.getenv("DASHSCOPE_POLL_MAX_SECONDS", "10")),
+)
+VIDEO_DEFAULT_PROMPT = "卡通人物自然地微笑并向镜头挥手，镜头缓慢推进，GOSIM开发者大会的科技氛围"
+
+# 各provider同时在途调用数的预算
+provider_limiter = ProviderLimiter({
+    "tongyi": int(os.getenv("TONGYI_MAX_CONCURRENCY", "8")),
+})
+# 自适应并发：以上面的值为初始上限，根据调用耗时和错误率在 [MIN, CEILING] 之间自动调整
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1") == "1"
+concurrency_controller = ConcurrencyController(
+    provider_limiter,
+    {"tongyi": (int(os.getenv("TONGYI_MIN_CONCURRENCY", "2")), int(os.getenv("TONGYI_CONCURRENCY_CEILING", "32")))},
+    window=int(os.getenv("ADAPTIVE_CONCURRENCY_WINDOW", "20")),
+    tolerance=float(os.getenv("ADAPTIVE_CONCURRENCY_TOLERANCE", "1.5")),
+) if ADAPTIVE_CONCURRENCY else None
+# provider费用与额度：预算按计费周期（BUDGET_PERIOD=day|month）计算，0表示不限制
+budget_tracker = BudgetTracker(
+    [
+        ProviderBudget(
+            "tongyi", budget=float(os.getenv("TONGYI_BUDGET", "0")),
+            model_costs={
+                "qwen-image-edit": float(os.getenv("TONGYI_IMAGE_COST", "0.25")),
+                "wan2.2-i2v-flash": float(os.getenv("TONGYI_VIDEO_COST", "0.5")),
+            },
+            expected_latency=20, default_model="qwen-image-edit",
+        ),
+        ProviderBudget(
+            "gemini", budget=float(os.getenv("GEMINI_BUDGET", "0")),
+            model_costs={
+                "gemini-2.5-flash-image-preview": float(os.getenv("GEMINI_IMAGE_COST", "0.3")),
+                "gemini-2.5-flash-lite": float(os.getenv("GEMINI_PROMPT_COST", "0.001")),
+            },
+            expected_latency=15, default_model="gemini-2.5-flash-image-preview",
+        ),
+        ProviderBudget(
+            "vidu", budget=float(os.getenv("VIDU_BUDGET", "0")),
+            # Vidu返回实际消耗的积分，按积分单价计费；估算单价用于排序
+            model_costs={"viduq1": float(os.getenv("VIDU_IMAGE_COST", "0.4"))},
+            unit_price=float(os.getenv("VIDU_CREDIT_PRICE", "0.05")),
+            expected_latency=60,
+        ),
+    ],
+    BUDGET_LEDGER_DIR,
+    period=os.getenv("BUDGET_PERIOD", "day"),
+    reserve_calls=int(os.getenv("BUDGET_RESERVE_CALLS", "20")),
+)
+# provider输出图片的校验：空白、近似纯色、截断、尺寸异常的输出算作失败，立即进入下一次尝试
+output_validator = OutputValidator(
+    enabled=os.getenv("OUTPUT_VALIDATION", "1") == "1",
+    min_bytes=int(os.getenv("OUTPUT_MIN_BYTES", "2048")),
+    min_side=int(os.getenv("OUTPUT_MIN_SIDE", "256")),
+    max_aspect=float(os.getenv("OUTPUT_MAX_ASPECT", "2.5")),
+    min_std=float(os.getenv("OUTPUT_MIN_STD", "4")),
+    min_entropy=float(os.getenv("OUTPUT_MIN_ENTROPY", "2.0")),
+    max_dominant=float(os.getenv("OUTPUT_MAX_DOMINANT", "0.95")),
+)
+# 运行中任务的排队位置与预计完成时间
+eta_estimator = EtaEstimator(provider_limiter, budget_tracker)
+# 客户端自带任务ID时的格式要求（用于在阻塞等待结果的同时查询进度）
+TASK_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+# DashScope表示欠费或额度用尽的错误码
+DASHSCOPE_QUOTA_CODES = {"Arrearage", "Throttling.AllocationQuota", "AllocationQuota.FreeTierOnly"}
+# 主provider在这个延迟目标内完成时才优先选最便宜的，请求可以用latency_target覆盖
+LATENCY_TARGET_SECONDS = float(os.getenv("LATENCY_TARGET_SECONDS", "60"))
+
+# 连拍近似重复检测：off不检测，flag只在响应中标记，reuse直接复用同一会话中之前的生成结果
+DEDUP_POLICY = os.getenv("DEDUP_POLICY", "flag")
+# 没有session_id的请求按时间窗口比较（可能把不同参会者的照片当成连拍），只在flag策略下可以开启
+DEDUP_WINDOW_FALLBACK = os.getenv("DEDUP_WINDOW_FALLBACK", "0") == "1" and DEDUP_POLICY == "flag"
+duplicate_index = DuplicateIndex(
+    DEDUP_INDEX_PATH,
+    algorithm=os.getenv("DEDUP_HASH", "phash"),
+    radius=int(os.getenv("DEDUP_RADIUS", "6")),
+    window=float(os.getenv("DEDUP_WINDOW_SECONDS", "600")),
+)
+
+# 单个任务的端到端截止时间，请求可以用deadline_seconds覆盖；单次provider调用最长不超过PROVIDER_CALL_TIMEOUT_SECONDS
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "60"))
+MAX_JOB_DEADLINE_SECONDS = float(os.getenv("MAX_JOB_DEADLINE_SECONDS", "600"))
+PROVIDER_CALL_TIMEOUT_SECONDS = float(os.getenv("PROVIDER_CALL_TIMEOUT_SECONDS", "120"))
+
+# 通义并行推测的默认变体数，1表示关闭（逐个串行尝试）
+TONGYI_FANOUT = int(os.getenv("TONGYI_FANOUT", "1"))
+
+# 同一任务中一个provider被内容审核拒绝这么多次后，后续尝试优先使用其他provider
+POLICY_REJECTIONS_PER_PROVIDER = int(os.getenv("POLICY_REJECTIONS_PER_PROVIDER", "2"))
+
+# prompt优化与原图预处理并行执行；第一次尝试最多等待这么久，超时则先用原始prompt
+PROMPT_OPTIMIZE_BUDGET = float(os.getenv("PROMPT_OPTIMIZE_BUDGET_MS", "800")) / 1000
+# Gemini优化请求本身的HTTP超时，避免后台线程无限挂起
+PROMPT_OPTIMIZE_TIMEOUT_MS = int(os.getenv("PROMPT_OPTIMIZE_TIMEOUT_MS", "10000"))
+prompt_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="prompt")
+
+# 按各 (provider, 变体) 的历史成功率和耗时决定prompt变体的尝试顺序，0表示按固定顺序
+PROMPT_BANDIT = os.getenv("PROMPT_BANDIT", "1") == "1"
+prompt_bandit = VariantBandit(PROMPT_BANDIT_PATH)
+
+# 每个任务/每次尝试的事件日志（Parquet，按小时滚动），用 event_report.py 分析
+event_log = EventLog(EVENT_LOG_DIR, flush_seconds=float(os.getenv("EVENT_LOG_FLUSH_SECONDS", "10")))
+
+# 管理接口（采样profiler等）的访问令牌，未配置时管理接口全部拒绝访问
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 单次采样会话的时长上限，按任务数采样时也以此兜底
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+profiler = Profiler()
+
+
+def cache_original_image_bytes(content: bytes) -> str:
+    """把原始图片写入缓存目录，返回公网可访问的URL"""
+    # 生成唯一文件名
+    unique_id = uuid.uuid4()
+    file_extension = ".jpg"  # 默认jpg，也可以从原始URL提取
+    file_name = f"original_{unique_id}{file_extension}"
+
+    # 保存原始图片，返回provider可访问的URL
+    return original_storage.save_bytes(file_name, content, provider="original")
 
 def download_and_cache_original_image(url: str) -> str:
     """下载原始图片并缓存到本地，返回公网可访问的URL"""
     try:
         response = requests.get(url, timeout=30)
         response.raise_for_status()
-        
-        # 生成唯一文件名
-        unique_id = uuid.uuid4()
-        file_extension = ".jpg"  # 默认jpg，也可以从原始URL提取
-        file_name = f"original_{unique_id}{file_extension}"
-        file_path = os.path.join(ORIGINAL_PHOTOS_DIR, file_name)
-        
-        # 保存原始图片
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-        
-        # 返回8080端口可访问的URL
-        return f"http://us.liyao.space:8080/original-images/{file_name}"
+        return cache_original_image_bytes(response.content)
     except Exception as e:
         print(f"下载原始图片失败: {e}")
         return url
 
-def save_image_from_url(url: str) -> str:
-    """从URL下载图片并保存到本地"""
-    try:
-        os.makedirs(AI_PHOTOS_DIR, exist_ok=True)
+def read_uploaded_original_image(file_name: str) -> bytes:
+    """读取original-photos目录中的上传原图"""
+    # 只接受文件名，防止路径穿越
+    file_path = os.path.join(ORIGINAL_UPLOADS_DIR, os.path.basename(file_name))
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail=f"原图不存在: {file_name}")
+    with open(file_path, "rb") as f:
+        return f.read()
 
-        response = requests.get(url, timeout=30)
+def is_local_url(url: str) -> bool:
+    return url.startswith(('http://localhost:', 'http://127.0.0.1:'))
+
+def fetch_original_content(base_image_url: str = None, original_file: str = None) -> bytes:
+    """读取原图内容；预处理、去重和本地卡通化都关闭时不下载，返回None"""
+    if original_file:
+        return read_uploaded_original_image(original_file)
+    if PREFLIGHT_NORMALIZE or DEDUP_POLICY != "off" or LOCAL_CARTOON:
+        try:
+            response = requests.get(base_image_url, timeout=30)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            print(f"⚠️ 下载原图失败: {e}，跳过预处理")
+    return None
+
+def prepare_provider_images(base_image_url: str = None, content: bytes = None, timeout: float = None) -> dict:
+    """准备发给各provider的原图，返回 {provider: 图片URL}
+
+    开启预处理时按各provider的目标分辨率处理原图内容并缓存；
+    预处理不可用或超过timeout秒时退回原有逻辑：本地URL缓存后转为8080端口URL，其他URL原样传递。
+    """
+    if content is not None and PREFLIGHT_NORMALIZE:
+        try:
+            return normalize_for_providers(content, PROVIDERS, original_storage, timeout)
+        except FutureTimeoutError:
+            print("⚠️ 原图预处理超时，使用原图")
+        except Exception as e:
+            print(f"⚠️ 原图预处理失败: {e}，使用原图")
+
+    if content is not None:
+        url = cache_original_image_bytes(content)
+    elif is_local_url(base_image_url):
+        # 如果是本地URL，下载并缓存到AI服务器，返回8080端口URL
+        print(f"本地图片URL: {base_image_url}，正在下载并缓存...")
+        url = download_and_cache_original_image(base_image_url)
+    else:
+        url = base_image_url
+    print(f"AI服务器图片URL: {url}")
+    return {provider: url for provider in PROVIDERS}
+
+def save_image_from_url(url: str, job_id: str = None, timeout: float = 30) -> str:
+    """从URL下载图片，校验通过后保存到本地；没通过校验时抛出OutputRejected"""
+    try:
+        response = requests.get(url, timeout=max(1.0, min(30, timeout)))
         response.raise_for_status()
+        output_validator.check(response.content)
 
         unique_id = uuid.uuid4()
         file_name = f"cartoon_{unique_id}.png"
-        file_path = os.path.join(AI_PHOTOS_DIR, file_name)
-
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-
-        return f"/ai-photos/{file_name}"
+        return ai_photos_store.save_bytes(file_name, response.content, job_id=job_id, provider="tongyi")
+    except OutputRejected:
+        raise
     except Exception as e:
         print(f"保存图片失败: {e}")
         return url
 
+PROMPT_OPTIMIZE_RULES = """
+请基于以下要求优化：
+1. 保持用户的核心意图
+2. 适合GOSIM开发者大会的场景（杭州科技氛围，开源精神）
+3. 添加卡通风格相关的细节描述
+4. 突出专业程序员形象
+5. 使用清晰、具体的视觉描述词汇
+6. 避免模糊或抽象的表达
+"""
+
 def optimize_prompt_with_gemini_flash(original_prompt: str, api_key: str) -> str:
     """使用Gemini 2.5 Flash优化图像生成prompt"""
     if not GEMINI_AVAILABLE or not api_key:
         return original_prompt
     
     try:
-        client = genai.Client(api_key=api_key)
+        client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=PROMPT_OPTIMIZE_TIMEOUT_MS),
+        )
         
         optimization_instruction = f"""
 你是一个专业的AI图像生成prompt优化专家。请将以下用户输入的prompt优化为更适合图像生成的描述：
 
 用户原始prompt: "{original_prompt}"
-
-请基于以下要求优化：
-1. 保持用户的核心意图
-2. 适合GOSIM开发者大会的场景（杭州科技氛围，开源精神）
-3. 添加卡通风格相关的细节描述
-4. 突出专业程序员形象
-5. 使用清晰、具体的视觉描述词汇
-6. 避免模糊或抽象的表达
-
+{PROMPT_OPTIMIZE_RULES}
 请只返回优化后的prompt，不要包含其他解释。优化后的prompt应该在100-150字之间。
 """
         
@@ -126,6 +404,7 @@ def optimize_prompt_with_gemini_flash(original_prompt: str, api_key: str) -> str
         
         if response and response.candidates:
             optimized_prompt = response.candidates[0].content.parts[0].text.strip()
+            budget_tracker.charge("gemini", "gemini-2.5-flash-lite")
             print(f"🎨 Gemini优化prompt: {original_prompt} -> {optimized_prompt}")
             return optimized_prompt
         else:
@@ -136,6 +415,67 @@ def optimize_prompt_with_gemini_flash(original_prompt: str, api_key: str) -> str
         print(f"⚠️ Gemini prompt优化失败: {e}，使用原prompt")
         return original_prompt
 
+def optimize_prompts_with_gemini_flash(original_prompts: list[str], api_key: str) -> list[str]:
+    """一次Gemini调用优化多个prompt，返回同样顺序的列表；失败时抛出异常，由调用方退回逐个优化"""
+    client = genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(timeout=PROMPT_OPTIMIZE_TIMEOUT_MS),
+    )
+    optimization_instruction = f"""
+你是一个专业的AI图像生成prompt优化专家。请将下面JSON数组中的每个用户prompt分别优化为更适合图像生成的描述：
+
+{json.dumps(original_prompts, ensure_ascii=False)}
+{PROMPT_OPTIMIZE_RULES}
+请返回一个JSON字符串数组，长度为{len(original_prompts)}，第i个元素是第i个prompt优化后的结果，每个100-150字，不要包含其他解释。
+"""
+    response = client.models.generate_content(
+        model="gemini-2.5-flash-lite",
+        contents=[types.Content(role="user", parts=[types.Part.from_text(text=optimization_instruction)])],
+        config=types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_budget=0),
+            response_mime_type="application/json",
+            response_schema=list[str],
+        ),
+    )
+    optimized = json.loads(response.text)
+    if not isinstance(optimized, list) or not all(isinstance(p, str) and p.strip() for p in optimized):
+        raise ValueError("批量优化返回的不是字符串数组")
+    budget_tracker.charge("gemini", "gemini-2.5-flash-lite")
+    print(f"🎨 Gemini批量优化了 {len(original_prompts)} 个prompt")
+    return [p.strip() for p in optimized]
+
+# 突发流量下合并PROMPT_BATCH_WINDOW_MS内到达的prompt优化请求，0表示关闭（每个任务单独调用）
+PROMPT_BATCH_WINDOW_MS = float(os.getenv("PROMPT_BATCH_WINDOW_MS", "50"))
+prompt_batcher = PromptBatcher(
+    optimize_prompts_with_gemini_flash,
+    optimize_prompt_with_gemini_flash,
+    window=PROMPT_BATCH_WINDOW_MS / 1000,
+    max_batch=int(os.getenv("PROMPT_BATCH_MAX", "16")),
+)
+
+def submit_prompt_optimization(prompt: str, api_key: str):
+    """异步优化prompt，返回Future"""
+    if PROMPT_BATCH_WINDOW_MS > 0:
+        return prompt_batcher.submit(prompt, api_key)
+    return prompt_executor.submit(optimize_prompt_with_gemini_flash, prompt, api_key)
+
+def choose_prompt_variants(provider: str, template_set: str, n_variants: int, tried: set, k: int = 1) -> list[int]:
+    """选出下一次尝试使用的k个变体序号；tried为本任务已经试过的变体"""
+    if PROMPT_BANDIT:
+        return prompt_bandit.choose(provider, template_set, n_variants, exclude=tried, k=k)
+    untried = [v for v in range(n_variants) if v not in tried]
+    return (untried if len(untried) >= k else list(range(n_variants)))[:k]
+
+def observe_prompt_variant(provider: str, template_set: str, variant: int, result: dict, elapsed: float):
+    """记录变体的尝试结果；只有内容审核拒绝和输出退化与prompt有关，其他失败（超时、限流、原图问题等）不计入"""
+    if not result["success"] and result.get("error_kind") not in (errors.POLICY_REJECTED, errors.OUTPUT_INVALID):
+        return
+    prompt_bandit.observe(provider, template_set, variant, bool(result["success"]), elapsed)
+
+def prompt_template_set(original_prompt: str) -> str:
+    """generate_prompt_variants使用的模板组：没有用户输入时为default，否则为user"""
+    return "user" if original_prompt and original_prompt.strip() else "default"
+
 def generate_prompt_variants(original_prompt: str) -> list[str]:
     """基于原始prompt生成5种智能变体"""
     # 基础GOSIM主题
@@ -174,7 +514,8 @@ def generate_prompt_variants(original_prompt: str) -> list[str]:
     
     return variants
 
-def attempt_vidu_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int) -> dict:
+@budget_tracker.metered("vidu", "viduq1")
+def attempt_vidu_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int, job_id: str = None, timeout: float = 30) -> dict:
     """Vidu AI生成尝试"""
     try:
         print(f"第{attempt_num}次尝试 - 使用Vidu，prompt: {prompt_instruction[:100]}...")
@@ -201,7 +542,7 @@ def attempt_vidu_generation(api_key: str, base_image_url: str, prompt_instructio
             "https://api.vidu.com/ent/v2/reference2image",
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=min(30, timeout)
         )
         
         if response.status_code == 200:
@@ -220,38 +561,58 @@ def attempt_vidu_generation(api_key: str, base_image_url: str, prompt_instructio
                     "success": True, 
                     "image_paths": [placeholder_path], 
                     "task_id": task_id,
+                    "credits": credits,
                     "async": True,  # 标记为异步任务
                     "message": f"Vidu异步任务已创建，task_id: {task_id}"
                 }
             else:
-                return {"success": False, "error": "Vidu未返回task_id"}
+                return {"success": False, "error": "Vidu未返回task_id", "error_kind": errors.TRANSIENT}
         elif response.status_code == 400:
             error_data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+            error_kind = errors.classify_vidu(400, error_data.get("reason"))
             if error_data.get("reason") == "CreditInsufficient":
-                return {"success": False, "error": "Vidu积分不足"}
+                return {"success": False, "error": "Vidu积分不足", "quota_exhausted": True, "error_kind": error_kind}
             else:
-                return {"success": False, "error": f"Vidu请求错误: {error_data.get('message', response.text)}"}
+                return {"success": False, "error": f"Vidu请求错误: {error_data.get('message', response.text)}", "error_kind": error_kind}
         else:
-            return {"success": False, "error": f"Vidu API错误: {response.status_code} - {response.text[:200]}"}
+            return {
+                "success": False,
+                "error": f"Vidu API错误: {response.status_code} - {response.text[:200]}",
+                "error_kind": errors.classify_vidu(response.status_code),
+            }
             
+    except requests.exceptions.Timeout:
+        return {"success": False, "error": f"Vidu第{attempt_num}次尝试超时（{timeout:.0f}秒）", "timed_out": True, "error_kind": errors.TRANSIENT}
     except Exception as e:
-        return {"success": False, "error": f"Vidu第{attempt_num}次尝试异常: {str(e)}"}
+        return {"success": False, "error": f"Vidu第{attempt_num}次尝试异常: {str(e)}", "error_kind": errors.classify_exception(e)}
 
-def attempt_gemini_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int) -> dict:
+@budget_tracker.metered("gemini", "gemini-2.5-flash-image-preview")
+def attempt_gemini_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int, job_id: str = None, timeout: float = PROVIDER_CALL_TIMEOUT_SECONDS) -> dict:
     """Gemini AI生成尝试"""
     if not GEMINI_AVAILABLE:
-        return {"success": False, "error": "Gemini包未安装"}
+        return {"success": False, "error": "Gemini包未安装", "error_kind": errors.AUTH}
     
     try:
         print(f"第{attempt_num}次尝试 - 使用Gemini，prompt: {prompt_instruction[:100]}...")
         
-        # 初始化Gemini客户端
-        client = genai.Client(api_key=api_key)
+        # 下载图片：原图下载失败与Gemini本身无关，4xx说明原图不可用
+        deadline = Deadline(timeout)
+        try:
+            response = requests.get(base_image_url, timeout=max(1.0, deadline.clamp(30)))
+            response.raise_for_status()
+            image = Image.open(BytesIO(response.content))
+        except Exception as e:
+            status_code = getattr(getattr(e, "response", None), "status_code", None)
+            invalid = (status_code is not None and 400 <= status_code < 500) or type(e).__name__ == "UnidentifiedImageError"
+            return {
+                "success": False,
+                "error": f"Gemini第{attempt_num}次尝试下载原图失败: {str(e)}",
+                "error_kind": errors.INPUT_INVALID if invalid else errors.TRANSIENT,
+                "timed_out": "Timeout" in type(e).__name__,
+            }
         
-        # 下载图片
-        response = requests.get(base_image_url, timeout=30)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
+        # 初始化Gemini客户端，SDK的HTTP超时限制在本次尝试剩余的时间预算内
+        client = genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=max(1000, int(deadline.remaining() * 1000))))
         
         # 调用Gemini API
         response = client.models.generate_content(
@@ -260,26 +621,79 @@ def attempt_gemini_generation(api_key: str, base_image_url: str, prompt_instruct
         )
         
         # 处理响应
-        for part in response.candidates[0].content.parts:
+        parts = response.candidates[0].content.parts if response.candidates and response.candidates[0].content else None
+        for part in parts or []:
             if part.inline_data is not None:
+                try:
+                    output_validator.check(part.inline_data.data)
+                except OutputRejected as e:
+                    print(f"🧪 Gemini第{attempt_num}次尝试的输出未通过校验: {e}")
+                    return {"success": False, "error": f"输出图片未通过校验: {e}", "error_kind": errors.OUTPUT_INVALID}
                 # 保存生成的图片
                 generated_image = Image.open(BytesIO(part.inline_data.data))
                 unique_id = uuid.uuid4()
                 file_name = f"gemini_{unique_id}.png"
-                file_path = os.path.join(AI_PHOTOS_DIR, file_name)
-                generated_image.save(file_path)
+                buffer = BytesIO()
+                generated_image.save(buffer, format="PNG")
                 
-                image_path = f"/ai-photos/{file_name}"
+                image_path = ai_photos_store.save_bytes(file_name, buffer.getvalue(), job_id=job_id, provider="gemini")
                 print(f"Gemini第{attempt_num}次尝试成功 - 保存图片: {image_path}")
                 return {"success": True, "image_paths": [image_path]}
         
-        return {"success": False, "error": "Gemini未生成图片"}
+        # 没有图片：多半是被安全策略拦截
+        candidate = response.candidates[0] if response.candidates else None
+        feedback = getattr(response, "prompt_feedback", None)
+        reason = getattr(feedback, "block_reason", None) or getattr(candidate, "finish_reason", None)
+        return {"success": False, "error": f"Gemini未生成图片（{reason}）", "error_kind": errors.classify_gemini_block(reason)}
         
     except Exception as e:
-        return {"success": False, "error": f"Gemini第{attempt_num}次尝试异常: {str(e)}"}
+        return {
+            "success": False,
+            "error": f"Gemini第{attempt_num}次尝试异常: {str(e)}",
+            "quota_exhausted": "RESOURCE_EXHAUSTED" in str(e),
+            "timed_out": "Timeout" in type(e).__name__,
+            "error_kind": errors.TRANSIENT if "Timeout" in type(e).__name__ else errors.classify_exception(e),
+        }
+
+def observe_concurrency(provider: str, started: float, result: dict = None):
+    """把一次占用并发名额的调用交给自适应并发控制
+
+    只有超时、限流和provider返回的5xx算作过载信号；额度用尽、未生成图片、输出校验失败等与负载无关的失败不降低并发上限。
+    """
+    if concurrency_controller is None:
+        return
+    result = result or {}
+    success = bool(result.get("success"))
+    status_code = result.get("status_code") or 0
+    rate_limited = result.get("error_kind") == errors.RATE_LIMITED and not result.get("quota_exhausted")
+    dropped = not success and (bool(result.get("timed_out")) or rate_limited or status_code >= 500)
+    concurrency_controller.observe(provider, time.time() - started, success, dropped=dropped)
+
+def release_tongyi_slot(result: dict = None):
+    """释放通义并发名额；超时被放弃的SDK调用仍在运行时，等它真正返回后再释放，避免实际在途调用数超过上限"""
+    pending = (result or {}).pop("pending_call", None)
+    if pending is not None:
+        provider_limiter.release_when_done("tongyi", pending)
+    else:
+        provider_limiter.release("tongyi")
+
+@budget_tracker.metered("tongyi", "qwen-image-edit")
+def attempt_ai_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int, acquire_slot: bool = True, job_id: str = None, timeout: float = PROVIDER_CALL_TIMEOUT_SECONDS) -> dict:
+    """单次AI生成尝试，整个尝试（含排队等待并发名额）最多timeout秒"""
+    deadline = Deadline(timeout)
+    if acquire_slot:
+        if not provider_limiter.acquire("tongyi", timeout=timeout, owner=job_id):
+            return {"success": False, "error": f"第{attempt_num}次尝试等待通义并发名额超时", "timed_out": True, "error_kind": errors.RATE_LIMITED}
+        started = time.time()
+        result = None
+        try:
+            # 直接调用未装饰的函数，同一次尝试只记一次账
+            result = attempt_ai_generation.__wrapped__(api_key, base_image_url, prompt_instruction, attempt_num, acquire_slot=False, job_id=job_id, timeout=deadline.remaining())
+            return result
+        finally:
+            observe_concurrency("tongyi", started, result)
+            release_tongyi_slot(result)
 
-def attempt_ai_generation(api_key: str, base_image_url: str, prompt_instruction: str, attempt_num: int) -> dict:
-    """单次AI生成尝试"""
     try:
         print(f"第{attempt_num}次尝试 - 使用prompt: {prompt_instruction[:100]}...")
         
@@ -293,7 +707,9 @@ def attempt_ai_generation(api_key: str, base_image_url: str, prompt_instruction:
             }
         ]
 
-        response = MultiModalConversation.call(
+        # SDK没有超时参数，放到独立线程中执行，超时后直接放弃
+        response = call_with_timeout(
+            dashscope.MultiModalConversation.call, deadline.remaining(),
             api_key=api_key,
             model="qwen-image-edit",
             messages=messages,
@@ -307,22 +723,208 @@ def attempt_ai_generation(api_key: str, base_image_url: str, prompt_instruction:
             choices = response_data['output']['choices']
 
             image_paths = []
+            rejected = []
             for choice in choices:
                 for content_item in choice['message']['content']:
                     if 'image' in content_item:
-                        saved_path = save_image_from_url(content_item['image'])
+                        try:
+                            saved_path = save_image_from_url(content_item['image'], job_id=job_id, timeout=deadline.remaining())
+                        except OutputRejected as e:
+                            print(f"🧪 第{attempt_num}次尝试的输出未通过校验: {e}")
+                            rejected.append(str(e))
+                            continue
                         image_paths.append(saved_path)
                         print(f"第{attempt_num}次尝试成功 - 保存图片: {saved_path}")
 
             if image_paths:
                 return {"success": True, "image_paths": image_paths}
+            elif rejected:
+                return {"success": False, "error": f"输出图片未通过校验: {'; '.join(rejected)}", "error_kind": errors.OUTPUT_INVALID}
             else:
-                return {"success": False, "error": "未生成图片"}
+                return {"success": False, "error": "未生成图片", "error_kind": errors.TRANSIENT}
         else:
-            return {"success": False, "error": f"API返回错误: {response.message}"}
+            return {
+                "success": False,
+                "error": f"API返回错误: {response.message}",
+                "quota_exhausted": response.code in DASHSCOPE_QUOTA_CODES,
+                "error_kind": errors.classify_dashscope(response.status_code, response.code, response.message),
+                "status_code": response.status_code,
+            }
             
+    except CallTimeout as e:
+        # pending_call由持有并发名额的调用方取走，底层调用返回后才释放名额
+        return {"success": False, "error": f"第{attempt_num}次尝试超时: {e}", "timed_out": True, "error_kind": errors.TRANSIENT, "pending_call": e.pending}
+    except Exception as e:
+        return {"success": False, "error": f"第{attempt_num}次尝试异常: {str(e)}", "error_kind": errors.classify_exception(e)}
+
+def attempt_tongyi_fanout(api_key: str, base_image_url: str, instructions: list[str], first_attempt_num: int, return_alternates: bool = False, job_id: str = None, timeout: float = PROVIDER_CALL_TIMEOUT_SECONDS, on_result: Callable = None) -> dict:
+    """把多个prompt变体并发提交给通义，第一个成功的结果胜出
+
+    实际并发数受通义的并发预算限制，至少保证一个名额。
+    return_alternates为True时等待其余在途请求结束，把其他成功结果作为备选返回。
+    on_result(序号, 结果, 耗时) 在每个变体结束时调用，包括胜出之后仍在后台跑完的请求。
+    """
+    deadline = Deadline(timeout)
+    if not provider_limiter.acquire("tongyi", timeout=timeout, owner=job_id):
+        return {"success": False, "error": "等待通义并发名额超时", "attempts": 1, "error_kind": errors.RATE_LIMITED}
+    granted = 1 + provider_limiter.try_acquire("tongyi", len(instructions) - 1)
+    instructions = instructions[:granted]
+    print(f"🔀 通义并行推测: 同时提交 {granted} 个变体")
+
+    task_tag = current_tag()
+
+    def run(index: int) -> dict:
+        tag_thread(task_tag)
+        started = time.time()
+        result = None
+        try:
+            result = attempt_ai_generation(api_key, base_image_url, instructions[index], first_attempt_num + index, acquire_slot=False, job_id=job_id, timeout=deadline.remaining())
+            if on_result is not None:
+                on_result(index, result, time.time() - started)
+            return result
+        finally:
+            observe_concurrency("tongyi", started, result)
+            release_tongyi_slot(result)
+            tag_thread(None)
+
+    executor = ThreadPoolExecutor(max_workers=granted, thread_name_prefix="fanout")
+    futures = {executor.submit(run, index): index for index in range(granted)}
+    failures = []
+    failure_kinds = set()
+    winner = None
+    alternates = []
+    try:
+        pending = set(futures)
+        while pending:
+            # 每个调用自身有超时，这里的等待只是兜底
+            done, pending = wait(pending, timeout=deadline.remaining() + 1, return_when=FIRST_COMPLETED)
+            if not done:
+                failures.append("并行推测超时")
+                failure_kinds.add(errors.TRANSIENT)
+                break
+            for future in done:
+                result = future.result()
+                index = futures[future]
+                if not result["success"]:
+                    failures.append(f"变体{index}: {result['error']}")
+                    failure_kinds.add(result.get("error_kind", errors.TRANSIENT))
+                elif winner is None:
+                    winner = {**result, "variant_index": index}
+                else:
+                    alternates.extend(result["image_paths"])
+            if winner is not None and not return_alternates:
+                break
+    finally:
+        # 落后的请求无法取消，让它们在后台跑完并释放名额
+        executor.shutdown(wait=False)
+
+    if winner is None:
+        # 有一个变体是临时故障就按临时故障处理；全部被审核拒绝时换变体，provider级别的错误直接换provider
+        fatal = failure_kinds & errors.PROVIDER_FATAL
+        if fatal:
+            error_kind = fatal.pop()
+        elif len(failure_kinds) == 1:
+            error_kind = failure_kinds.pop()
+        else:
+            error_kind = errors.TRANSIENT
+        return {"success": False, "error": "; ".join(failures), "attempts": granted, "error_kind": error_kind}
+    winner["attempts"] = granted
+    if return_alternates:
+        winner["alternate_image_paths"] = alternates
+    return winner
+
+def submit_cartoon_video(image_path: str, prompt: str = None, job_id: str = None) -> str:
+    """把已生成的卡通图片提交为图生视频任务，返回DashScope任务ID
+
+    本地图片先放入原图存储以获得provider可访问的URL；视频完成后写入ai-videos。
+    """
+    api_key = os.getenv("DASHSCOPE_API_KEY")
+    if not api_key or api_key == "your_dashscope_api_key_here":
+        raise HTTPException(status_code=500, detail="DashScope API key未配置")
+    if not image_path.startswith("/ai-photos/"):
+        raise HTTPException(status_code=400, detail=f"只支持/ai-photos/下的图片: {image_path}")
+
+    local_path = os.path.normpath(os.path.join(AI_PHOTOS_DIR, image_path[len("/ai-photos/"):]))
+    if not local_path.startswith(os.path.normpath(AI_PHOTOS_DIR) + os.sep) or not os.path.isfile(local_path):
+        raise HTTPException(status_code=404, detail=f"图片不存在: {image_path}")
+    try:
+        with open(local_path, "rb") as f:
+            image_url = original_storage.save_bytes(f"video_src_{uuid.uuid4()}.png", f.read(), job_id=job_id, provider="video-source")
     except Exception as e:
-        return {"success": False, "error": f"第{attempt_num}次尝试异常: {str(e)}"}
+        raise HTTPException(status_code=502, detail=f"视频源图片上传失败: {e}")
+
+    def on_video_done(task):
+        if task.status == "SUCCEEDED":
+            budget_tracker.charge("tongyi", "wan2.2-i2v-flash", job_id=job_id)
+        if task.result_paths:
+            print(f"🎬 任务 {job_id} 的视频已生成: {task.result_paths[0]}")
+
+    try:
+        task = dashscope_engine.submit_video(prompt or VIDEO_DEFAULT_PROMPT, image_url, api_key, callback=on_video_done, job_id=job_id)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"视频任务提交失败: {e}")
+    return task.task_id
+
+def install_drain_handler():
+    """在uvicorn的SIGTERM处理函数之前插入排空逻辑；uvicorn的处理函数负责停止监听"""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def stop_listening():
+        if callable(previous):
+            previous(signal.SIGTERM, None)
+        else:
+            # 不在uvicorn下运行时恢复默认行为
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def active_jobs() -> dict:
+        with task_lock:
+            return {task_id: info["request"] for task_id, info in running_tasks.items() if "request" in info}
+
+    def on_sigterm(signum, frame):
+        drain_controller.begin(stop_listening, active_jobs)
+
+    try:
+        signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:
+        # 只能在主线程注册信号处理函数（例如TestClient中运行时）
+        print("⚠️ 不在主线程中，跳过SIGTERM排空处理")
+
+# 本进程恢复执行的上次排空时未完成的任务：task_id -> 状态（resuming，或结束后的success/failed及结果）
+resumed_tasks = {}
+
+def resume_checkpointed_jobs():
+    """把上一个进程排空时没做完的任务作为一个批量任务在后台重新执行
+
+    任务沿用原来的task_id，等待结果的客户端（photo-app）可以继续用 /task-status/{task_id} 查询；
+    整批结果也可以用 /batch/{batch_id} 查询。
+    """
+    pending = drain_controller.take_pending()
+    if not pending:
+        return
+    batch_id = f"resume-{time.strftime('%Y%m%d-%H%M%S')}"
+    items = [{**request, "task_id": task_id, "id": task_id} for task_id, request in pending]
+    with task_lock:
+        for task_id, _ in pending:
+            resumed_tasks[task_id] = {"status": "resuming", "batch_id": batch_id}
+    checkpoint = BatchCheckpoint(os.path.join(BATCH_CHECKPOINT_DIR, f"{batch_id}.jsonl"))
+    runner = BatchRunner(run_generation_job, checkpoint, concurrency=BATCH_MAX_CONCURRENCY)
+    print(f"♻️ 恢复上次排空时未完成的 {len(items)} 个任务（batch_id: {batch_id}）")
+
+    def run():
+        for record in runner.run(items):
+            print(f"♻️ 恢复任务 {record['key']}: {record['status']}")
+            # 再次遇到重启时任务又写入了checkpoint，由下一个进程继续
+            status = "resuming" if record["key"] in drain_controller.checkpointed else record["status"]
+            with task_lock:
+                resumed_tasks[record["key"]] = {
+                    "status": status,
+                    "batch_id": batch_id,
+                    "image_paths": record.get("image_paths", []),
+                    "error": record.get("error"),
+                }
+
+    threading.Thread(target=run, name="resume", daemon=True).start()
 
 @app.get("/")
 def read_root():
@@ -334,9 +936,36 @@ def get_running_tasks():
     with task_lock:
         return {
             "running_tasks": list(running_tasks.keys()),
-            "count": len(running_tasks)
+            "count": len(running_tasks),
+            # AI还在生成时可以先展示的本地卡通预览
+            "previews": {task_id: info["preview_path"] for task_id, info in running_tasks.items() if info.get("preview_path")},
         }
 
+@app.get("/task-status/{task_id}")
+def get_task_status(task_id: str):
+    """运行中任务的阶段、排队位置和预计完成时间（每次查询按实时统计重新估算）
+
+    重启前没做完、由本进程恢复的任务，在开始执行前返回status为resuming，结束后返回success/failed和结果。
+    """
+    status = eta_estimator.estimate(task_id)
+    if status is None:
+        with task_lock:
+            resumed = resumed_tasks.get(task_id)
+        if resumed is None:
+            raise HTTPException(status_code=404, detail=f"任务 {task_id} 不存在或已完成")
+        return {"task_id": task_id, **resumed}
+    status["status"] = "running"
+    with task_lock:
+        info = running_tasks.get(task_id, {})
+        status["preview_path"] = info.get("preview_path")
+        status["cancelled"] = info.get("cancelled", False)
+    return status
+
+@app.get("/queue-estimate")
+def get_queue_estimate():
+    """现在提交新任务的预计排队时间和完成时间，客户端可以据此设置超时"""
+    return eta_estimator.estimate_new(attempt_provider_order()[0])
+
 @app.post("/cancel-task/{task_id}")
 def cancel_task(task_id: str):
     """取消指定的任务"""
@@ -395,7 +1024,9 @@ def get_vidu_task_status(task_id: str):
 
 @app.get("/health")
 def health_check():
-    """API健康检查"""
+    """API健康检查；排空期间返回503，负载均衡据此摘除本实例"""
+    if drain_controller.draining:
+        return JSONResponse(status_code=503, content={"status": "draining", "drain": drain_controller.snapshot()})
     return {
         "status": "healthy",
         "ai_photos_dir": AI_PHOTOS_DIR,
@@ -405,37 +1036,324 @@ def health_check():
         "gemini_available": GEMINI_AVAILABLE,
         "gemini_prompt_optimization": GEMINI_AVAILABLE and bool(os.getenv("GEMINI_API_KEY")),
         "vidu_api_key_configured": bool(os.getenv("VIDU_API_KEY")),
-        "fallback_strategy": "通义5次 → Gemini1次 → Vidu1次 (共7次重试)"
+        "fallback_strategy": "按费用/额度/延迟排序: 主provider 5次 → 其余各1次 (共7次重试)",
+        "tongyi_fanout": TONGYI_FANOUT,
+        "prompt_batching": prompt_batcher.snapshot(),
+        "provider_concurrency": provider_limiter.snapshot(),
+        "adaptive_concurrency": concurrency_controller.snapshot() if concurrency_controller else None,
+        "retention": retention_manager.snapshot(),
+        "preflight_crop": subject_crop_snapshot(),
+        "queue": eta_estimator.snapshot(attempt_provider_order()),
+        "local_cartoon": cartoon_snapshot(),
+        "output_validation": output_validator.snapshot(),
+        "gallery": gallery_feed.snapshot(),
+        "dashscope_tasks": dashscope_engine.snapshot(),
+        "job_deadline_seconds": JOB_DEADLINE_SECONDS,
+        "isolated_calls": isolation_snapshot(),
+        "dedup_policy": DEDUP_POLICY,
+        "dedup": duplicate_index.snapshot(),
+        "drain": drain_controller.snapshot(),
+        "event_log": event_log.snapshot(),
+        "prompt_bandit": prompt_bandit.snapshot() if PROMPT_BANDIT else None
     }
 
+@app.get("/budget")
+def get_budget(latency_target: float = None):
+    """各provider本计费周期的花费、剩余预算、延迟/成功率估计，以及当前的调度顺序"""
+    return budget_tracker.snapshot(configured_providers(), latency_target or LATENCY_TARGET_SECONDS)
+
+def configured_providers() -> list[str]:
+    candidates = ["tongyi"]
+    if os.getenv("GEMINI_API_KEY") and GEMINI_AVAILABLE:
+        candidates.append("gemini")
+    if os.getenv("VIDU_API_KEY"):
+        candidates.append("vidu")
+    return candidates
+
+def attempt_provider_order() -> list[str]:
+    """新任务当前会按什么顺序使用provider（额度都用尽时按配置顺序）"""
+    candidates = configured_providers()
+    return budget_tracker.rank(candidates, LATENCY_TARGET_SECONDS) or candidates
+
+def require_admin(authorization: str = None, x_admin_token: str = None):
+    token = x_admin_token or ""
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="需要管理员令牌")
+
+def render_profile(session, format: str):
+    if format == "collapsed":
+        return PlainTextResponse(session.collapsed())
+    if format == "speedscope":
+        return JSONResponse(
+            content=session.speedscope(),
+            headers={"Content-Disposition": f'attachment; filename="profile-{session.id}.speedscope.json"'},
+        )
+    return {**session.summary(), "threads": session.threads()}
+
+@app.post("/admin/profile")
+def start_profile(seconds: float = None, jobs: int = None, interval_ms: float = 10, format: str = "summary",
+                  authorization: str = Header(None), x_admin_token: str = Header(None)):
+    """对运行中的进程做统计采样：seconds 指定时长（同步返回结果），jobs 指定采样接下来的K个生成任务（异步，用GET查询）
+
+    format: summary（每线程墙钟时间拆分）/ collapsed（折叠栈文本）/ speedscope（speedscope JSON）
+    """
+    require_admin(authorization, x_admin_token)
+    if format not in ("summary", "collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail=f"未知的format: {format}")
+    if seconds is None and jobs is None:
+        raise HTTPException(status_code=400, detail="需要seconds或jobs参数")
+    if seconds is not None and not seconds > 0:
+        raise HTTPException(status_code=400, detail=f"seconds必须大于0: {seconds}")
+    if jobs is not None and jobs < 1:
+        raise HTTPException(status_code=400, detail=f"jobs不能小于1: {jobs}")
+    if not interval_ms >= 1:
+        raise HTTPException(status_code=400, detail="interval_ms不能小于1")
+    try:
+        session = profiler.start(
+            interval_ms / 1000,
+            seconds=min(seconds, PROFILE_MAX_SECONDS) if seconds else None,
+            jobs=jobs,
+            max_seconds=PROFILE_MAX_SECONDS,
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    print(f"🔬 开始采样 {session.id}: seconds={session.seconds} jobs={jobs} interval={interval_ms}ms")
+    if jobs:
+        return JSONResponse(status_code=202, content=session.summary())
+    session.done.wait()
+    return render_profile(session, format)
+
+@app.get("/admin/profile/{profile_id}")
+def get_profile(profile_id: str, format: str = "summary", stop: bool = False,
+                authorization: str = Header(None), x_admin_token: str = Header(None)):
+    """查询采样结果；仍在采样时返回202和进度，stop=true提前结束采样"""
+    require_admin(authorization, x_admin_token)
+    session = profiler.get(profile_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"采样会话不存在: {profile_id}")
+    if stop:
+        session.stop()
+        session.done.wait(5)
+    if not session.done.is_set():
+        return JSONResponse(status_code=202, content=session.summary())
+    return render_profile(session, format)
+
+@app.get("/startup-report")
+def startup_report():
+    """启动耗时报告：app.main导入耗时和各SDK的延迟加载耗时"""
+    return {
+        "app_import_seconds": STARTUP_IMPORT_SECONDS,
+        "prewarm_enabled": PREWARM_SDKS,
+        "sdk_load_seconds": dict(load_timings),
+        "sdk_pending": [name for name in PREWARM_MODULES if name not in load_timings],
+    }
+
+@app.get("/manifest")
+def query_manifest(job_id: str = None, since: float = 0, until: float = None, limit: int = 1000, store: str = "ai-photos"):
+    """按任务ID或创建时间范围查询已生成的文件（只读内存索引，不遍历目录）"""
+    stores = {"ai-photos": ai_photos_store, "original-photos-cache": original_storage}
+    if store not in stores:
+        raise HTTPException(status_code=400, detail=f"未知的store: {store}")
+    target = stores[store]
+    records = target.find_by_job(job_id) if job_id else target.find_between(since, until, limit)
+    return {"store": store, "count": len(records), "records": records}
+
+@app.get("/gallery")
+async def gallery(cursor: str = None, since: float = None, limit: int = 50, wait: float = 0,
+            if_none_match: str = Header(None)):
+    """生成图片的增量feed：按时间排序，带cursor只返回之后的新图片；支持ETag/304和长轮询（wait秒）
+
+    不带cursor和since时返回最新的limit张；把响应中的next_cursor传回来获取之后的图片。
+    """
+    limit = max(1, min(limit, GALLERY_MAX_LIMIT))
+    wait = max(0.0, min(wait, GALLERY_MAX_WAIT_SECONDS))
+    try:
+        page, etag = await gallery_feed.page(run_in_threadpool, cursor, since, limit, wait)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"无效的cursor: {cursor}")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        gallery_feed.not_modified()
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content={**page, "count": len(page["items"])}, headers=headers)
+
+def attach_video_stage(response: dict, request: dict, task_id: str) -> dict:
+    """请求带with_video时，把生成的卡通图继续提交图生视频；视频失败不影响图片结果"""
+    if not request.get("with_video"):
+        return response
+    try:
+        response["video_task_id"] = submit_cartoon_video(response["image_paths"][0], request.get("video_prompt"), task_id)
+    except HTTPException as e:
+        print(f"⚠️ 任务 {task_id} 的视频提交失败: {e.detail}")
+        response["video_error"] = e.detail
+    except Exception as e:
+        print(f"⚠️ 任务 {task_id} 的视频提交失败: {e}")
+        response["video_error"] = str(e)
+    return response
+
+@app.post("/generate-video/")
+def generate_video(request: dict):
+    """把卡通图片生成短视频（异步），返回任务ID，用 /video-task/{task_id} 查询结果"""
+    image_path = request.get("image_path")
+    if not image_path:
+        raise HTTPException(status_code=400, detail="缺少image_path参数")
+    task_id = submit_cartoon_video(image_path, request.get("prompt"), request.get("job_id"))
+    return {"status": "submitted", "video_task_id": task_id}
+
+@app.get("/video-task/{task_id}")
+def get_video_task(task_id: str):
+    """查询DashScope视频任务状态，完成后result_paths为/ai-videos/下的MP4路径"""
+    task = dashscope_engine.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"视频任务 {task_id} 不存在")
+    return task.to_dict()
+
+def record_attempt_event(task_id: str, attempt_num: int, provider: str, prompt_variant: int, started: float,
+                         result: dict, sleep_ms: float = 0.0, fanout: int = 1):
+    event_log.record(
+        "attempt",
+        job_id=task_id,
+        attempt=attempt_num,
+        provider=provider,
+        prompt_variant=prompt_variant,
+        fanout=fanout,
+        success=bool(result["success"]),
+        latency_ms=(time.time() - started) * 1000,
+        sleep_ms=sleep_ms,
+        error=None if result["success"] else str(result.get("error"))[:500],
+        error_kind=None if result["success"] else result.get("error_kind", errors.TRANSIENT),
+    )
+
 def is_task_cancelled(task_id: str) -> bool:
     """检查任务是否被取消"""
     with task_lock:
         task_info = running_tasks.get(task_id)
         return task_info and task_info.get("cancelled", False)
 
+def check_near_duplicate(task_id: str, content: bytes, request: dict, prompt: str, deadline: Deadline) -> dict:
+    """计算原图感知哈希并登记；找到同一会话的近似重复时返回其信息，reuse策略下尽量带回之前的结果"""
+    try:
+        value = duplicate_index.compute(content)
+    except Exception as e:
+        print(f"⚠️ 计算感知哈希失败: {e}")
+        return None
+    session_id = request.get("session_id")
+    match = duplicate_index.find(value, session_id, window_fallback=DEDUP_WINDOW_FALLBACK, exclude_job=task_id)
+    duplicate_index.add(task_id, value, session_id, prompt)
+    if match is None:
+        return None
+
+    distance, entry = match
+    info = {"job_id": entry["job_id"], "distance": distance, "reused": False}
+    print(f"👯 任务 {task_id} 与 {entry['job_id']} 近似重复（汉明距离 {distance}）")
+    # 只有prompt相同时才复用；前一张还在生成时等它结束，但不超过本任务截止时间的一半
+    if DEDUP_POLICY == "reuse" and entry["prompt"] == prompt:
+        if entry["status"] == "pending":
+            entry = duplicate_index.wait_result(entry["job_id"], deadline.remaining() / 2)
+        if entry["status"] == "success" and entry["image_paths"]:
+            info.update(reused=True, image_paths=entry["image_paths"])
+            duplicate_index.mark_reused()
+    return info
+
+def start_local_preview(task_id: str, content: bytes):
+    """在进程池中生成本地卡通预览，完成后保存并登记到任务上；返回Future（结果为图片路径），不可用时返回None"""
+    if not LOCAL_CARTOON or content is None:
+        return None
+    preview = Future()
+
+    def save(future):
+        try:
+            path = ai_photos_store.save_bytes(f"local_{task_id}.jpg", future.result(), job_id=task_id, provider="local")
+        except Exception as e:
+            print(f"⚠️ 任务 {task_id} 的本地卡通预览失败: {e}")
+            preview.set_exception(e)
+            return
+        with task_lock:
+            if task_id in running_tasks:
+                running_tasks[task_id]["preview_path"] = path
+        preview.set_result(path)
+
+    submit_cartoon(content).add_done_callback(save)
+    return preview
+
+def local_fallback(task_id: str, preview, reason: str) -> dict:
+    """所有provider都失败时，用本地卡通预览作为结果；预览不可用时返回None"""
+    if preview is None:
+        return None
+    try:
+        path = preview.result(timeout=LOCAL_CARTOON_WAIT_SECONDS)
+    except Exception:
+        return None
+    print(f"🖍️ 任务 {task_id} 使用本地卡通预览作为结果")
+    # 标记为最终结果后才会出现在 /gallery 中
+    ai_photos_store.mark(f"local_{task_id}.jpg", final=True)
+    return {"status": "success", "image_paths": [path], "task_id": task_id, "fallback": "local", "provider_error": reason}
+
 @app.post("/generate-image/")
 def generate_image(request: dict):
     """带自动重试机制的卡通图片生成"""
-    # 生成任务ID
-    task_id = str(uuid.uuid4())
+    return run_generation_job(request)
+
+def request_number(request: dict, key: str, default, cast: Callable = float):
+    """读取请求中的数值参数，缺省时返回default，无法解析时返回400"""
+    value = request.get(key)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"{key}必须是数字: {value!r}")
+
+def run_generation_job(request: dict) -> dict:
+    """执行一次完整的生成任务（通义5次 → Gemini → Vidu），失败时抛出HTTPException"""
+    if drain_controller.draining:
+        raise HTTPException(status_code=503, detail="服务器正在重启，请稍后重试")
+
+    # 生成任务ID；客户端可以自带任务ID，在等待结果的同时用 /task-status/{task_id} 查询排队位置和预计完成时间
+    task_id = request.get("task_id") or str(uuid.uuid4())
+    if not isinstance(task_id, str) or not TASK_ID_PATTERN.match(task_id):
+        raise HTTPException(status_code=400, detail="task_id只能包含字母、数字、下划线和连字符，长度8~64")
+    # 端到端截止时间：所有尝试共享这个预算，到期后给出明确的失败结果
+    deadline_seconds = request_number(request, "deadline_seconds", JOB_DEADLINE_SECONDS)
+    if not deadline_seconds > 0:
+        raise HTTPException(status_code=400, detail=f"deadline_seconds必须大于0: {deadline_seconds}")
+    deadline = Deadline(min(deadline_seconds, MAX_JOB_DEADLINE_SECONDS))
+    # 可选：并行推测模式，把前k个变体同时提交给通义
+    fanout = max(1, min(request_number(request, "fanout", TONGYI_FANOUT, int), 5))
+    # 主provider需要在这个时间内完成，才按成本优先选择
+    latency_target = request_number(request, "latency_target", LATENCY_TARGET_SECONDS)
+    if not latency_target > 0:
+        raise HTTPException(status_code=400, detail=f"latency_target必须大于0: {latency_target}")
     
     # 注册任务
     with task_lock:
+        if task_id in running_tasks:
+            raise HTTPException(status_code=409, detail=f"任务 {task_id} 正在运行")
         running_tasks[task_id] = {
             "created_at": time.time(),
+            "deadline_at": deadline.expires_at,
             "cancelled": False,
             "request": request
         }
+    eta_estimator.job_started(task_id, deadline.expires_at, attempt_provider_order()[0])
     
+    stopped_for_drain = False
+    # 写入事件日志的任务结果，在各个返回和异常分支中更新
+    job_event = {"status": "failed", "attempt": 0, "sleep_ms": 0.0, "http_status": 200}
+    preview = None  # 本地卡通预览的Future
+    tag_thread(task_id)
     try:
         print(f"🚀 开始任务 {task_id}")
         
         model_name = request.get("model_name", "qwen-image-edit")
         prompt = request.get("prompt", "生成可爱的卡通形象")
         base_image_url = request.get("base_image_url")
+        # 批量重跑时可以直接引用original-photos目录中的文件
+        original_file = None if base_image_url else request.get("original_file")
 
-        if not base_image_url:
+        if not base_image_url and not original_file:
             raise HTTPException(status_code=400, detail="缺少base_image_url参数")
 
         # 获取API keys
@@ -444,41 +1362,100 @@ def generate_image(request: dict):
         vidu_api_key = os.getenv("VIDU_API_KEY")
         
         if not dashscope_api_key or dashscope_api_key == "your_dashscope_api_key_here":
-            # Mock模式：生成随机彩色图片
+            # Mock模式：返回本地卡通化的结果，不可用时生成随机彩色图片
+            preview = start_local_preview(task_id, fetch_original_content(base_image_url, original_file))
+            response = local_fallback(task_id, preview, "未配置DASHSCOPE_API_KEY")
+            if response is not None:
+                with task_lock:
+                    running_tasks.pop(task_id, None)
+                job_event.update(status="mock", provider="local")
+                del response["fallback"], response["provider_error"]
+                return response
+
             import random
             from PIL import Image
 
-            os.makedirs(AI_PHOTOS_DIR, exist_ok=True)
             colors = ["#FC6A59", "#FFC63E", "#FD543F", "#6CC8CC"]
             mock_color = random.choice(colors)
 
             image = Image.new('RGB', (512, 512), mock_color)
             unique_id = uuid.uuid4()
             file_name = f"cartoon_{unique_id}.png"
-            file_path = os.path.join(AI_PHOTOS_DIR, file_name)
-            image.save(file_path)
+            buffer = BytesIO()
+            image.save(buffer, format="PNG")
+            image_path = ai_photos_store.save_bytes(file_name, buffer.getvalue(), job_id=task_id, provider="mock")
 
-            return {"status": "success", "image_paths": [f"/ai-photos/{file_name}"]}
+            with task_lock:
+                running_tasks.pop(task_id, None)
+            job_event.update(status="mock", provider="mock")
+            return {"status": "success", "image_paths": [image_path]}
 
-        # 如果是本地URL，下载并缓存到AI服务器，返回8080端口URL
-        if base_image_url.startswith(('http://localhost:', 'http://127.0.0.1:')):
-            print(f"本地图片URL: {base_image_url}，正在下载并缓存...")
-            public_url = download_and_cache_original_image(base_image_url)
-            print(f"AI服务器图片URL: {public_url}")
-            base_image_url = public_url
-
-        # 使用Gemini 2.5 Flash优化用户prompt
+        # 使用Gemini 2.5 Flash优化用户prompt，与原图预处理并行执行
         print(f"📝 原始prompt: {prompt}")
+        prompt_started = time.time()
         if gemini_api_key and GEMINI_AVAILABLE:
-            optimized_prompt = optimize_prompt_with_gemini_flash(prompt, gemini_api_key)
+            optimize_future = submit_prompt_optimization(prompt, gemini_api_key)
         else:
-            optimized_prompt = prompt
+            optimize_future = None
             print("⚠️ Gemini不可用，跳过prompt优化")
-        
+
+        content = fetch_original_content(base_image_url, original_file)
+
+        # 同一会话中的近似重复：标记，或者直接复用之前的结果
+        near_duplicate = None
+        if content is not None and DEDUP_POLICY != "off" and request.get("dedup", True):
+            near_duplicate = check_near_duplicate(task_id, content, request, prompt, deadline)
+            if near_duplicate is not None and near_duplicate.get("reused"):
+                if optimize_future is not None:
+                    optimize_future.cancel()
+                with task_lock:
+                    running_tasks.pop(task_id, None)
+                print(f"♻️ 任务 {task_id} 与 {near_duplicate['job_id']} 近似重复，复用结果")
+                duplicate_index.record_result(task_id, "success", near_duplicate["image_paths"])
+                job_event["status"] = "reused"
+                return {"status": "success", "image_paths": near_duplicate["image_paths"], "task_id": task_id, "near_duplicate": near_duplicate}
+
+        # 本地卡通预览与AI生成并行，先展示，所有provider都失败时作为结果
+        preview = start_local_preview(task_id, content)
+
+        # 预处理原图，得到每个provider使用的图片URL
+        image_urls = prepare_provider_images(base_image_url, content, deadline.remaining())
+        # 登记本任务引用的缓存原图：更新访问时间，并在任务结束前防止被清理
+        cached_files = {
+            file_name for file_name in map(original_storage.file_name_for_url, image_urls.values()) if file_name
+        }
+        for file_name in cached_files:
+            retention_manager.touch(original_storage.path_for(file_name))
+        with task_lock:
+            if task_id in running_tasks:
+                running_tasks[task_id]["files"] = cached_files
+
+        # 第一次尝试只等待剩余的延迟预算，超时则先用原始prompt，优化结果到达后用于后续尝试
+        optimized_prompt = prompt
+        if optimize_future is not None:
+            remaining = PROMPT_OPTIMIZE_BUDGET - (time.time() - prompt_started)
+            wait_started = time.time()
+            try:
+                optimized_prompt = optimize_future.result(timeout=max(0, remaining))
+                optimize_future = None
+            except FutureTimeoutError:
+                print(f"⏱️ prompt优化超过{PROMPT_OPTIMIZE_BUDGET * 1000:.0f}ms预算，先使用原始prompt")
+            job_event["prompt_wait_ms"] = (time.time() - wait_started) * 1000
+
         # 生成基于优化prompt的多种变体
         prompt_variants = generate_prompt_variants(optimized_prompt)
+        template_set = prompt_template_set(optimized_prompt)
         print(f"为优化后的prompt生成了 {len(prompt_variants)} 个变体")
-        
+
+        def refresh_prompt_variants():
+            """优化结果迟到时，为后续尝试切换到优化后的变体"""
+            nonlocal optimize_future, prompt_variants, template_set
+            if optimize_future is not None and optimize_future.done():
+                prompt_variants = generate_prompt_variants(optimize_future.result())
+                template_set = prompt_template_set(optimize_future.result())
+                optimize_future = None
+                print("🎨 prompt优化结果已到达，后续尝试使用优化后的变体")
+
         # 记录所有尝试的错误
         all_errors = []
         
@@ -500,78 +1477,322 @@ def generate_image(request: dict):
         # 保持原有的5次通义重试，然后增加额外的fallback选项
         max_attempts = 7  # 5次通义 + 1次Gemini + 1次Vidu
         
-        for attempt in range(max_attempts):
+        # 按费用、剩余额度和延迟目标规划每次尝试的provider；
+        # 默认价格下与原来的顺序一致（通义5次 → Gemini1次 → Vidu1次）
+        candidate_providers = ["tongyi"]
+        if gemini_api_key and GEMINI_AVAILABLE:
+            candidate_providers.append("gemini")
+        if vidu_api_key:
+            candidate_providers.append("vidu")
+        attempt_plan = budget_tracker.plan(candidate_providers, max_attempts, latency_target)
+        if not attempt_plan:
+            with task_lock:
+                running_tasks.pop(task_id, None)
+            raise HTTPException(status_code=503, detail="所有provider本周期额度已用尽")
+        print(f"🧭 provider计划: {' → '.join(attempt_plan)}")
+
+        first_attempt = 0
+        # 并行推测整体记为一次尝试，之后的串行尝试在事件日志中从第2次开始编号
+        event_attempt_offset = 0
+        tried_variants = set()
+        # 按错误类别调整后续尝试：本任务不再使用的provider（-> 错误类别）、被审核拒绝多次后尽量避开的provider、
+        # 刚被限流、下一次尝试先避开的provider
+        excluded_providers = {}
+        avoided_providers = set()
+        avoid_once = None
+        policy_rejections = {}
+        if fanout > 1 and attempt_plan[0] == "tongyi":
+            refresh_prompt_variants()
+            fanout_variants = choose_prompt_variants("tongyi", template_set, len(prompt_variants), tried_variants, k=fanout)
+            fanout_template_set = template_set
+            instructions = [build_instruction(prompt_variants[variant]) for variant in fanout_variants]
+            fanout_started = time.time()
+            eta_estimator.attempt_started(task_id, "tongyi", 1)
+            result = attempt_tongyi_fanout(
+                dashscope_api_key, image_urls["tongyi"], instructions, 1,
+                return_alternates=bool(request.get("return_alternates", False)),
+                job_id=task_id,
+                timeout=deadline.clamp(PROVIDER_CALL_TIMEOUT_SECONDS),
+                on_result=lambda index, r, elapsed: observe_prompt_variant("tongyi", fanout_template_set, fanout_variants[index], r, elapsed),
+            )
+            # variant_index是instructions中的序号，换算成变体序号
+            winning_variant = fanout_variants[result["variant_index"]] if result["success"] else None
+            tried_variants.update(fanout_variants[:result["attempts"]])
+            record_attempt_event(task_id, 1, "tongyi", winning_variant, fanout_started, result, fanout=result["attempts"])
+            job_event.update(attempt=1, fanout=result["attempts"])
+            if result["success"]:
+                print(f"\n✅ 通义并行推测成功（变体{winning_variant}）！")
+                job_event.update(status="success", provider="tongyi", prompt_variant=winning_variant)
+                with task_lock:
+                    running_tasks.pop(task_id, None)
+                print(f"🏁 任务 {task_id} 完成")
+                response = {"status": "success", "image_paths": result["image_paths"], "task_id": task_id}
+                duplicate_index.record_result(task_id, "success", result["image_paths"])
+                if near_duplicate is not None:
+                    response["near_duplicate"] = near_duplicate
+                if "alternate_image_paths" in result:
+                    response["alternate_image_paths"] = result["alternate_image_paths"]
+                return attach_video_stage(response, request, task_id)
+            all_errors.append(f"通义并行推测: {result['error']}")
+            if result.get("error_kind") in errors.PROVIDER_FATAL:
+                excluded_providers["tongyi"] = result["error_kind"]
+            print(f"\n⚠️ 通义并行推测全部失败: {result['error']}")
+            # 已推测过的变体不再串行重试
+            first_attempt = result["attempts"]
+            event_attempt_offset = first_attempt - 1
+
+        deadline_hit = False
+        for attempt in range(first_attempt, max_attempts):
             # 检查任务是否被取消
             if is_task_cancelled(task_id):
                 print(f"🚫 任务 {task_id} 已被取消，停止处理")
                 with task_lock:
                     running_tasks.pop(task_id, None)
                 raise HTTPException(status_code=499, detail="任务已被取消")
+
+            # 排空时间已到：任务已写入checkpoint，由下一个进程继续
+            if drain_controller.expired.is_set():
+                drain_controller.checkpoint(task_id, request)
+                stopped_for_drain = True
+                print(f"💾 任务 {task_id} 在第{attempt + 1}次尝试前停止，等待下次启动恢复")
+                raise HTTPException(status_code=503, detail={"message": "服务器正在重启，任务将在重启后继续", "task_id": task_id, "resumable": True})
             
-            current_prompt = prompt_variants[attempt % len(prompt_variants)]
+            # 计划中的provider在任务执行期间额度耗尽、已判定不可用或需要避开时，改用当前排序最靠前的其他provider
+            provider = attempt_plan[attempt]
+            usable = [p for p in candidate_providers if p not in excluded_providers]
+            if not usable:
+                break
+            preferred = [p for p in usable if p not in avoided_providers and p != avoid_once]
+            if provider not in preferred or budget_tracker.state_of(provider) == "exhausted":
+                ranked = budget_tracker.rank(preferred, latency_target) or budget_tracker.rank(usable, latency_target)
+                if not ranked:
+                    all_errors.append("所有provider额度已用尽")
+                    break
+                if ranked[0] != provider:
+                    print(f"🔀 第{attempt + 1}次尝试由 {provider} 改用 {ranked[0]}")
+                provider = ranked[0]
+            avoid_once = None
+
+            # 剩余时间不够这个provider的预期耗时：换一个来得及的provider，都来不及就直接结束
+            # （第一次尝试总会执行，即使预期耗时超过截止时间）
+            remaining = deadline.remaining()
+            if attempt > 0 and budget_tracker.expected_latency(provider) > remaining:
+                fitting = [
+                    p for p in budget_tracker.rank(usable, remaining)
+                    if budget_tracker.expected_latency(p) <= remaining
+                ]
+                if not fitting:
+                    deadline_hit = True
+                    all_errors.append(f"剩余{remaining:.0f}秒不足以完成下一次尝试")
+                    break
+                print(f"⏱️ 剩余{remaining:.0f}秒，第{attempt + 1}次尝试由 {provider} 改用 {fitting[0]}")
+                provider = fitting[0]
+            call_timeout = deadline.clamp(PROVIDER_CALL_TIMEOUT_SECONDS)
+
+            # 按历史成功率和耗时为这个provider选一个本任务还没试过的变体
+            refresh_prompt_variants()
+            prompt_variant = choose_prompt_variants(provider, template_set, len(prompt_variants), tried_variants)[0]
+            # 优化结果可能在这次尝试期间到达并切换模板组，结果按选择时的模板组计入
+            variant_template_set = template_set
+            tried_variants.add(prompt_variant)
+            current_prompt = prompt_variants[prompt_variant]
             base_instruction = build_instruction(current_prompt)
-            
-            if attempt < 5:
-                # 前5次尝试用通义（保持原有逻辑）
-                result = attempt_ai_generation(dashscope_api_key, base_image_url, base_instruction, attempt + 1)
-                service_name = "通义"
-            elif attempt == 5:
-                # 第6次尝试用Gemini作为fallback
-                if gemini_api_key and GEMINI_AVAILABLE:
-                    result = attempt_gemini_generation(gemini_api_key, base_image_url, current_prompt, attempt + 1)
-                    service_name = "Gemini"
-                else:
-                    # 如果Gemini不可用，继续用通义
-                    result = attempt_ai_generation(dashscope_api_key, base_image_url, base_instruction, attempt + 1)
-                    service_name = "通义"
+            event_attempt = attempt + 1 - event_attempt_offset
+            job_event["attempt"] = event_attempt
+            attempt_started = time.time()
+            eta_estimator.attempt_started(task_id, provider, attempt + 1)
+
+            if provider == "gemini":
+                result = attempt_gemini_generation(gemini_api_key, image_urls["gemini"], current_prompt, attempt + 1, job_id=task_id, timeout=call_timeout)
+                service_name = "Gemini"
+            elif provider == "vidu":
+                result = attempt_vidu_generation(vidu_api_key, image_urls["vidu"], current_prompt, attempt + 1, job_id=task_id, timeout=call_timeout)
+                service_name = "Vidu"
             else:
-                # 第7次最后尝试用Vidu
-                if vidu_api_key:
-                    result = attempt_vidu_generation(vidu_api_key, base_image_url, current_prompt, attempt + 1)
-                    service_name = "Vidu"
-                else:
-                    # 如果Vidu不可用，继续用通义
-                    result = attempt_ai_generation(dashscope_api_key, base_image_url, base_instruction, attempt + 1)
-                    service_name = "通义"
+                result = attempt_ai_generation(dashscope_api_key, image_urls["tongyi"], base_instruction, attempt + 1, job_id=task_id, timeout=call_timeout)
+                service_name = "通义"
+            observe_prompt_variant(provider, variant_template_set, prompt_variant, result, time.time() - attempt_started)
             
             if result["success"]:
                 print(f"\n✅ {service_name}第{attempt + 1}次尝试成功！")
+                record_attempt_event(task_id, event_attempt, provider, prompt_variant, attempt_started, result)
+                job_event.update(status="success", provider=provider, prompt_variant=prompt_variant)
                 # 清理任务记录
                 with task_lock:
                     running_tasks.pop(task_id, None)
                 print(f"🏁 任务 {task_id} 完成")
-                return {"status": "success", "image_paths": result["image_paths"], "task_id": task_id}
+                duplicate_index.record_result(task_id, "success", result["image_paths"])
+                response = {"status": "success", "image_paths": result["image_paths"], "task_id": task_id}
+                if near_duplicate is not None:
+                    response["near_duplicate"] = near_duplicate
+                return attach_video_stage(response, request, task_id)
             else:
                 error_msg = result["error"]
+                error_kind = result.get("error_kind", errors.TRANSIENT)
                 all_errors.append(f"{service_name}第{attempt + 1}次: {error_msg}")
-                print(f"\n⚠️ {service_name}第{attempt + 1}次尝试失败: {error_msg}")
+                print(f"\n⚠️ {service_name}第{attempt + 1}次尝试失败（{error_kind}）: {error_msg}")
                 
+                if deadline.expired():
+                    record_attempt_event(task_id, event_attempt, provider, prompt_variant, attempt_started, result)
+                    deadline_hit = True
+                    break
+
+                # 只有临时故障值得等待后重试；其他类别立即换变体或换provider
+                retry_now = True
+                if error_kind in errors.PROVIDER_FATAL:
+                    excluded_providers[provider] = error_kind
+                    print(f"🚷 {service_name}本任务不再尝试（{error_kind}）")
+                elif error_kind == errors.POLICY_REJECTED:
+                    policy_rejections[provider] = policy_rejections.get(provider, 0) + 1
+                    if policy_rejections[provider] >= POLICY_REJECTIONS_PER_PROVIDER:
+                        avoided_providers.add(provider)
+                elif error_kind == errors.OUTPUT_INVALID:
+                    # 输出退化（空白、截断等）：换下一个变体立即重试
+                    pass
+                elif error_kind == errors.RATE_LIMITED and any(
+                    p != provider and p not in excluded_providers for p in candidate_providers
+                ):
+                    avoid_once = provider
+                else:
+                    retry_now = False
+
+                if all(p in excluded_providers for p in candidate_providers):
+                    record_attempt_event(task_id, event_attempt, provider, prompt_variant, attempt_started, result)
+                    break
+
                 # 在重试之间稍微等待，避免频繁请求
-                if attempt < max_attempts - 1:  # 最后一次不等待
-                    wait_time = min((attempt + 1) * 2, 10)  # 递增等待时间，最多10秒
-                    print(f"等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
+                sleep_ms = 0.0
+                if not retry_now and attempt < max_attempts - 1:  # 最后一次不等待
+                    wait_time = min((attempt + 1) * 2, 10, deadline.remaining())  # 递增等待时间，最多10秒，不超过截止时间
+                    print(f"等待 {wait_time:.0f} 秒后重试...")
+                    sleep_started = time.time()
+                    # 排空时间到了立即醒来，不再等满
+                    drain_controller.expired.wait(wait_time)
+                    sleep_ms = (time.time() - sleep_started) * 1000
+                    job_event["sleep_ms"] += sleep_ms
+                # 调用耗时不含重试等待
+                record_attempt_event(task_id, event_attempt, provider, prompt_variant, attempt_started, result, sleep_ms=sleep_ms)
         
-        # 所有尝试都失败了
-        print(f"\n❌ 所有 {max_attempts} 次尝试都失败了（通义5次 + Gemini1次 + Vidu1次）")
         error_summary = "; ".join(all_errors)
         
         # 清理任务记录
         with task_lock:
             running_tasks.pop(task_id, None)
         print(f"💀 任务 {task_id} 失败")
-        
+
+        if deadline_hit:
+            print(f"\n⏱️ 任务在{deadline.seconds:.0f}秒截止时间内未完成（已用{deadline.elapsed():.1f}秒）")
+            raise HTTPException(
+                status_code=504,
+                detail=f"AI生成未能在{deadline.seconds:.0f}秒内完成: {error_summary}"
+            )
+
+        # 所有provider都已判定不可用：原图有问题时重试也没用，直接告诉调用方
+        if all(p in excluded_providers for p in candidate_providers):
+            if errors.INPUT_INVALID in excluded_providers.values():
+                print(f"\n🚷 原图无法被任何provider使用，提前结束")
+                raise HTTPException(status_code=422, detail=f"原图无法使用: {error_summary}")
+            print(f"\n🚷 所有provider均不可用（{excluded_providers}），提前结束")
+            raise HTTPException(status_code=502, detail=f"所有provider均不可用: {error_summary}")
+
+        # 所有尝试都失败了
+        print(f"\n❌ 所有 {max_attempts} 次尝试都失败了（{' → '.join(attempt_plan)}）")
         raise HTTPException(
             status_code=500,
             detail=f"AI生成失败，已重试{max_attempts}次: {error_summary}"
         )
 
-    except HTTPException:
+    except HTTPException as e:
+        with task_lock:
+            running_tasks.pop(task_id, None)
+        duplicate_index.record_result(task_id, "failed")
+        fallback = local_fallback(task_id, preview, e.detail) if e.status_code in LOCAL_FALLBACK_STATUSES else None
+        if fallback is not None:
+            job_event.update(status="fallback", provider="local", http_status=e.status_code, error=str(e.detail)[:500])
+            return fallback
+        job_event.update(
+            status={499: "cancelled", 504: "deadline", 400: "rejected", 422: "input_invalid"}.get(e.status_code, "drained" if stopped_for_drain else "failed"),
+            http_status=e.status_code,
+            error=str(e.detail)[:500],
+        )
         raise  # 重新抛出HTTP异常
     except Exception as e:
         print(f"生成图片错误: {e}")
+        job_event.update(http_status=500, error=str(e)[:500])
+        duplicate_index.record_result(task_id, "failed")
         # 清理任务记录
         with task_lock:
             running_tasks.pop(task_id, None)
         print(f"💀 任务 {task_id} 异常失败")
         raise HTTPException(status_code=500, detail=f"生成失败: {str(e)}")
+    finally:
+        if not stopped_for_drain:
+            drain_controller.complete(task_id)
+        event_log.record(
+            "job",
+            job_id=task_id,
+            success=job_event["status"] in ("success", "reused", "mock"),
+            latency_ms=deadline.elapsed() * 1000,
+            **job_event,
+        )
+        eta_estimator.job_finished(task_id, job_event["status"] == "success")
+        tag_thread(None)
+        profiler.job_finished()
+
+@app.post("/batch/generate-images/")
+def batch_generate_images(request: dict):
+    """批量重新生成：有界并发执行，逐条以NDJSON流式返回结果，支持断点续跑
+
+    请求体: {"items": [{"id", "original_file" 或 "base_image_url", "prompt"}], "batch_id", "concurrency"}
+    使用同一个batch_id重新提交时，已成功的条目会被跳过。
+    """
+    if drain_controller.draining:
+        raise HTTPException(status_code=503, detail="服务器正在重启，请稍后重试")
+    items = request.get("items") or []
+    if not items:
+        raise HTTPException(status_code=400, detail="缺少items参数")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="items必须是数组")
+    for item in items:
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"条目必须是对象: {item!r}")
+        if not (item.get("original_file") or item.get("base_image_url")):
+            raise HTTPException(status_code=400, detail=f"条目缺少original_file或base_image_url: {item}")
+
+    concurrency = request_number(request, "concurrency", 4, int)
+    if concurrency < 1:
+        raise HTTPException(status_code=400, detail=f"concurrency必须大于0: {concurrency}")
+    concurrency = min(concurrency, BATCH_MAX_CONCURRENCY)
+
+    batch_id = request.get("batch_id")
+    if batch_id is not None and not isinstance(batch_id, str):
+        raise HTTPException(status_code=400, detail="batch_id必须是字符串")
+    if not batch_id:
+        # 未指定batch_id时由条目列表推导，重复提交同一批会自动续跑
+        keys = sorted(item_key(item) for item in items)
+        batch_id = hashlib.sha1("\n".join(keys).encode("utf-8")).hexdigest()[:12]
+    batch_id = os.path.basename(batch_id)
+
+    checkpoint = BatchCheckpoint(os.path.join(BATCH_CHECKPOINT_DIR, f"{batch_id}.jsonl"))
+    runner = BatchRunner(run_generation_job, checkpoint, concurrency=concurrency)
+    print(f"📦 批量任务 {batch_id}: {len(items)} 条, 并发 {concurrency}")
+
+    def stream():
+        yield json.dumps({"type": "start", "batch_id": batch_id, "total": len(items), "concurrency": concurrency}, ensure_ascii=False) + "\n"
+        for record in runner.run(items):
+            yield json.dumps({"type": "item", **record}, ensure_ascii=False) + "\n"
+        yield json.dumps({"type": "done", "batch_id": batch_id, **checkpoint.summary()}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/batch/{batch_id}")
+def get_batch_status(batch_id: str):
+    """查询批量任务的断点记录"""
+    path = os.path.join(BATCH_CHECKPOINT_DIR, f"{os.path.basename(batch_id)}.jsonl")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"批量任务 {batch_id} 不存在")
+    checkpoint = BatchCheckpoint(path)
+    return {"batch_id": batch_id, **checkpoint.summary(), "items": list(checkpoint.records.values())}
+
+STARTUP_IMPORT_SECONDS = round(time.perf_counter() - _import_started, 4)
+print(f"⚡ app.main 导入完成，耗时 {STARTUP_IMPORT_SECONDS:.3f}s")
@@ -0,0 +1,123 @@
+"""
+prompt变体顺序的多臂老虎机（Thompson采样）
+
+原来每个任务都按固定顺序尝试5个prompt变体；如果变体0被通义的内容审核拒绝得比变体2多，每个任务都要为此多试一次。
+这里为每个 (provider, 模板组, 变体序号) 维护成功率的Beta后验和成功调用耗时的EWMA（没有用户输入时的默认模板
+和基于用户输入的模板是两组不同的prompt，序号相同也不能共用统计），
+每次尝试时对本任务还没试过的变体各采样一个成功率p，选 p / 预期耗时 最大的一个——
+按这个比值降序依次尝试，正是期望"成功前总耗时"最小的顺序。采样带来的随机性保证冷门变体仍会被探索。
+
+状态保存在JSON文件中，重启后继续使用；成功+失败次数超过max_count时按比例缩小，让后验能跟上provider行为的变化。
+保存不在请求路径上逐次进行：每save_every次观测或每save_interval秒写一次，写文件时不持有统计锁。
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+EWMA_ALPHA = 0.2
+
+
+class VariantBandit:
+    def __init__(self, path: str, max_count: float = 500, save_every: int = 20, save_interval: float = 30):
+        self.path = path
+        self.max_count = max_count
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # 只串行化写文件，不阻塞choose/observe
+        self.arms = {}  # "provider:模板组:变体序号" -> {"successes", "failures", "latency", "pulls"}
+        self.choices = 0
+        self.unsaved = 0
+        self.saved_at = time.time()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                arms = json.load(f).get("arms", {})
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"⚠️ 读取prompt变体统计失败: {e}，重新开始学习")
+            return
+        # 旧格式（provider:变体序号）混合了两组模板的统计，丢弃
+        self.arms = {key: arm for key, arm in arms.items() if key.count(":") == 2}
+
+    def flush(self):
+        """把当前统计写入文件（定期调用，以及进程退出时）"""
+        with self.lock:
+            if not self.unsaved:
+                return
+            data = json.dumps({"updated_at": time.time(), "arms": self.arms}, ensure_ascii=False)
+            self.unsaved = 0
+            self.saved_at = time.time()
+        with self.save_lock:
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"⚠️ 保存prompt变体统计失败: {e}")
+
+    @staticmethod
+    def _key(provider: str, template_set: str, variant: int) -> str:
+        return f"{provider}:{template_set}:{variant}"
+
+    def _arm(self, provider: str, template_set: str, variant: int) -> dict:
+        return self.arms.setdefault(
+            self._key(provider, template_set, variant), {"successes": 0.0, "failures": 0.0, "latency": None, "pulls": 0}
+        )
+
+    def choose(self, provider: str, template_set: str, n_variants: int, exclude: set = None, k: int = 1) -> list[int]:
+        """为provider选出template_set组中的k个变体（按优先级），exclude是本任务已经试过的变体；全部试过后重新开始"""
+        candidates = [v for v in range(n_variants) if v not in (exclude or set())]
+        if len(candidates) < k:
+            candidates = list(range(n_variants))
+        with self.lock:
+            arms = {v: self.arms.get(self._key(provider, template_set, v)) for v in candidates}
+            known = [arm["latency"] for arm in arms.values() if arm and arm["latency"]]
+            # 没有耗时数据的变体按同一provider其他变体的平均耗时估计
+            default_latency = sum(known) / len(known) if known else 1.0
+            scores = {}
+            for variant, arm in arms.items():
+                successes = arm["successes"] if arm else 0.0
+                failures = arm["failures"] if arm else 0.0
+                latency = (arm["latency"] if arm else None) or default_latency
+                scores[variant] = random.betavariate(successes + 1, failures + 1) / max(latency, 0.1)
+            self.choices += 1
+        return sorted(candidates, key=lambda v: scores[v], reverse=True)[:k]
+
+    def observe(self, provider: str, template_set: str, variant: int, success: bool, latency: float = None):
+        """记录一次尝试结果；latency只在成功时计入"""
+        with self.lock:
+            arm = self._arm(provider, template_set, variant)
+            arm["pulls"] += 1
+            arm["successes" if success else "failures"] += 1
+            total = arm["successes"] + arm["failures"]
+            if total > self.max_count:
+                scale = self.max_count / total
+                arm["successes"] *= scale
+                arm["failures"] *= scale
+            if success and latency is not None:
+                arm["latency"] = latency if arm["latency"] is None else arm["latency"] + EWMA_ALPHA * (latency - arm["latency"])
+            self.unsaved += 1
+            due = self.unsaved >= self.save_every or time.time() - self.saved_at >= self.save_interval
+        if due:
+            self.flush()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            providers = {}
+            for key, arm in sorted(self.arms.items()):
+                provider, template_set, variant = key.split(":")
+                providers.setdefault(provider, {}).setdefault(template_set, {})[variant] = {
+                    "pulls": arm["pulls"],
+                    "success_rate": round((arm["successes"] + 1) / (arm["successes"] + arm["failures"] + 2), 3),
+                    "latency_seconds": None if arm["latency"] is None else round(arm["latency"], 2),
+                }
+            return {"choices": self.choices, "providers": providers}
@@ -0,0 +1,124 @@
+"""
+批量重新生成 - 有界并发调度 + 断点续跑
+
+用于故障恢复后把积压的 pending / failed 照片重新提交生成。
+每个条目完成后立即追加写入 checkpoint（JSONL），中断后用同一个 batch_id
+重新运行即可跳过已成功的条目。
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator
+
+
+def item_key(item: dict) -> str:
+    """条目在checkpoint中的唯一键：优先用id，其次是原图文件名或URL"""
+    return str(item.get("id") or item.get("original_file") or item.get("base_image_url"))
+
+
+class BatchCheckpoint:
+    """追加写入的JSONL断点文件，同一个key以最后一条记录为准"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 进程被杀时最后一行可能只写了一半
+                        continue
+                    self.records[record["key"]] = record
+
+    def is_done(self, key: str) -> bool:
+        record = self.records.get(key)
+        return bool(record) and record.get("status") == "success"
+
+    def record(self, record: dict):
+        with self.lock:
+            self.records[record["key"]] = record
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def summary(self) -> dict:
+        with self.lock:
+            statuses = [r.get("status") for r in self.records.values()]
+        return {
+            "success": statuses.count("success"),
+            "failed": statuses.count("failed"),
+        }
+
+
+class BatchRunner:
+    """以有界并发执行一批生成任务，按完成顺序逐条产出结果"""
+
+    def __init__(self, job_fn: Callable[[dict], dict], checkpoint: BatchCheckpoint, concurrency: int = 4):
+        self.job_fn = job_fn
+        self.checkpoint = checkpoint
+        self.concurrency = max(1, concurrency)
+
+    def _run_one(self, item: dict) -> dict:
+        key = item_key(item)
+        started = time.time()
+        try:
+            result = self.job_fn(item)
+            record = {
+                "key": key,
+                "status": "success",
+                "image_paths": result.get("image_paths", []),
+                "task_id": result.get("task_id"),
+            }
+        except Exception as e:
+            # HTTPException的detail比str(e)更有信息量
+            record = {"key": key, "status": "failed", "error": str(getattr(e, "detail", e))}
+        record["elapsed"] = round(time.time() - started, 2)
+        record["finished_at"] = time.time()
+        # 在工作线程里落盘：即使调用方中途断开，已完成的条目也不会丢
+        self.checkpoint.record(record)
+        return record
+
+    def run(self, items: Iterable[dict]) -> Iterator[dict]:
+        """执行整批任务；已在checkpoint中成功的条目直接以skipped产出"""
+        pending = []
+        seen = set()
+        for item in items:
+            key = item_key(item)
+            if key in seen:
+                continue
+            seen.add(key)
+            if self.checkpoint.is_done(key):
+                yield {**self.checkpoint.records[key], "status": "skipped"}
+            else:
+                pending.append(item)
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        try:
+            queue = iter(pending)
+            in_flight = set()
+            # 滑动窗口提交，避免几百个条目一次性堆进线程池
+            for item in queue:
+                in_flight.add(executor.submit(self._run_one, item))
+                if len(in_flight) >= self.concurrency:
+                    break
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_item = next(queue, None)
+                    if next_item is not None:
+                        in_flight.add(executor.submit(self._run_one, next_item))
+                    yield future.result()
+        finally:
+            # 调用方断开时不再提交新条目，已在执行的条目跑完后照常写入checkpoint
+            executor.shutdown(wait=False)
@@ -0,0 +1,241 @@
+"""
+provider费用与额度跟踪 + 按成本/延迟排序的调度策略
+
+每次调用按 (provider, 模型) 记账，写入按计费周期（天/月）滚动的JSONL账本，重启后从账本恢复本周期花费。
+每个provider可以配置周期预算；剩余额度不足以支撑 reserve_calls 次调用时提前降级，
+不足一次调用或provider报告额度耗尽时暂时停用，把流量提前切到其他provider，而不是等到一连串失败。
+
+调度时在满足延迟目标的provider中选"期望成本"（单价 / 成功率）最低的一个作为主provider。
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+# 费用统一以人民币计；Vidu按积分计费，用 ProviderBudget.unit_price 换算
+EWMA_ALPHA = 0.2
+
+
+class ProviderBudget:
+    def __init__(self, provider: str, budget: float = 0, model_costs: dict = None, unit_price: float = 1.0,
+                 expected_latency: float = 30.0, default_model: str = None):
+        self.provider = provider
+        self.budget = budget  # 每个计费周期的预算，0表示不限制
+        self.model_costs = dict(model_costs or {})  # 模型 -> 每次成功调用的估算费用
+        self.unit_price = unit_price  # provider返回用量（例如Vidu积分）时，每单位的费用
+        self.default_model = default_model or next(iter(self.model_costs), None)
+        self.latency = expected_latency  # 成功调用耗时的EWMA，初始为经验值
+        self.success_rate = 0.8  # 成功率的EWMA
+        self.calls = 0
+        self.failures = 0
+        self.spent = 0.0
+        self.spent_by_model = {}
+        self.exhausted_until = 0.0  # provider报告额度耗尽后暂停使用到这个时间
+
+    def cost_of(self, model: str = None) -> float:
+        return self.model_costs.get(model or self.default_model, 0.0)
+
+
+class BudgetTracker:
+    """按provider/模型记账，并据此给出provider的尝试顺序"""
+
+    def __init__(self, providers: list[ProviderBudget], ledger_dir: str, period: str = "day",
+                 reserve_calls: int = 20, exhausted_cooldown: float = 600):
+        self.providers = {p.provider: p for p in providers}
+        self.ledger_dir = ledger_dir
+        self.period = period
+        self.reserve_calls = reserve_calls
+        self.exhausted_cooldown = exhausted_cooldown
+        self.lock = threading.Lock()
+        self.period_key = self._period_key()
+        os.makedirs(ledger_dir, exist_ok=True)
+        self._load_ledger()
+
+    # ---------- 账本 ----------
+
+    def _period_key(self) -> str:
+        return time.strftime("%Y-%m" if self.period == "month" else "%Y-%m-%d")
+
+    def _ledger_path(self) -> str:
+        return os.path.join(self.ledger_dir, f"ledger-{self.period_key}.jsonl")
+
+    def _load_ledger(self):
+        path = self._ledger_path()
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                state = self.providers.get(entry.get("provider"))
+                if state is not None:
+                    self._add_spend(state, entry["model"], entry["cost"])
+
+    def _add_spend(self, state: ProviderBudget, model: str, cost: float):
+        state.spent += cost
+        state.spent_by_model[model] = state.spent_by_model.get(model, 0.0) + cost
+
+    def _roll_period(self):
+        """进入新的计费周期时清零花费（调用方持有锁）"""
+        key = self._period_key()
+        if key == self.period_key:
+            return
+        self.period_key = key
+        for state in self.providers.values():
+            state.spent = 0.0
+            state.spent_by_model = {}
+            state.exhausted_until = 0.0
+
+    # ---------- 记账 ----------
+
+    def charge(self, provider: str, model: str, units: float = None, job_id: str = None) -> float:
+        """记录一次计费调用；provider返回了实际用量时按用量计费，否则按模型单价估算"""
+        state = self.providers.get(provider)
+        if state is None:
+            return 0.0
+        cost = units * state.unit_price if units is not None else state.cost_of(model)
+        entry = {"ts": time.time(), "provider": provider, "model": model, "units": units, "cost": cost, "job_id": job_id}
+        with self.lock:
+            self._roll_period()
+            self._add_spend(state, model, cost)
+            with open(self._ledger_path(), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return cost
+
+    def observe(self, provider: str, elapsed: float, success: bool, quota_exhausted: bool = False,
+                latency_sample: bool = True):
+        """更新延迟与成功率估计；latency_sample为False时不计入延迟（例如异步任务只是提交成功）；
+        quota_exhausted表示provider明确报告额度/余额不足"""
+        state = self.providers.get(provider)
+        if state is None:
+            return
+        with self.lock:
+            state.calls += 1
+            state.success_rate += EWMA_ALPHA * ((1.0 if success else 0.0) - state.success_rate)
+            if latency_sample:
+                state.latency += EWMA_ALPHA * (elapsed - state.latency)
+            if not success:
+                state.failures += 1
+            if quota_exhausted:
+                state.exhausted_until = time.time() + self.exhausted_cooldown
+                print(f"💸 {provider} 额度耗尽，{self.exhausted_cooldown:.0f}秒内不再调度")
+
+    def metered(self, provider: str, model: str):
+        """装饰provider尝试函数：按返回的结果字典记账并更新延迟/成功率估计"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.time()
+                result = fn(*args, **kwargs)
+                if result.get("success"):
+                    self.charge(provider, model, units=result.get("credits"), job_id=kwargs.get("job_id"))
+                self.observe(
+                    provider, time.time() - started, bool(result.get("success")),
+                    quota_exhausted=bool(result.get("quota_exhausted")),
+                    # 超时的调用也计入延迟，否则慢的provider看起来会越来越快
+                    latency_sample=not result.get("async") and bool(result.get("success") or result.get("timed_out")),
+                )
+                return result
+            return wrapper
+        return decorator
+
+    # ---------- 调度 ----------
+
+    def expected_latency(self, provider: str) -> float:
+        state = self.providers.get(provider)
+        return state.latency if state is not None else 0.0
+
+    def success_rate(self, provider: str) -> float:
+        state = self.providers.get(provider)
+        return state.success_rate if state is not None else 1.0
+
+    def remaining(self, provider: str) -> float:
+        """本周期剩余预算，不限制时返回None"""
+        state = self.providers[provider]
+        return None if not state.budget else max(0.0, state.budget - state.spent)
+
+    def state_of(self, provider: str) -> str:
+        """ok / low（剩余额度接近耗尽，降低优先级）/ exhausted（暂不调度）"""
+        state = self.providers.get(provider)
+        if state is None:
+            return "ok"
+        if state.exhausted_until > time.time():
+            return "exhausted"
+        remaining = self.remaining(provider)
+        if remaining is None:
+            return "ok"
+        cost = state.cost_of()
+        if remaining < cost or remaining <= 0:
+            return "exhausted"
+        if remaining < cost * self.reserve_calls:
+            return "low"
+        return "ok"
+
+    def rank(self, candidates: list[str], latency_target: float) -> list[str]:
+        """可用provider按优先级排序：额度充足优先，其次满足延迟目标，再按期望成本"""
+        with self.lock:
+            self._roll_period()
+
+        def key(provider: str):
+            state = self.providers.get(provider)
+            if state is None:
+                return (1, 1, 0.0, 0.0)
+            expected_cost = state.cost_of() / max(state.success_rate, 0.1)
+            return (
+                self.state_of(provider) == "low",
+                state.latency > latency_target,
+                expected_cost,
+                state.latency,
+            )
+
+        usable = [p for p in candidates if self.state_of(p) != "exhausted"]
+        return sorted(usable, key=key)
+
+    def plan(self, candidates: list[str], attempts: int, latency_target: float, primary_attempts: int = 5) -> list[str]:
+        """为一个任务规划每次尝试使用的provider：主provider尝试primary_attempts次，其余各一次，剩余次数回到主provider"""
+        ranked = self.rank(candidates, latency_target)
+        if not ranked:
+            return []
+        plan = [ranked[0]] * min(primary_attempts, attempts)
+        for provider in ranked[1:]:
+            if len(plan) < attempts:
+                plan.append(provider)
+        while len(plan) < attempts:
+            plan.append(ranked[0])
+        return plan
+
+    def snapshot(self, candidates: list[str] = None, latency_target: float = None) -> dict:
+        with self.lock:
+            self._roll_period()
+            period = self.period_key
+        providers = {}
+        for name, state in self.providers.items():
+            remaining = self.remaining(name)
+            providers[name] = {
+                "state": self.state_of(name),
+                "budget": state.budget or None,
+                "spent": round(state.spent, 4),
+                "remaining": None if remaining is None else round(remaining, 4),
+                "spent_by_model": {model: round(cost, 4) for model, cost in state.spent_by_model.items()},
+                "unit_cost": state.cost_of(),
+                "expected_latency_seconds": round(state.latency, 2),
+                "success_rate": round(state.success_rate, 3),
+                "calls": state.calls,
+                "failures": state.failures,
+                "exhausted_until": state.exhausted_until or None,
+            }
+        snapshot = {
+            "period": self.period,
+            "period_key": period,
+            "currency": "CNY",
+            "total_spent": round(sum(state.spent for state in self.providers.values()), 4),
+            "providers": providers,
+        }
+        if candidates is not None and latency_target is not None:
+            snapshot["latency_target_seconds"] = latency_target
+            snapshot["provider_order"] = self.rank(candidates, latency_target)
+        return snapshot
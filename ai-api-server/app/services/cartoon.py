@@ -0,0 +1,156 @@
+"""
+本地卡通化（纯CPU，NumPy + PIL）
+
+AI生成通常要十几秒，全部provider失败时用户什么都拿不到，没配置DASHSCOPE_API_KEY时只能返回一张纯色图。
+这里用经典的卡通滤镜在本地生成一张风格化预览：
+
+1. 保边平滑：在半分辨率上做几轮双边滤波（5×5邻域，按空间距离和颜色差加权），抹平皮肤和背景的纹理但保留轮廓
+2. 颜色量化：在采样像素上做几轮k-means得到调色板，每个像素映射到最近的颜色，形成色块
+3. 描边：在亮度图上求Sobel梯度，梯度最大的一部分像素压暗，叠加成线条
+
+全部是整幅数组的向量化运算，没有逐像素的Python循环；在原图预处理的进程池中执行，768像素的图不到半秒。
+预览在任务开始时生成，AI还在生成时就可以展示；所有provider都失败时它就是最终结果。
+"""
+
+import os
+import threading
+import time
+from io import BytesIO
+
+from app.services.clients.lazy import is_available
+from app.services.imaging import submit
+
+LOCAL_CARTOON = os.getenv("LOCAL_CARTOON", "1") == "1" and is_available("numpy")
+CARTOON_MAX_SIDE = int(os.getenv("LOCAL_CARTOON_MAX_SIDE", "768"))
+CARTOON_COLORS = int(os.getenv("LOCAL_CARTOON_COLORS", "10"))
+SMOOTH_PASSES = 3
+SMOOTH_RADIUS = 2
+SIGMA_SPACE = 2.0
+SIGMA_COLOR = 0.12  # 颜色差（0~1）超过约2倍sigma的邻居几乎不参与平均，边缘因此保留
+EDGE_FRACTION = 0.08  # 梯度最大的8%像素描成线条
+EDGE_DARKNESS = 0.75
+JPEG_QUALITY = 88
+
+stats = {"rendered": 0, "errors": 0, "render_ms_total": 0.0, "max_render_ms": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _bilateral(image, radius: int, sigma_space: float, sigma_color: float):
+    """向量化双边滤波：对每个邻域偏移整体平移一次数组，累加权重"""
+    import numpy as np
+
+    height, width, _ = image.shape
+    padded = np.pad(image, ((radius, radius), (radius, radius), (0, 0)), mode="edge")
+    total = np.zeros_like(image)
+    weights = np.zeros((height, width, 1), dtype=image.dtype)
+    color_scale = -0.5 / sigma_color ** 2
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            shifted = padded[radius + dy:radius + dy + height, radius + dx:radius + dx + width]
+            difference = shifted - image
+            weight = np.exp(np.einsum("ijk,ijk->ij", difference, difference)[..., None] * color_scale
+                            - (dy * dy + dx * dx) / (2 * sigma_space ** 2))
+            total += weight * shifted
+            weights += weight
+    return total / weights
+
+
+def _palette(image, colors: int, iterations: int = 8, samples: int = 4096):
+    """在随机采样的像素上做k-means，返回 colors×3 的调色板"""
+    import numpy as np
+
+    pixels = image.reshape(-1, 3)
+    rng = np.random.default_rng(0)
+    sample = pixels[rng.choice(len(pixels), size=min(samples, len(pixels)), replace=False)]
+    # 按亮度分位数初始化，结果稳定，不依赖随机种子
+    order = np.argsort(sample @ np.array([0.299, 0.587, 0.114], dtype=sample.dtype))
+    centers = sample[order[np.linspace(0, len(order) - 1, colors).astype(int)]].copy()
+    for _ in range(iterations):
+        labels = _nearest(sample, centers)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=colors)[:, None]
+        centers = np.where(counts > 0, sums / np.maximum(counts, 1), centers)
+    return centers
+
+
+def _nearest(pixels, centers):
+    # |p - c|² = |p|² - 2p·c + |c|²，|p|²对所有中心相同可以省略
+    return ((centers ** 2).sum(axis=1) - 2 * pixels @ centers.T).argmin(axis=1)
+
+
+def _edges(image, fraction: float):
+    """亮度图的Sobel梯度，返回0~1的线条强度"""
+    import numpy as np
+
+    luma = image @ np.array([0.299, 0.587, 0.114], dtype=image.dtype)
+    p = np.pad(luma, 1, mode="edge")
+    gx = (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])
+    gy = (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])
+    magnitude = np.hypot(gx, gy)
+    threshold = np.quantile(magnitude, 1 - fraction)
+    # 阈值附近柔和过渡，避免锯齿
+    return np.clip((magnitude - threshold * 0.7) / (threshold * 0.6 + 1e-6), 0, 1)
+
+
+def cartoonize(content: bytes, max_side: int = CARTOON_MAX_SIDE, colors: int = CARTOON_COLORS) -> bytes:
+    """把原图转换成卡通风格的JPEG（在子进程中执行）"""
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(content))
+    # JPEG直接按缩小的尺寸解码，大图解码快很多
+    image.draft("RGB", (max_side, max_side))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_side, max_side), Image.BILINEAR)
+    width, height = image.size
+
+    # 平滑在半分辨率上进行，再放大回来；放大本身也带来一点柔化
+    small = image.resize((max(1, width // 2), max(1, height // 2)), Image.BILINEAR)
+    smooth = np.asarray(small, dtype=np.float32) / 255
+    for _ in range(SMOOTH_PASSES):
+        smooth = _bilateral(smooth, SMOOTH_RADIUS, SIGMA_SPACE, SIGMA_COLOR)
+    smooth_image = Image.fromarray((smooth * 255).astype(np.uint8)).resize((width, height), Image.BILINEAR)
+    smooth = np.asarray(smooth_image, dtype=np.float32) / 255
+
+    palette = _palette(smooth, colors)
+    quantized = palette[_nearest(smooth.reshape(-1, 3), palette)].reshape(height, width, 3)
+
+    edges = _edges(smooth, EDGE_FRACTION)
+    result = quantized * (1 - EDGE_DARKNESS * edges[..., None])
+
+    output = BytesIO()
+    Image.fromarray((np.clip(result, 0, 1) * 255).astype(np.uint8)).save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue()
+
+
+def submit_cartoon(content: bytes):
+    """在图片处理进程池中生成卡通预览，返回Future（结果为JPEG字节）"""
+    started = time.perf_counter()
+    future = submit(cartoonize, content)
+
+    def done(f):
+        elapsed = (time.perf_counter() - started) * 1000
+        with _stats_lock:
+            if f.cancelled() or f.exception() is not None:
+                stats["errors"] += 1
+                return
+            stats["rendered"] += 1
+            stats["render_ms_total"] += elapsed
+            stats["max_render_ms"] = max(stats["max_render_ms"], elapsed)
+
+    future.add_done_callback(done)
+    return future
+
+
+def cartoon_snapshot() -> dict:
+    with _stats_lock:
+        rendered = stats["rendered"]
+        return {
+            "enabled": LOCAL_CARTOON,
+            "max_side": CARTOON_MAX_SIDE,
+            "rendered": rendered,
+            "errors": stats["errors"],
+            "avg_render_ms": round(stats["render_ms_total"] / rendered, 1) if rendered else None,
+            "max_render_ms": round(stats["max_render_ms"], 1),
+        }
@@ -0,0 +1,254 @@
+"""
+DashScope异步任务引擎
+
+万相图像编辑和图生视频都是异步任务：async_call提交后需要轮询直到完成。
+SDK自带的wait()会让每个任务独占一个线程直到渲染结束；这里改为单个轮询线程同时跟踪所有任务，
+每个任务按自适应间隔查询（刚提交时查得勤，跑得越久查得越疏），
+完成后在下载线程池中把结果流式写入磁盘，再通过回调通知调用方。
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable
+
+from app.services.clients.lazy import LazyModule
+
+dashscope = LazyModule("dashscope")
+requests = LazyModule("requests")
+
+FINAL_STATUSES = {"SUCCEEDED", "FAILED", "CANCELED", "UNKNOWN"}
+
+
+class DashScopeTaskError(Exception):
+    """DashScope任务提交或执行失败"""
+
+
+class DashScopeTask:
+    def __init__(self, task_id: str, kind: str, api_key: str, callback: Callable = None, job_id: str = None):
+        self.task_id = task_id
+        self.kind = kind  # "image" 或 "video"
+        self.api_key = api_key
+        self.callback = callback
+        self.job_id = job_id
+        self.status = "PENDING"
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.polls = 0
+        self.next_poll_at = self.submitted_at
+        self.result_urls = []  # provider返回的远程URL
+        self.result_paths = []  # 写入本地后的路径
+        self.error = None
+        self.future = Future()
+
+    def to_dict(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "kind": self.kind,
+            "job_id": self.job_id,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+            "polls": self.polls,
+            "result_paths": self.result_paths,
+            "error": self.error,
+        }
+
+
+class DashScopeTaskEngine:
+    """单线程轮询、多任务复用的DashScope异步任务引擎"""
+
+    def __init__(self, stores: dict, min_interval: float = 1.0, max_interval: float = 10.0, backoff: float = 1.5,
+                 task_timeout: float = 900, download_workers: int = 4, history_size: int = 1000):
+        self.stores = stores  # {"image": ShardedStore, "video": ShardedStore}，结果写入的位置
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.task_timeout = task_timeout
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.active = {}  # task_id -> DashScopeTask
+        self.history = OrderedDict()  # 已结束的任务，保留最近history_size个
+        self.downloader = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="dashscope-download")
+        self._thread = None
+        self._stopped = False
+
+    # ---------- 提交 ----------
+
+    def submit_image_edit(self, prompt: str, base_image_url: str, api_key: str, n: int = 1,
+                          function: str = "stylization_all", callback: Callable = None, job_id: str = None) -> DashScopeTask:
+        rsp = dashscope.ImageSynthesis.async_call(
+            api_key=api_key,
+            model="wanx2.1-imageedit",
+            function=function,
+            prompt=prompt,
+            base_image_url=base_image_url,
+            n=n,
+        )
+        return self._register(rsp, "image", api_key, callback, job_id)
+
+    def submit_video(self, prompt: str, img_url: str, api_key: str, model: str = "wan2.2-i2v-flash",
+                     resolution: str = "480P", callback: Callable = None, job_id: str = None) -> DashScopeTask:
+        rsp = dashscope.VideoSynthesis.async_call(
+            api_key=api_key,
+            model=model,
+            prompt=prompt,
+            resolution=resolution,
+            img_url=img_url,
+        )
+        return self._register(rsp, "video", api_key, callback, job_id)
+
+    def _register(self, rsp, kind: str, api_key: str, callback: Callable, job_id: str) -> DashScopeTask:
+        if rsp.status_code != HTTPStatus.OK:
+            raise DashScopeTaskError(
+                f"提交失败, status_code: {rsp.status_code}, code: {rsp.code}, message: {rsp.message}"
+            )
+        task = DashScopeTask(rsp.output.task_id, kind, api_key, callback, job_id)
+        with self.lock:
+            self.active[task.task_id] = task
+            self.wakeup.notify()
+        self._ensure_started()
+        print(f"📨 DashScope {kind}任务已提交: {task.task_id}（在途 {len(self.active)} 个）")
+        return task
+
+    # ---------- 查询 ----------
+
+    def get(self, task_id: str) -> DashScopeTask:
+        with self.lock:
+            return self.active.get(task_id) or self.history.get(task_id)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            downloading = sum(1 for task in self.history.values() if task.status == "DOWNLOADING")
+            return {
+                "active": len(self.active),
+                "downloading": downloading,
+                "finished": len(self.history) - downloading,
+                "by_kind": {
+                    kind: sum(1 for task in self.active.values() if task.kind == kind)
+                    for kind in ("image", "video")
+                },
+            }
+
+    # ---------- 轮询 ----------
+
+    def _ensure_started(self):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._poll_loop, name="dashscope-poller", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self.lock:
+            self._stopped = True
+            self.wakeup.notify()
+
+    def _interval_for(self, task: DashScopeTask) -> float:
+        return min(self.max_interval, self.min_interval * (self.backoff ** task.polls))
+
+    def _poll_loop(self):
+        while True:
+            with self.lock:
+                while not self._stopped and not self.active:
+                    self.wakeup.wait()
+                if self._stopped:
+                    return
+                now = time.time()
+                due = [task for task in self.active.values() if task.next_poll_at <= now]
+                if not due:
+                    next_at = min(task.next_poll_at for task in self.active.values())
+                    self.wakeup.wait(timeout=max(0.0, next_at - now))
+                    continue
+
+            for task in due:
+                self._poll_one(task)
+
+    def _poll_one(self, task: DashScopeTask):
+        api = dashscope.ImageSynthesis if task.kind == "image" else dashscope.VideoSynthesis
+        try:
+            status = api.fetch(task.task_id, api_key=task.api_key)
+        except Exception as e:
+            # 网络抖动：按当前间隔稍后重试
+            print(f"⚠️ 查询DashScope任务 {task.task_id} 失败: {e}")
+            status = None
+
+        if status is not None and status.status_code != HTTPStatus.OK:
+            # 限流、查询接口的5xx等：任务本身还在provider上运行，和网络异常一样稍后再查
+            print(f"⚠️ 查询DashScope任务 {task.task_id} 失败, status_code: {status.status_code}, "
+                  f"code: {status.code}, message: {status.message}")
+            status = None
+
+        task.polls += 1
+        task.next_poll_at = time.time() + self._interval_for(task)
+        if status is not None:
+            task.status = status.output.task_status
+        if status is None or task.status not in FINAL_STATUSES:
+            if time.time() - task.submitted_at > self.task_timeout:
+                self._finish(task, "FAILED", f"任务超过{self.task_timeout:.0f}秒仍未完成")
+            return
+
+        if task.status == "SUCCEEDED":
+            if task.kind == "image":
+                task.result_urls = [result.url for result in status.output.results if getattr(result, "url", None)]
+            else:
+                task.result_urls = [status.output.video_url]
+            # 下载期间不再轮询，但仍能通过get()查到（状态为DOWNLOADING），直到_finish写入最终状态
+            task.status = "DOWNLOADING"
+            with self.lock:
+                self.active.pop(task.task_id, None)
+                self._remember(task)
+            self.downloader.submit(self._download, task)
+        else:
+            message = getattr(status.output, "message", None) or getattr(status, "message", "")
+            self._finish(task, task.status, f"任务{task.status}: {message}")
+
+    def _download(self, task: DashScopeTask):
+        extension = "png" if task.kind == "image" else "mp4"
+        prefix = "wanx" if task.kind == "image" else "video"
+        try:
+            for url in task.result_urls:
+                file_name = f"{prefix}_{uuid.uuid4()}.{extension}"
+                with requests.get(url, stream=True, timeout=(10, 120)) as response:
+                    response.raise_for_status()
+                    path = self.stores[task.kind].save_stream(
+                        file_name, response.iter_content(chunk_size=256 * 1024),
+                        job_id=task.job_id, provider=f"dashscope-{task.kind}",
+                    )
+                task.result_paths.append(path)
+            self._finish(task, "SUCCEEDED")
+        except Exception as e:
+            self._finish(task, "FAILED", f"下载结果失败: {e}")
+
+    def _remember(self, task: DashScopeTask):
+        # 调用方持有锁
+        self.history[task.task_id] = task
+        self.history.move_to_end(task.task_id)
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+
+    def _finish(self, task: DashScopeTask, status: str, error: str = None):
+        task.status = status
+        task.error = error
+        task.finished_at = time.time()
+        with self.lock:
+            self.active.pop(task.task_id, None)
+            self._remember(task)
+
+        elapsed = task.finished_at - task.submitted_at
+        if error:
+            print(f"❌ DashScope {task.kind}任务 {task.task_id} 失败（{elapsed:.1f}s）: {error}")
+            task.future.set_exception(DashScopeTaskError(error))
+        else:
+            print(f"✅ DashScope {task.kind}任务 {task.task_id} 完成（{elapsed:.1f}s, 轮询{task.polls}次）: {task.result_paths}")
+            task.future.set_result(task)
+
+        if task.callback is not None:
+            try:
+                task.callback(task)
+            except Exception as e:
+                print(f"⚠️ DashScope任务回调异常: {e}")
@@ -0,0 +1,72 @@
+"""
+provider SDK的延迟加载
+
+dashscope、google-genai等SDK导入耗时数百毫秒。这里用代理对象包装模块，
+第一次访问属性时才真正导入，并记录每个模块的加载耗时；
+服务启动后可以在后台线程中预热，避免首个请求承担导入开销。
+"""
+
+import importlib
+import importlib.util
+import sys
+import threading
+import time
+
+_lock = threading.Lock()
+load_timings = {}  # 模块名 -> 加载耗时（秒）
+
+
+def load(name: str):
+    """导入模块并记录耗时，重复调用直接返回已加载的模块"""
+    if name in load_timings:
+        return sys.modules[name]
+    with _lock:
+        if name in load_timings:
+            return sys.modules[name]
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        load_timings[name] = round(time.perf_counter() - started, 4)
+        return module
+
+
+def is_available(name: str) -> bool:
+    """不导入模块本身，只检查是否已安装"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+class LazyModule:
+    """模块代理，第一次访问属性时才导入"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = load(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+def prewarm(names: list[str], delay: float = 0.0) -> threading.Thread:
+    """在后台线程中依次加载模块，失败只打印不抛出"""
+    def run():
+        if delay:
+            time.sleep(delay)
+        started = time.perf_counter()
+        for name in names:
+            try:
+                load(name)
+            except Exception as e:
+                print(f"⚠️ 预热 {name} 失败: {e}")
+        print(f"🔥 SDK预热完成，耗时 {time.perf_counter() - started:.2f}s: {load_timings}")
+
+    thread = threading.Thread(target=run, name="sdk-prewarm", daemon=True)
+    thread.start()
+    return thread
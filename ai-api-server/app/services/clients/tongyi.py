@@ -1,72 +1,33 @@
 import os
-from http import HTTPStatus
-from dashscope import ImageSynthesis, MultiModalConversation, VideoSynthesis
-from dashscope.api_entities.dashscope_response import ImageSynthesisResponse, VideoSynthesisResponse
+from dashscope import MultiModalConversation
+from dashscope.api_entities.dashscope_response import ImageSynthesisResponse
 import requests
 import pathlib
 import json
 import uuid
 
+from app.services.clients.dashscope_tasks import DashScopeTask, DashScopeTaskEngine
 
 
-def call_tongyi_wanxiang(prompt: str, base_image_url: str = None, n: int = 1, api_key: str = None) -> ImageSynthesisResponse:
+def call_tongyi_wanxiang(engine: DashScopeTaskEngine, prompt: str, base_image_url: str = None, n: int = 1,
+                         api_key: str = None, timeout: float = None) -> DashScopeTask:
     """
     Calls the Tongyi Wanxiang image synthesis API.
+
+    任务交给调用方传入的异步任务引擎（main.dashscope_engine）轮询，结果写入引擎的存储；
+    这里只等待结果，失败时抛出DashScopeTaskError。
     """
     if api_key is None:
         api_key = os.getenv("DASHSCOPE_API_KEY")
         if api_key is None:
             raise ValueError("DASHSCOPE_API_KEY environment variable not set.")
 
-    # Determine the function and model based on whether a base_image_url is provided
-    if base_image_url:
-        model = "wanx2.1-imageedit"
-        function = "stylization_all" # Or another appropriate function
-    else:
+    if not base_image_url:
         raise ValueError("Base image URL is required for this model.")
 
-    # Build the parameters
-    call_params = {
-        "api_key": api_key,
-        "model": model,
-        "prompt": prompt,
-        "n": n,
-    }
-    if base_image_url:
-        call_params["base_image_url"] = base_image_url
-    if function:
-        call_params["function"] = function
-
-    # Asynchronous call
-    rsp = ImageSynthesis.async_call(**call_params)
-
-    print(rsp)
-    if rsp.status_code == HTTPStatus.OK:
-        print("task_id: %s" % rsp.output.task_id)
-    else:
-        raise SystemExit('Failed, status_code: %s, code: %s, message: %s' %
-              (rsp.status_code, rsp.code, rsp.message))
-
-    status = ImageSynthesis.fetch(rsp, api_key=api_key)
-    if status.status_code == HTTPStatus.OK:
-        print(status.output.task_status)
-    else:
-        raise SystemExit('Failed, status_code: %s, code: %s, message: %s' %
-              (status.status_code, status.code, status.message))
-
-    rsp = ImageSynthesis.wait(rsp, api_key=api_key)
-    
-    print(rsp)
-    if rsp.status_code == HTTPStatus.OK:
-        print(rsp.output)
-        for result in rsp.output.results:
-            print("---------------------------")
-            print(result.url)
-    else:
-        raise SystemExit('Failed, status_code: %s, code: %s, message: %s' %
-              (rsp.status_code, rsp.code, rsp.message))
-        
-    return rsp
+    task = engine.submit_image_edit(prompt, base_image_url, api_key, n=n, function="stylization_all")
+    print("task_id: %s" % task.task_id)
+    return task.future.result(timeout=timeout)
 
 def call_tongyi_qianwen_image_edit(prompt: str, base_image_url: str = None, n: int = 1, api_key: str = None) -> ImageSynthesisResponse:
     if api_key is None:
@@ -184,38 +145,14 @@ def call_tongyi_qianwen_image_edit(prompt: str, base_image_url: str = None, n: i
         print("请参考文档：https://help.aliyun.com/zh/model-studio/developer-reference/error-code")
         raise Exception(f"HTTP返回码：{response.status_code}")
     
-def call_tongyi_wanxiang_video_flash(prompt: str, base_image_url: str = None, n: int = 1, api_key: str = None) -> VideoSynthesisResponse:
+def call_tongyi_wanxiang_video_flash(engine: DashScopeTaskEngine, prompt: str, base_image_url: str = None, n: int = 1,
+                                     api_key: str = None, timeout: float = None) -> DashScopeTask:
+    """图生视频：任务交给调用方传入的异步任务引擎轮询，完成后MP4已写入引擎的视频存储；失败时抛出DashScopeTaskError"""
     if api_key is None:
         api_key = os.getenv("DASHSCOPE_API_KEY")
         if api_key is None:
             raise ValueError("DASHSCOPE_API_KEY environment variable not set.")
 
-    rsp = VideoSynthesis.async_call(api_key=api_key,
-                                    model='wan2.2-i2v-flash',
-                                    prompt=prompt,
-                                    resolution="480P",
-                                    img_url=base_image_url)
-
-    print(rsp)
-    if rsp.status_code == HTTPStatus.OK:
-        print("task_id: %s" % rsp.output.task_id)
-    else:
-        raise Exception('Failed, status_code: %s, code: %s, message: %s' %
-              (rsp.status_code, rsp.code, rsp.message))
-
-    status = VideoSynthesis.fetch(rsp, api_key=api_key)
-    if status.status_code == HTTPStatus.OK:
-        print(status.output.task_status)
-    else:
-        raise Exception('Failed, status_code: %s, code: %s, message: %s' %
-              (status.status_code, status.code, status.message))
-
-    rsp = VideoSynthesis.wait(rsp, api_key=api_key)
-    print(rsp)
-    if rsp.status_code == HTTPStatus.OK:
-        print(rsp.output.video_url)
-    else:
-        raise Exception('Failed, status_code: %s, code: %s, message: %s' %
-              (rsp.status_code, rsp.code, rsp.message))
-    
-    return rsp
\ No newline at end of file
+    task = engine.submit_video(prompt, base_image_url, api_key, model='wan2.2-i2v-flash', resolution="480P")
+    print("task_id: %s" % task.task_id)
+    return task.future.result(timeout=timeout)
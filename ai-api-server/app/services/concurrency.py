@@ -0,0 +1,243 @@
+"""
+按provider划分的并发预算
+
+每个provider同时在途的调用数不超过各自的上限；上限可以在运行时调整。
+等待名额的调用按到达顺序排队（先到先得），并记录属于哪个任务，用于向客户端报告排队位置。
+开启自适应时由ConcurrencyController根据调用耗时和错误率自动调整上限。
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class ProviderLimiter:
+    """每个provider一个计数器，用Condition实现可动态调整上限的信号量"""
+
+    def __init__(self, limits: dict[str, int]):
+        self.limits = dict(limits)
+        self.in_flight = {provider: 0 for provider in limits}
+        self.waiters = {provider: deque() for provider in limits}  # 排队中的 [owner]，队首先获得名额
+        self.abandoned = {provider: 0 for provider in limits}  # 调用方已超时放弃、但底层调用仍在运行的名额
+        self.cond = threading.Condition()
+
+    def acquire(self, provider: str, timeout: float = None, owner: str = None) -> bool:
+        """阻塞获取一个名额，超时返回False；未配置上限的provider不受限制。owner为等待者所属的任务ID"""
+        with self.cond:
+            if provider not in self.limits:
+                return True
+            # 用列表包一层，同一任务的多个等待者也能区分
+            ticket = [owner]
+            queue = self.waiters[provider]
+            queue.append(ticket)
+            ok = self.cond.wait_for(
+                lambda: queue[0] is ticket and self.in_flight[provider] < self.limits[provider], timeout
+            )
+            queue.remove(ticket)
+            if ok:
+                self.in_flight[provider] += 1
+            # 队首变了，唤醒下一个等待者
+            self.cond.notify_all()
+            return ok
+
+    def try_acquire(self, provider: str, n: int) -> int:
+        """非阻塞地尽量获取n个名额，返回实际获得的数量"""
+        with self.cond:
+            if provider not in self.limits:
+                return n
+            # 有任务在排队时不插队
+            if self.waiters[provider]:
+                return 0
+            granted = max(0, min(n, self.limits[provider] - self.in_flight[provider]))
+            self.in_flight[provider] += granted
+            return granted
+
+    def release(self, provider: str, n: int = 1):
+        with self.cond:
+            if provider not in self.limits:
+                return
+            self.in_flight[provider] = max(0, self.in_flight[provider] - n)
+            self.cond.notify_all()
+
+    def release_when_done(self, provider: str, future):
+        """调用方超时放弃的调用继续占用名额，底层调用（future）真正返回后才释放"""
+        with self.cond:
+            if provider not in self.limits:
+                return
+            self.abandoned[provider] += 1
+
+        def done(_):
+            with self.cond:
+                self.abandoned[provider] -= 1
+            self.release(provider)
+
+        future.add_done_callback(done)
+
+    def set_limit(self, provider: str, limit: int):
+        with self.cond:
+            self.limits[provider] = max(1, limit)
+            self.in_flight.setdefault(provider, 0)
+            self.waiters.setdefault(provider, deque())
+            self.abandoned.setdefault(provider, 0)
+            self.cond.notify_all()
+
+    def position(self, provider: str, owner: str) -> int:
+        """owner在provider队列中的位置（0为队首），不在排队时返回None"""
+        with self.cond:
+            for index, (waiter,) in enumerate(self.waiters.get(provider, ())):
+                if waiter == owner:
+                    return index
+            return None
+
+    def load(self, provider: str) -> dict:
+        """provider当前的上限、在途调用数和排队数；未配置上限时返回None"""
+        with self.cond:
+            if provider not in self.limits:
+                return None
+            return {"limit": self.limits[provider], "in_flight": self.in_flight[provider], "queued": len(self.waiters[provider])}
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                provider: {
+                    "limit": self.limits[provider],
+                    "in_flight": self.in_flight[provider],
+                    "queued": len(self.waiters[provider]),
+                    "abandoned": self.abandoned[provider],
+                }
+                for provider in self.limits
+            }
+
+
+class ConcurrencyController:
+    """按provider自动调整ProviderLimiter的上限（AIMD + 延迟梯度，思路类似TCP Vegas / Netflix concurrency-limits）
+
+    每凑满window次调用（或过了window_seconds秒）评估一次：
+    - 超时、限流、5xx这类过载信号占比超过error_threshold：上限乘以backoff
+    - 上限在这个窗口内确实被用满，且调用耗时中位数超过基线的tolerance倍：按 基线 / 当前耗时 的比例降低
+    - 上限被用满、耗时平稳：上限加一
+    - 上限没有用满：说明瓶颈不在并发数，保持不变
+
+    基线是窗口耗时中位数的EWMA。没有用满上限时耗时变长，是provider自身变慢（DashScope一天中在10~60秒之间波动），
+    此时不降并发，基线很快跟上新的耗时水平；用满上限时基线只缓慢上升。因耗时降低上限后隔一个窗口再看，耗时没有回落
+    说明变慢的是provider而不是排队，直接以当前耗时作为新基线，不再继续降。
+    """
+
+    def __init__(self, limiter: ProviderLimiter, bounds: dict[str, tuple[int, int]], window: int = 20,
+                 window_seconds: float = 30, tolerance: float = 1.5, backoff: float = 0.75,
+                 error_threshold: float = 0.2, baseline_alpha: float = 0.1):
+        self.limiter = limiter
+        self.bounds = dict(bounds)  # provider -> (最小上限, 最大上限)
+        self.window = window
+        self.window_seconds = window_seconds
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.error_threshold = error_threshold
+        self.baseline_alpha = baseline_alpha
+        self.lock = threading.Lock()
+        self.state = {provider: self._new_state() for provider in bounds}
+
+    @staticmethod
+    def _new_state() -> dict:
+        return {
+            "latencies": [], "samples": 0, "drops": 0, "saturated": False, "window_started": time.time(),
+            "baseline": None, "last_latency": None, "last_decision": None, "cut_latency": None, "cut_windows": 0,
+            "increases": 0, "decreases": 0, "history": deque(maxlen=20),
+        }
+
+    def observe(self, provider: str, latency: float, success: bool, dropped: bool = False):
+        """记录一次调用（从拿到名额到调用结束）；dropped表示超时、限流、5xx等过载信号"""
+        if provider not in self.state:
+            return
+        load = self.limiter.load(provider)
+        with self.lock:
+            state = self.state[provider]
+            state["samples"] += 1
+            if success:
+                state["latencies"].append(latency)
+            if dropped:
+                state["drops"] += 1
+            # 调用结束前其他调用仍占满名额或有人排队：这个窗口里上限是瓶颈
+            if load is not None and load["in_flight"] + load["queued"] >= load["limit"]:
+                state["saturated"] = True
+            if state["samples"] >= self.window or (
+                    state["samples"] >= 3 and time.time() - state["window_started"] >= self.window_seconds):
+                self._adjust(provider, state, load)
+
+    def _adjust(self, provider: str, state: dict, load: dict):
+        # 调用方持有锁
+        latencies = sorted(state["latencies"])
+        current = latencies[len(latencies) // 2] if latencies else None
+        baseline = state["baseline"]
+        limit = load["limit"] if load else self.bounds[provider][1]
+        low, high = self.bounds[provider]
+        drop_rate = state["drops"] / state["samples"]
+
+        # 因耗时降了上限之后：第一个窗口里还有按旧上限排队的调用，先观察；第二个窗口耗时仍没有回落，
+        # 说明变慢的是provider本身，不是我们压出来的
+        settling = provider_shift = False
+        if state["cut_latency"] is not None:
+            state["cut_windows"] += 1
+            if state["cut_windows"] == 1:
+                settling = True
+            else:
+                provider_shift = current is not None and current >= state["cut_latency"] * 0.9
+                state["cut_latency"] = None
+
+        if drop_rate > self.error_threshold:
+            new_limit, reason = int(limit * self.backoff), f"过载信号{drop_rate:.0%}"
+            state["cut_latency"] = None
+        elif settling:
+            new_limit, reason = limit, "等待降低上限生效"
+        elif provider_shift:
+            new_limit, reason = limit, f"降低上限后耗时仍为{current:.1f}s，更新基线"
+        elif current is not None and baseline and state["saturated"] and current > baseline * self.tolerance:
+            new_limit, reason = int(limit * max(self.backoff, baseline / current)), f"耗时{current:.1f}s超过基线{baseline:.1f}s"
+            state.update(cut_latency=current, cut_windows=0)
+        elif state["saturated"] and (current is None or not baseline or current <= baseline * self.tolerance):
+            new_limit, reason = limit + 1, "上限用满且耗时平稳"
+        else:
+            new_limit, reason = limit, "上限未用满"
+        new_limit = max(low, min(high, new_limit))
+
+        if current is not None:
+            # 没有用满上限时耗时变化来自provider本身，基线更快地跟上；
+            # 用满上限时耗时变长可能是我们自己压出来的，基线只缓慢上升，否则会跟着一起涨、上限越加越高
+            if provider_shift:
+                alpha = 1.0
+            elif not state["saturated"]:
+                alpha = min(1.0, self.baseline_alpha * 3)
+            elif baseline is not None and current > baseline:
+                alpha = self.baseline_alpha / 4
+            else:
+                alpha = self.baseline_alpha
+            state["baseline"] = current if baseline is None else baseline + alpha * (current - baseline)
+            state["last_latency"] = current
+        state["last_decision"] = reason
+        if new_limit != limit:
+            state["increases" if new_limit > limit else "decreases"] += 1
+            state["history"].append({"ts": time.time(), "limit": new_limit, "reason": reason})
+            self.limiter.set_limit(provider, new_limit)
+            print(f"🎚️ {provider} 并发上限 {limit} → {new_limit}（{reason}）")
+
+        state.update(latencies=[], samples=0, drops=0, saturated=False, window_started=time.time())
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            providers = {}
+            for provider, state in self.state.items():
+                load = self.limiter.load(provider) or {}
+                providers[provider] = {
+                    "limit": load.get("limit"),
+                    "min": self.bounds[provider][0],
+                    "max": self.bounds[provider][1],
+                    "in_flight": load.get("in_flight"),
+                    "queued": load.get("queued"),
+                    "baseline_latency_seconds": None if state["baseline"] is None else round(state["baseline"], 2),
+                    "last_latency_seconds": None if state["last_latency"] is None else round(state["last_latency"], 2),
+                    "last_decision": state["last_decision"],
+                    "increases": state["increases"],
+                    "decreases": state["decreases"],
+                    "history": list(state["history"]),
+                }
+            return providers
@@ -0,0 +1,87 @@
+"""
+任务截止时间与SDK调用的硬超时
+
+每个生成任务带一个截止时间，每次尝试只拿到剩余的时间预算。
+没有超时参数的SDK调用（例如 dashscope.MultiModalConversation.call）放到独立的守护线程中执行，
+超时后调用方直接放弃等待；挂起的线程不会占用任务线程，也不会阻止进程退出。
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable
+
+from app.services.profiler import current_tag, tag_thread
+
+
+class CallTimeout(Exception):
+    """隔离执行的调用没有在给定时间内返回；pending为仍在后台运行的调用的Future（已经结束时为None）"""
+
+    def __init__(self, message: str, pending: Future = None):
+        super().__init__(message)
+        self.pending = pending
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.started = time.time()
+        self.expires_at = self.started + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.time())
+
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+    def clamp(self, timeout: float) -> float:
+        """把单个操作的超时限制在剩余预算内"""
+        return min(timeout, self.remaining())
+
+
+# 被放弃但仍在后台运行的调用，用于观察是否有provider大量挂起
+_stats_lock = threading.Lock()
+isolation_stats = {"calls": 0, "timeouts": 0, "abandoned_running": 0}
+
+
+def call_with_timeout(fn: Callable, timeout: float, *args, **kwargs):
+    """在独立的守护线程中执行fn，最多等待timeout秒，超时抛出CallTimeout"""
+    future = Future()
+    task_tag = current_tag()
+
+    def run():
+        # 隔离线程的采样样本仍然归到发起调用的任务
+        tag_thread(task_tag)
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            tag_thread(None)
+            with _stats_lock:
+                if abandoned.is_set():
+                    isolation_stats["abandoned_running"] -= 1
+
+    abandoned = threading.Event()
+    with _stats_lock:
+        isolation_stats["calls"] += 1
+    threading.Thread(target=run, name=f"isolated-{getattr(fn, '__name__', 'call')}", daemon=True).start()
+    try:
+        return future.result(timeout=max(0.0, timeout))
+    except FutureTimeoutError:
+        with _stats_lock:
+            # 线程可能恰好在这时结束，只有仍在运行时才计入abandoned_running
+            if not future.done():
+                abandoned.set()
+                isolation_stats["abandoned_running"] += 1
+            isolation_stats["timeouts"] += 1
+        raise CallTimeout(f"调用超过{timeout:.1f}秒未返回", pending=future if abandoned.is_set() else None)
+
+
+def snapshot() -> dict:
+    with _stats_lock:
+        return dict(isolation_stats)
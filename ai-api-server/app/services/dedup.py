@@ -0,0 +1,248 @@
+"""
+原图近似重复检测：感知哈希 + 多索引哈希表
+
+参会者经常对同一个姿势连拍两三张，每张都会走一遍完整的生成流程。
+入口处为每张原图计算64位感知哈希（pHash：32x32灰度图的DCT低频8x8与中位数比较，NumPy矩阵乘实现；
+也可以选dHash），放入多索引哈希表，按汉明距离半径查询，几万张图内查询在亚毫秒级。
+同一会话的近似重复可以只做标记，也可以直接复用之前的生成结果。没有会话ID的请求默认不比较，
+显式开启后才把时间窗口内的照片视为同一批连拍（不同参会者的照片也可能落在同一窗口内）。
+"""
+
+import json
+import os
+import threading
+import time
+from io import BytesIO
+
+HASH_SIZE = 8
+PHASH_SAMPLE = 32
+
+_dct_cache = {}
+
+
+def _dct_matrix(n: int):
+    """正交DCT-II变换矩阵，二维DCT即 D @ X @ D.T"""
+    import numpy as np
+
+    if n not in _dct_cache:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+        matrix[0] /= np.sqrt(2.0)
+        _dct_cache[n] = matrix
+    return _dct_cache[n]
+
+
+def _grayscale(content: bytes, size: tuple):
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(content))
+    # JPEG可以在解码阶段直接按1/2、1/4、1/8缩小，省掉大部分解码开销
+    image.draft("L", (size[0] * 4, size[1] * 4))
+    image = ImageOps.exif_transpose(image).convert("L").resize(size, Image.LANCZOS)
+    return np.asarray(image, dtype=np.float64)
+
+
+def _bits_to_int(bits) -> int:
+    import numpy as np
+
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+
+def phash(content: bytes) -> int:
+    import numpy as np
+
+    pixels = _grayscale(content, (PHASH_SAMPLE, PHASH_SAMPLE))
+    dct = _dct_matrix(PHASH_SAMPLE)
+    low = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE]
+    # 直流分量只反映整体亮度，不参与中位数
+    median = np.median(low.ravel()[1:])
+    return _bits_to_int(low > median)
+
+
+def dhash(content: bytes) -> int:
+    pixels = _grayscale(content, (HASH_SIZE + 1, HASH_SIZE))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """多索引哈希表：64位哈希切成 radius+1 段，每段一张精确匹配的哈希表
+
+    由抽屉原理，汉明距离不超过radius的两个哈希至少有一段完全相同，
+    所以只需要取出各段桶里的候选再逐个验证距离。随机哈希下5万条的查询约0.06ms；
+    BK树在汉明空间中距离集中在32附近，剪枝效果差，同样规模要慢两个数量级。
+    """
+
+    def __init__(self, radius: int, bits: int = HASH_SIZE * HASH_SIZE):
+        self.radius = radius
+        segments = radius + 1
+        self.bounds = [bits * i // segments for i in range(segments + 1)]
+        self.tables = [{} for _ in range(segments)]
+        self.size = 0
+
+    def _segments(self, value: int) -> list[int]:
+        return [
+            (value >> low) & ((1 << (high - low)) - 1)
+            for low, high in zip(self.bounds, self.bounds[1:])
+        ]
+
+    def add(self, value: int, item):
+        self.size += 1
+        for table, segment in zip(self.tables, self._segments(value)):
+            table.setdefault(segment, []).append((value, item))
+
+    def search(self, value: int) -> list[tuple[int, object]]:
+        """返回汉明距离不超过radius的 [(距离, 条目)]，按距离升序"""
+        seen = set()
+        results = []
+        for table, segment in zip(self.tables, self._segments(value)):
+            for candidate, item in table.get(segment, ()):
+                if id(item) in seen:
+                    continue
+                seen.add(id(item))
+                distance = hamming(value, candidate)
+                if distance <= self.radius:
+                    results.append((distance, item))
+        results.sort(key=lambda pair: pair[0])
+        return results
+
+
+class DuplicateIndex:
+    """持久化的原图哈希索引：JSONL追加写入，启动时重建内存索引"""
+
+    def __init__(self, path: str, algorithm: str = "phash", radius: int = 6, window: float = 600):
+        self.path = path
+        self.algorithm = algorithm
+        self.hash_fn = HASH_FUNCTIONS[algorithm]
+        self.radius = radius
+        self.window = window  # 没有会话ID且开启了时间窗口时，只把这么多秒内的照片视为同一批连拍
+        self.lock = threading.Condition()
+        self.table = MultiIndexHash(radius)
+        self.entries = {}  # job_id -> 条目
+        self.stats = {"lookups": 0, "matches": 0, "reused": 0, "lookup_ms_total": 0.0}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("algorithm", self.algorithm) != self.algorithm:
+                    continue
+                self._apply(record)
+        # 上次进程退出时还没有结果的任务不会再有结果了
+        for entry in self.entries.values():
+            if entry["status"] == "pending":
+                entry["status"] = "abandoned"
+
+    def _apply(self, record: dict):
+        if record.get("op") == "result":
+            entry = self.entries.get(record["job_id"])
+            if entry is not None:
+                entry["status"] = record["status"]
+                entry["image_paths"] = record.get("image_paths", [])
+            return
+        entry = {
+            "job_id": record["job_id"],
+            "hash": int(record["hash"], 16),
+            "session_id": record.get("session_id"),
+            "prompt": record.get("prompt"),
+            "created_at": record["created_at"],
+            "status": record.get("status", "pending"),
+            "image_paths": record.get("image_paths", []),
+        }
+        self.entries[entry["job_id"]] = entry
+        self.table.add(entry["hash"], entry)
+
+    def _append(self, record: dict):
+        # 调用方持有锁
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._apply(record)
+
+    def compute(self, content: bytes) -> int:
+        return self.hash_fn(content)
+
+    def find(self, value: int, session_id: str = None, now: float = None, window_fallback: bool = False,
+             exclude_job: str = None) -> tuple[int, dict]:
+        """查找同一会话最相近的一张，返回 (距离, 条目) 或 None
+
+        没有会话ID时返回None；window_fallback为True时改为在时间窗口内查找。
+        exclude_job是当前任务自己的ID：重启后恢复的任务沿用原task_id，不能匹配到自己排空前登记的条目。
+        """
+        if not session_id and not window_fallback:
+            return None
+        now = now or time.time()
+        started = time.perf_counter()
+        with self.lock:
+            candidates = self.table.search(value)
+            self.stats["lookups"] += 1
+            self.stats["lookup_ms_total"] += (time.perf_counter() - started) * 1000
+            for distance, entry in candidates:
+                if entry["job_id"] == exclude_job:
+                    continue
+                if session_id and entry["session_id"] != session_id:
+                    continue
+                if not session_id and now - entry["created_at"] > self.window:
+                    continue
+                self.stats["matches"] += 1
+                return distance, entry
+        return None
+
+    def add(self, job_id: str, value: int, session_id: str = None, prompt: str = None):
+        with self.lock:
+            # 恢复的任务已经登记过，保留原条目（仍为pending，完成后由record_result更新）
+            if job_id in self.entries:
+                return
+            self._append({
+                "job_id": job_id,
+                "hash": f"{value:016x}",
+                "algorithm": self.algorithm,
+                "session_id": session_id,
+                "prompt": prompt,
+                "created_at": time.time(),
+            })
+
+    def record_result(self, job_id: str, status: str, image_paths: list[str] = None):
+        """登记任务结果，并唤醒等待这个结果的近似重复请求"""
+        with self.lock:
+            if job_id not in self.entries:
+                return
+            self._append({"op": "result", "job_id": job_id, "status": status, "image_paths": image_paths or []})
+            self.lock.notify_all()
+
+    def wait_result(self, job_id: str, timeout: float) -> dict:
+        """等待之前的任务结束（连拍时前一张往往还在生成中），返回条目"""
+        with self.lock:
+            self.lock.wait_for(lambda: self.entries[job_id]["status"] != "pending", timeout)
+            return dict(self.entries[job_id])
+
+    def mark_reused(self):
+        with self.lock:
+            self.stats["reused"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            lookups = self.stats["lookups"]
+            return {
+                "algorithm": self.algorithm,
+                "radius": self.radius,
+                "indexed": self.table.size,
+                "lookups": lookups,
+                "matches": self.stats["matches"],
+                "reused": self.stats["reused"],
+                "avg_lookup_ms": round(self.stats["lookup_ms_total"] / lookups, 4) if lookups else None,
+            }
@@ -0,0 +1,108 @@
+"""
+收到SIGTERM时的平滑下线
+
+1. 立即进入draining状态：/health返回503，新的生成任务被拒绝；
+2. 等待readiness_grace秒让负载均衡摘掉本实例后，交给uvicorn停止监听（在途请求继续执行）；
+3. 在途任务最多再执行drain_seconds秒；到期仍未结束的任务写入checkpoint，并在下一个尝试边界停止；
+4. 下一个进程启动时读取checkpoint，把未完成的任务重新执行一遍。
+
+checkpoint是追加写入的JSONL：pending记录任务请求，done表示任务后来还是完成了，不需要恢复。
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+
+class DrainController:
+    def __init__(self, checkpoint_path: str, drain_seconds: float = 30, readiness_grace: float = 0):
+        self.checkpoint_path = checkpoint_path
+        self.drain_seconds = drain_seconds
+        self.readiness_grace = readiness_grace
+        self.lock = threading.Lock()
+        self.draining = False
+        self.started_at = None
+        self.expired = threading.Event()  # 排空时间用完，在途任务应在下一个尝试边界停止
+        self.checkpointed = set()
+        os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+
+    def _append(self, record: dict):
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def checkpoint(self, task_id: str, request: dict):
+        """记录一个未完成的任务，供下一个进程恢复；重复调用只写一次"""
+        with self.lock:
+            if task_id in self.checkpointed:
+                return
+            self.checkpointed.add(task_id)
+            self._append({"op": "pending", "task_id": task_id, "request": request, "at": time.time()})
+
+    def complete(self, task_id: str):
+        """写入checkpoint之后任务还是结束了（成功或确定失败），下次启动时不再恢复"""
+        with self.lock:
+            if task_id not in self.checkpointed:
+                return
+            self.checkpointed.discard(task_id)
+            self._append({"op": "done", "task_id": task_id, "at": time.time()})
+
+    def take_pending(self) -> list[tuple[str, dict]]:
+        """读取上一个进程留下的未完成任务，并把checkpoint改名归档，避免重复恢复"""
+        if not os.path.exists(self.checkpoint_path):
+            return []
+        pending = {}
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("op") == "pending":
+                    pending[record["task_id"]] = record["request"]
+                elif record.get("op") == "done":
+                    pending.pop(record["task_id"], None)
+        os.replace(self.checkpoint_path, f"{self.checkpoint_path}.{int(time.time())}.resumed")
+        return list(pending.items())
+
+    def begin(self, stop_listening: Callable[[], None], active_jobs: Callable[[], dict]):
+        """开始排空（在信号处理函数中调用，立即返回）"""
+        with self.lock:
+            if self.draining:
+                # 第二次SIGTERM：不再等待，直接交给uvicorn
+                stop_listening()
+                return
+            self.draining = True
+            self.started_at = time.time()
+        print(f"🛑 收到SIGTERM，开始排空：最多等待在途任务 {self.drain_seconds:.0f} 秒")
+        threading.Thread(target=self._drain, args=(stop_listening, active_jobs), name="drain", daemon=True).start()
+
+    def _drain(self, stop_listening: Callable[[], None], active_jobs: Callable[[], dict]):
+        if self.readiness_grace:
+            time.sleep(self.readiness_grace)
+        stop_listening()
+
+        deadline = self.started_at + self.drain_seconds
+        while time.time() < deadline and active_jobs():
+            time.sleep(0.2)
+        remaining = active_jobs()
+        if not remaining:
+            print("✅ 在途任务已全部完成")
+            return
+        self.expired.set()
+        for task_id, request in remaining.items():
+            self.checkpoint(task_id, request)
+        print(f"💾 排空时间已到，{len(remaining)} 个未完成任务已写入checkpoint，将在下次启动时恢复")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "draining": self.draining,
+                "drain_seconds": self.drain_seconds,
+                "elapsed": round(time.time() - self.started_at, 1) if self.started_at else None,
+                "expired": self.expired.is_set(),
+                "checkpointed": len(self.checkpointed),
+            }
@@ -0,0 +1,139 @@
+"""
+provider错误分类
+
+原来所有失败都被拼成字符串，然后一视同仁地等待、重试。这里把各provider的错误归为六类，
+重试循环据此决定下一步：
+
+- transient       临时故障（5xx、网络错误、超时）：等待后重试
+- rate_limited    限流或额度不足：优先换provider，没有其他provider时再等待
+- input_invalid   原图无法下载或格式不被接受：这个provider不再尝试，所有provider都不接受时立即失败
+- policy_rejected 内容审核拒绝：立即换下一个prompt变体，不等待；同一provider连续被拒时换provider
+- auth            API key无效或无权限：这个provider不再尝试
+- output_invalid  返回了图片但没有通过输出校验（空白、纯色、截断等）：立即进入下一次尝试，不等待
+
+无法识别的错误按transient处理，保持原来的重试行为。
+"""
+
+TRANSIENT = "transient"
+RATE_LIMITED = "rate_limited"
+INPUT_INVALID = "input_invalid"
+POLICY_REJECTED = "policy_rejected"
+AUTH = "auth"
+OUTPUT_INVALID = "output_invalid"
+
+# 这些类别说明换一个变体或等一会儿也没用，本任务不再使用这个provider
+PROVIDER_FATAL = {INPUT_INVALID, AUTH}
+
+# DashScope错误码：https://help.aliyun.com/zh/model-studio/error-code
+# 笼统的InvalidParameter不在这里：它多半来自prompt或尺寸参数，由classify_dashscope根据错误信息判断是否与原图有关
+DASHSCOPE_CODES = {
+    "InvalidApiKey": AUTH,
+    "AccessDenied": AUTH,
+    "AccessDenied.Unpurchased": AUTH,
+    "Workspace.AccessDenied": AUTH,
+    "Model.AccessDenied": AUTH,
+    "Throttling": RATE_LIMITED,
+    "Throttling.RateQuota": RATE_LIMITED,
+    "Throttling.BurstRate": RATE_LIMITED,
+    "Throttling.AllocationQuota": RATE_LIMITED,
+    "AllocationQuota.FreeTierOnly": RATE_LIMITED,
+    "Arrearage": RATE_LIMITED,
+    "DataInspectionFailed": POLICY_REJECTED,
+    "data_inspection_failed": POLICY_REJECTED,
+    "IPInfringementSuspect": POLICY_REJECTED,
+    "InvalidURL": INPUT_INVALID,
+    "InvalidImage": INPUT_INVALID,
+    "InvalidFile.DownloadFailed": INPUT_INVALID,
+    "InvalidParameter.DataInspection": INPUT_INVALID,
+    "InternalError": TRANSIENT,
+    "InternalError.Algo": TRANSIENT,
+    "ServiceUnavailable": TRANSIENT,
+    "RequestTimeOut": TRANSIENT,
+}
+
+# Vidu 400响应中的reason
+VIDU_REASONS = {
+    "CreditInsufficient": RATE_LIMITED,
+    "TaskLimitExceeded": RATE_LIMITED,
+    "ImageDownloadFailed": INPUT_INVALID,
+    "ImageFormatInvalid": INPUT_INVALID,
+    "ImageSizeInvalid": INPUT_INVALID,
+    "AuditSubmitIllegal": POLICY_REJECTED,
+    "AuditResultIllegal": POLICY_REJECTED,
+}
+
+# Gemini（Google API）的status
+GEMINI_STATUSES = {
+    "UNAUTHENTICATED": AUTH,
+    "PERMISSION_DENIED": AUTH,
+    "RESOURCE_EXHAUSTED": RATE_LIMITED,
+    "INVALID_ARGUMENT": INPUT_INVALID,
+    "FAILED_PRECONDITION": INPUT_INVALID,
+    "UNAVAILABLE": TRANSIENT,
+    "INTERNAL": TRANSIENT,
+    "DEADLINE_EXCEEDED": TRANSIENT,
+}
+
+# Gemini的finish_reason / block_reason中表示被安全策略拦截的值
+GEMINI_BLOCK_REASONS = {
+    "SAFETY", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "IMAGE_SAFETY", "IMAGE_PROHIBITED_CONTENT",
+    "RECITATION", "IMAGE_RECITATION", "MODEL_ARMOR", "JAILBREAK",
+}
+
+
+def classify_http_status(status_code: int) -> str:
+    if status_code in (401, 403):
+        return AUTH
+    if status_code == 429:
+        return RATE_LIMITED
+    if status_code in (400, 404, 413, 415, 422):
+        return INPUT_INVALID
+    return TRANSIENT
+
+
+def classify_dashscope(status_code: int, code: str = None, message: str = None) -> str:
+    if code in DASHSCOPE_CODES:
+        return DASHSCOPE_CODES[code]
+    for prefix, kind in (("Throttling", RATE_LIMITED), ("InvalidImage", INPUT_INVALID), ("InvalidFile", INPUT_INVALID)):
+        if code and code.startswith(prefix):
+            return kind
+    text = (message or "").lower()
+    if "inappropriate" in text or "inspection" in text:
+        return POLICY_REJECTED
+    if "download" in text and ("image" in text or "url" in text):
+        return INPUT_INVALID
+    if code == "InvalidParameter":
+        # 只有错误信息指向原图时才放弃这个provider，否则换一个变体重试
+        return INPUT_INVALID if any(word in text for word in ("image", "url", "图片", "图像")) else TRANSIENT
+    if status_code in (401, 403, 429):
+        return classify_http_status(status_code)
+    return TRANSIENT
+
+
+def classify_vidu(status_code: int, reason: str = None) -> str:
+    if reason in VIDU_REASONS:
+        return VIDU_REASONS[reason]
+    return classify_http_status(status_code)
+
+
+def classify_gemini_block(reason) -> str:
+    """Gemini响应被拦截（没有返回图片）时，根据finish_reason/block_reason分类"""
+    name = getattr(reason, "name", None) or str(reason or "")
+    return POLICY_REJECTED if name.split(".")[-1] in GEMINI_BLOCK_REASONS else TRANSIENT
+
+
+def classify_exception(e: Exception) -> str:
+    """SDK或HTTP客户端抛出的异常"""
+    status = getattr(e, "status", None)
+    if isinstance(status, str) and status in GEMINI_STATUSES:
+        return GEMINI_STATUSES[status]
+    # requests.HTTPError带response；google-genai的APIError带整数code
+    response = getattr(e, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code is None and isinstance(getattr(e, "code", None), int):
+        status_code = e.code
+    if status_code is not None:
+        return classify_http_status(status_code)
+    if type(e).__name__ in ("UnidentifiedImageError", "DecompressionBombError"):
+        return INPUT_INVALID
+    return TRANSIENT
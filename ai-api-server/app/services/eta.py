@@ -0,0 +1,168 @@
+"""
+任务排队位置与预计完成时间
+
+/generate-image/ 是阻塞调用，客户端原来只能干等，不知道要等10秒还是3分钟。这里跟踪每个运行中任务的阶段
+（准备中 / 排队等待provider名额 / 正在调用provider），每次查询时根据实时数据重新估算：
+
+- 每个provider单次调用的耗时和成功率：来自BudgetTracker的EWMA（每次调用后更新）
+- 排队：在provider名额队列中排第k位、上限c个并发、单次调用耗时S时，预计等待 (k + 1) × S / c
+- 重试：本次失败的概率为 1 - p，后面平均还需要 (1 - p) / p 次调用
+- 准备阶段（下载、预处理、prompt优化）：最近完成任务的准备耗时中位数
+
+预计完成时间不会晚于任务的截止时间。新任务提交前也可以先查询预计等待时间，用来设置客户端超时；
+队列长度和预计等待随负载上升，运维可以在饱和之前看到趋势。
+"""
+
+import threading
+import time
+from collections import deque
+
+MIN_SUCCESS_RATE = 0.2  # 成功率估计很低时，重试次数的估计不再继续放大
+
+
+def _median(values) -> float:
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2] if ordered else None
+
+
+class EtaEstimator:
+    def __init__(self, limiter, budget, history: int = 200):
+        self.limiter = limiter  # ProviderLimiter，提供排队位置和并发上限
+        self.budget = budget  # BudgetTracker，提供每个provider的耗时和成功率估计
+        self.lock = threading.Lock()
+        self.jobs = {}  # 任务ID -> 阶段信息
+        self.prepare_seconds = deque(maxlen=history)  # 最近任务从开始到第一次调用provider的耗时
+        self.job_seconds = deque(maxlen=history)  # 最近成功任务的端到端耗时
+        self.errors = deque(maxlen=history)  # 预计耗时与实际耗时之差（秒），用于观察估计的准确度
+
+    # ---------- 任务阶段 ----------
+
+    def job_started(self, task_id: str, deadline_at: float, provider: str = "tongyi"):
+        # 记下提交时的估计，任务结束后与实际耗时比较
+        first_estimate = self.estimate_new(provider)["eta_seconds"]
+        with self.lock:
+            self.jobs[task_id] = {
+                "started_at": time.time(), "deadline_at": deadline_at, "phase": "preparing",
+                "provider": provider, "attempt": 0, "attempt_started_at": None, "first_estimate": first_estimate,
+            }
+
+    def attempt_started(self, task_id: str, provider: str, attempt: int):
+        with self.lock:
+            job = self.jobs.get(task_id)
+            if job is None:
+                return
+            now = time.time()
+            if job["attempt"] == 0:
+                self.prepare_seconds.append(now - job["started_at"])
+            job.update(phase="generating", provider=provider, attempt=attempt, attempt_started_at=now)
+
+    def job_finished(self, task_id: str, success: bool):
+        with self.lock:
+            job = self.jobs.pop(task_id, None)
+            if job is None or not success:
+                return
+            elapsed = time.time() - job["started_at"]
+            self.job_seconds.append(elapsed)
+            self.errors.append(job["first_estimate"] - elapsed)
+
+    # ---------- 估算 ----------
+
+    def _queue_wait(self, provider: str, position: int) -> float:
+        """排在第position位（0为队首）时预计等待名额的时间"""
+        load = self.limiter.load(provider)
+        if load is None:
+            return 0.0
+        if position is None:
+            # 新任务：排在当前队列的末尾；还有空闲名额时不用等
+            if load["in_flight"] + load["queued"] < load["limit"]:
+                return 0.0
+            position = load["queued"]
+        return (position + 1) * self.budget.expected_latency(provider) / load["limit"]
+
+    def _retry_tail(self, provider: str) -> float:
+        success_rate = max(self.budget.success_rate(provider), MIN_SUCCESS_RATE)
+        return (1 - success_rate) / success_rate * self.budget.expected_latency(provider)
+
+    def _prepare_estimate(self) -> float:
+        median = _median(self.prepare_seconds)
+        return median if median is not None else 1.0
+
+    def estimate(self, task_id: str) -> dict:
+        """运行中任务的阶段、排队位置和预计剩余时间；任务不存在时返回None"""
+        with self.lock:
+            job = self.jobs.get(task_id)
+            if job is None:
+                return None
+            job = dict(job)
+        now = time.time()
+        provider = job["provider"]
+        latency = self.budget.expected_latency(provider)
+        position = self.limiter.position(provider, task_id)
+        load = self.limiter.load(provider)
+
+        if job["phase"] == "preparing":
+            phase = "preparing"
+            remaining = (max(0.0, self._prepare_estimate() - (now - job["started_at"]))
+                         + self._queue_wait(provider, None) + latency + self._retry_tail(provider))
+        elif position is not None:
+            phase = "queued"
+            remaining = self._queue_wait(provider, position) + latency + self._retry_tail(provider)
+        else:
+            phase = "generating"
+            in_attempt = now - (job["attempt_started_at"] or now)
+            # 已经超过平均耗时的调用，至少再估计一小段时间
+            remaining = max(latency - in_attempt, latency * 0.1) + self._retry_tail(provider)
+
+        eta = min(now + remaining, job["deadline_at"]) if job["deadline_at"] else now + remaining
+        return {
+            "task_id": task_id,
+            "phase": phase,
+            "provider": provider,
+            "attempt": job["attempt"],
+            "queue_position": None if position is None else position + 1,
+            "queue_length": load["queued"] if load else 0,
+            "elapsed_seconds": round(now - job["started_at"], 1),
+            "eta_seconds": round(max(0.0, eta - now), 1),
+            "estimated_completion_at": round(eta, 3),
+            "deadline_at": job["deadline_at"],
+        }
+
+    def estimate_new(self, provider: str = "tongyi") -> dict:
+        """现在提交一个新任务时的预计排队和完成时间"""
+        load = self.limiter.load(provider)
+        queue_wait = self._queue_wait(provider, None)
+        total = self._prepare_estimate() + queue_wait + self.budget.expected_latency(provider) + self._retry_tail(provider)
+        return {
+            "provider": provider,
+            "queue_length": load["queued"] if load else 0,
+            "in_flight": load["in_flight"] if load else None,
+            "limit": load["limit"] if load else None,
+            "queue_wait_seconds": round(queue_wait, 1),
+            "eta_seconds": round(total, 1),
+        }
+
+    def snapshot(self, providers: list[str]) -> dict:
+        with self.lock:
+            running = len(self.jobs)
+            preparing = sum(job["phase"] == "preparing" for job in self.jobs.values())
+            job_p50 = _median(self.job_seconds)
+            errors = sorted(abs(error) for error in self.errors)
+        queues = {}
+        for provider in providers:
+            load = self.limiter.load(provider)
+            if load is not None:
+                queues[provider] = {
+                    **load,
+                    # 大于1表示新任务需要排队
+                    "utilization": round((load["in_flight"] + load["queued"]) / load["limit"], 2),
+                    "queue_wait_seconds": round(self._queue_wait(provider, None), 1),
+                }
+        return {
+            "running_jobs": running,
+            "preparing": preparing,
+            "queues": queues,
+            "new_job_eta_seconds": self.estimate_new(providers[0])["eta_seconds"] if providers else None,
+            "job_seconds_p50": None if job_p50 is None else round(job_p50, 1),
+            # 提交时的估计与实际耗时之差（绝对值）的中位数
+            "estimate_error_p50_seconds": round(errors[len(errors) // 2], 1) if errors else None,
+        }
@@ -0,0 +1,284 @@
+"""
+任务/尝试事件日志（Parquet，按小时滚动）
+
+每个生成任务写一行job事件，每次provider尝试写一行attempt事件，事后用 event_report.py 分析
+7次尝试阶梯的实际表现：各provider耗时、第几个prompt变体成功、重试等待占了多少时间。
+
+record() 只把事件放进内存缓冲区，不做任何IO；后台线程每 flush_seconds 秒（或攒够 flush_rows 行）
+把缓冲区写成一个Parquet分片 {小时}/part-*.parquet。进入新的小时后，上一个小时的分片合并成
+events-{小时}.parquet。进程崩溃最多丢失一个刷新周期内的事件。
+"""
+
+import glob
+import os
+import threading
+import time
+
+from app.services.clients.lazy import is_available, load
+
+# 每一行都包含全部列，job和attempt事件不用的列为空
+COLUMNS = [
+    ("ts", "float64"),  # 事件时间（Unix秒）
+    ("kind", "string"),  # job / attempt
+    ("job_id", "string"),
+    ("attempt", "int16"),  # 第几次尝试（从1开始，并行推测整体算一次）；job事件为总尝试次数
+    ("provider", "string"),  # attempt: 本次使用的provider；job: 成功的provider
+    ("prompt_variant", "int16"),  # 使用（或成功）的prompt变体序号
+    ("fanout", "int8"),  # 通义并行推测实际提交的变体数（attempt和job事件都有）
+    ("success", "bool"),
+    ("latency_ms", "float32"),  # attempt: 本次调用耗时；job: 端到端耗时
+    ("sleep_ms", "float32"),  # attempt: 失败后的重试等待；job: 所有重试等待之和
+    ("prompt_wait_ms", "float32"),  # job: 第一次尝试前等待prompt优化的时间
+    ("status", "string"),  # job: success / reused / mock / failed / deadline / cancelled / drained / rejected / input_invalid / fallback
+    ("http_status", "int16"),
+    ("error", "string"),
+    ("error_kind", "string"),  # attempt: 错误类别（transient / rate_limited / input_invalid / policy_rejected / auth）
+]
+
+
+def _schema():
+    pa = load("pyarrow")
+    return pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in COLUMNS])
+
+
+def _read(path: str):
+    """按当前schema读取一个文件；旧文件缺少的列补空值"""
+    pa = load("pyarrow")
+    pq = load("pyarrow.parquet")
+    schema = _schema()
+    table = pq.read_table(path)
+    columns = [
+        table[field.name].cast(field.type) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _hour_key(ts: float) -> str:
+    return time.strftime("%Y%m%d%H", time.localtime(ts))
+
+
+class EventLog:
+    def __init__(self, directory: str, flush_rows: int = 1000, flush_seconds: float = 10, max_buffer: int = 100000):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer  # 写入持续失败时最多缓冲这么多行，超出的事件丢弃
+        self.enabled = is_available("pyarrow")
+        self.cond = threading.Condition()
+        self.buffer = []
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "flushes": 0, "compacted_hours": 0}
+        self.last_error = None
+        self._stopped = False
+        self._thread = None
+        self._sequence = 0
+        if not self.enabled:
+            print("⚠️ 未安装pyarrow，任务事件日志已关闭")
+            return
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._writer_loop, name="event-log", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并写出剩余事件"""
+        with self.cond:
+            self._stopped = True
+            self.cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def record(self, kind: str, **fields):
+        if not self.enabled:
+            return
+        row = {"ts": time.time(), "kind": kind, **fields}
+        with self.cond:
+            if len(self.buffer) >= self.max_buffer:
+                self.stats["dropped"] += 1
+                return
+            self.buffer.append(row)
+            self.stats["recorded"] += 1
+            if len(self.buffer) >= self.flush_rows:
+                self.cond.notify()
+
+    # ---------- 写入 ----------
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self._stopped or len(self.buffer) >= self.flush_rows, self.flush_seconds)
+                rows, self.buffer = self.buffer, []
+                stopped = self._stopped
+            if rows:
+                self._flush(rows)
+            self._compact_finished_hours()
+            if stopped:
+                return
+
+    def _flush(self, rows: list[dict]):
+        pq = load("pyarrow.parquet")
+        pa = load("pyarrow")
+        by_hour = {}
+        for row in rows:
+            by_hour.setdefault(_hour_key(row["ts"]), []).append(row)
+        try:
+            for hour, hour_rows in by_hour.items():
+                part_dir = os.path.join(self.directory, hour)
+                os.makedirs(part_dir, exist_ok=True)
+                self._sequence += 1
+                path = os.path.join(part_dir, f"part-{int(time.time() * 1000)}-{self._sequence}.parquet")
+                table = pa.Table.from_pylist(hour_rows, schema=_schema())
+                pq.write_table(table, path + ".tmp", compression="zstd")
+                os.replace(path + ".tmp", path)
+        except Exception as e:
+            # 写入失败时放回缓冲区，下个周期重试
+            self.last_error = str(e)
+            print(f"⚠️ 写入事件日志失败: {e}")
+            with self.cond:
+                self.buffer[:0] = rows[:max(0, self.max_buffer - len(self.buffer))]
+            return
+        with self.cond:
+            self.stats["written"] += len(rows)
+            self.stats["flushes"] += 1
+        self.last_error = None
+
+    def _compact_finished_hours(self):
+        """把已经结束的小时的分片合并成一个文件"""
+        pq = load("pyarrow.parquet")
+        pa = load("pyarrow")
+        current = _hour_key(time.time())
+        for part_dir in sorted(glob.glob(os.path.join(self.directory, "[0-9]" * 10))):
+            hour = os.path.basename(part_dir)
+            if hour >= current or not os.path.isdir(part_dir):
+                continue
+            parts = sorted(glob.glob(os.path.join(part_dir, "part-*.parquet")))
+            target = os.path.join(self.directory, f"events-{hour}.parquet")
+            try:
+                # 进程重启后同一个小时可能已经合并过，追加到已有文件中
+                sources = ([target] if os.path.exists(target) else []) + parts
+                if parts:
+                    table = pa.concat_tables([_read(path) for path in sources])
+                    pq.write_table(table, target + ".tmp", compression="zstd")
+                    os.replace(target + ".tmp", target)
+                for path in parts:
+                    os.remove(path)
+                for leftover in glob.glob(os.path.join(part_dir, "*.tmp")):
+                    os.remove(leftover)
+                os.rmdir(part_dir)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"⚠️ 合并事件日志 {hour} 失败: {e}")
+                continue
+            if parts:
+                with self.cond:
+                    self.stats["compacted_hours"] += 1
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                "enabled": self.enabled,
+                "directory": self.directory,
+                "buffered": len(self.buffer),
+                **self.stats,
+                "last_error": self.last_error,
+            }
+
+
+def load_events(directory: str, since: float = None, until: float = None):
+    """读取 [since, until) 时间范围内的事件，返回pyarrow.Table"""
+    pa = load("pyarrow")
+    pc = load("pyarrow.compute")
+    since_hour = _hour_key(since) if since else None
+    until_hour = _hour_key(until) if until else None
+    paths = glob.glob(os.path.join(directory, "events-*.parquet"))
+    paths += glob.glob(os.path.join(directory, "[0-9]" * 10, "part-*.parquet"))
+    tables = []
+    for path in sorted(paths):
+        name = os.path.basename(path)
+        hour = name[len("events-"):-len(".parquet")] if name.startswith("events-") else os.path.basename(os.path.dirname(path))
+        # 按文件名中的小时跳过时间范围之外的文件
+        if (since_hour and hour < since_hour) or (until_hour and hour > until_hour):
+            continue
+        tables.append(_read(path))
+    table = pa.concat_tables(tables) if tables else _schema().empty_table()
+    if since:
+        table = table.filter(pc.greater_equal(table["ts"], since))
+    if until:
+        table = table.filter(pc.less(table["ts"], until))
+    return table
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    import numpy as np
+
+    p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+    return {
+        "count": len(values),
+        "p50": round(float(p50), 1),
+        "p90": round(float(p90), 1),
+        "p95": round(float(p95), 1),
+        "p99": round(float(p99), 1),
+        "max": round(float(max(values)), 1),
+    }
+
+
+def _counts(values) -> dict:
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], str(item[0]))))
+
+
+def summarize(table) -> dict:
+    """任务成功率、端到端延迟分位数、几次尝试成功、provider占比、各provider的尝试耗时"""
+    rows = table.to_pylist()
+    jobs = [row for row in rows if row["kind"] == "job"]
+    attempts = [row for row in rows if row["kind"] == "attempt"]
+    # 复用和mock没有调用provider，不计入延迟和尝试次数
+    generated = [row for row in jobs if row["status"] == "success"]
+
+    report = {
+        "jobs": len(jobs),
+        "attempts": len(attempts),
+        "status": _counts(row["status"] for row in jobs),
+        "success_rate": round(sum(row["status"] in ("success", "reused", "mock") for row in jobs) / len(jobs), 4) if jobs else None,
+        "latency_ms": {
+            "success": _percentiles([row["latency_ms"] for row in generated]),
+            "all": _percentiles([row["latency_ms"] for row in jobs if row["latency_ms"] is not None]),
+        },
+        "attempts_to_success": _counts(row["attempt"] for row in generated),
+        "provider_share": {},
+        "prompt_variant_success": _counts(row["prompt_variant"] for row in generated if row["prompt_variant"] is not None),
+        "sleep": {
+            "total_seconds": round(sum(row["sleep_ms"] or 0 for row in jobs) / 1000, 1),
+            "share_of_job_time": round(
+                sum(row["sleep_ms"] or 0 for row in jobs) / max(1.0, sum(row["latency_ms"] or 0 for row in jobs)), 4
+            ) if jobs else None,
+        },
+        "prompt_wait_ms": _percentiles([row["prompt_wait_ms"] for row in jobs if row["prompt_wait_ms"] is not None]),
+        "providers": {},
+    }
+    if generated:
+        share = _counts(row["provider"] for row in generated)
+        report["provider_share"] = {provider: round(count / len(generated), 4) for provider, count in share.items()}
+    for provider in sorted({row["provider"] for row in attempts if row["provider"]}):
+        provider_attempts = [row for row in attempts if row["provider"] == provider]
+        succeeded = [row for row in provider_attempts if row["success"]]
+        report["providers"][provider] = {
+            "attempts": len(provider_attempts),
+            "success_rate": round(len(succeeded) / len(provider_attempts), 4),
+            "latency_ms": _percentiles([row["latency_ms"] for row in provider_attempts]),
+            "success_latency_ms": _percentiles([row["latency_ms"] for row in succeeded]),
+            "error_kinds": _counts(row["error_kind"] for row in provider_attempts if not row["success"] and row["error_kind"]),
+            "top_errors": dict(list(_counts(
+                (row["error"] or "")[:80] for row in provider_attempts if not row["success"]
+            ).items())[:5]),
+        }
+    return report
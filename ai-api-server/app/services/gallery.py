@@ -0,0 +1,223 @@
+"""
+生成图片的增量feed（/gallery）
+
+大屏display-app和管理后台原来靠反复全量轮询发现新图片。这里直接使用ai-photos的manifest内存索引（按时间排序），
+客户端带着上一页返回的cursor只取之后新增的图片：
+
+- cursor是不透明字符串（创建时间 + 路径），重启后仍然有效；也可以用since传Unix时间戳
+- 每页带原图URL、尺寸、provider，以及衍生文件：缩略图（首次出现在feed中时在进程池里生成）和同一任务的视频
+- 响应带ETag，内容没有变化时返回304；wait参数开启长轮询，没有新图片时最多挂起wait秒，有新图片立即返回
+  （长轮询在事件循环中等待通知，不占用线程池名额，只有取页本身在线程池中执行）
+
+本地卡通预览（provider为local）只有在成为任务的最终结果后才会出现在feed中。
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+
+THUMBNAIL_QUALITY = 82
+
+
+def render_thumbnail(source_path: str, max_side: int) -> bytes:
+    """生成JPEG缩略图（在子进程中执行）"""
+    from io import BytesIO
+
+    from PIL import Image
+
+    image = Image.open(source_path)
+    image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def encode_cursor(record: dict) -> str:
+    return f"{record['created_at']!r}:{record['path']}"
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    created_at, _, path = cursor.partition(":")
+    return float(created_at), path
+
+
+class GalleryFeed:
+    def __init__(self, store, thumbnails=None, videos=None, thumbnail_side: int = 320, submit=None,
+                 hidden_providers: tuple = ("local",)):
+        self.store = store  # ai-photos的ShardedStore
+        self.thumbnails = thumbnails  # 存放缩略图的ShardedStore，None表示不生成
+        self.videos = videos  # ai-videos的ShardedStore，用于查找同一任务的视频
+        self.thumbnail_side = thumbnail_side
+        self.submit = submit  # 在进程池中执行函数，返回Future
+        self.hidden_providers = set(hidden_providers)
+        self.cond = threading.Condition()
+        self.version = 0  # 任何相关manifest变化都加一，用于ETag和唤醒长轮询
+        self.waiters = set()  # 长轮询中的 (事件循环, asyncio.Event)
+        self.pending_thumbnails = set()
+        self.stats = {"pages": 0, "not_modified": 0, "long_polls": 0, "thumbnails": 0, "thumbnail_errors": 0}
+        store.subscribe(self._image_changed)
+        for source in (thumbnails, videos):
+            if source is not None:
+                source.subscribe(self._bump)
+
+    def _bump(self, record: dict = None):
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+            waiters = list(self.waiters)
+        # manifest变化来自任务线程，通过call_soon_threadsafe唤醒事件循环中的长轮询
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _image_changed(self, record: dict):
+        self._bump()
+        if record.get("op") != "delete" and self.visible(record):
+            self._ensure_thumbnail(record)
+
+    def visible(self, record: dict) -> bool:
+        return record.get("provider") not in self.hidden_providers or bool(record.get("final"))
+
+    # ---------- 衍生文件 ----------
+
+    @staticmethod
+    def _thumbnail_name(record: dict) -> str:
+        return os.path.splitext(os.path.basename(record["path"]))[0] + ".jpg"
+
+    def _ensure_thumbnail(self, record: dict):
+        if self.thumbnails is None or self.submit is None or (record.get("width") or 0) <= self.thumbnail_side:
+            return
+        name = self._thumbnail_name(record)
+        with self.cond:
+            if name in self.pending_thumbnails or self.thumbnails.relative_path(name) in self.thumbnails.records:
+                return
+            self.pending_thumbnails.add(name)
+        future = self.submit(render_thumbnail, os.path.join(self.store.root, record["path"]), self.thumbnail_side)
+
+        def save(f):
+            try:
+                self.thumbnails.save_bytes(name, f.result(), job_id=record.get("job_id"), provider="thumbnail")
+                key = "thumbnails"
+            except Exception as e:
+                print(f"⚠️ 生成缩略图 {name} 失败: {e}")
+                key = "thumbnail_errors"
+            with self.cond:
+                self.pending_thumbnails.discard(name)
+                self.stats[key] += 1
+
+        future.add_done_callback(save)
+
+    def _derivatives(self, record: dict) -> dict:
+        derivatives = {"thumbnail": None, "video": None}
+        if self.thumbnails is not None:
+            thumbnail = self.thumbnails.records.get(self.thumbnails.relative_path(self._thumbnail_name(record)))
+            if thumbnail is not None:
+                derivatives["thumbnail"] = {
+                    "url": f"{self.thumbnails.url_prefix}/{thumbnail['path']}",
+                    "width": thumbnail["width"],
+                    "height": thumbnail["height"],
+                }
+            elif (record.get("width") or 0) <= self.thumbnail_side:
+                # 原图本身就足够小
+                derivatives["thumbnail"] = {"url": f"{self.store.url_prefix}/{record['path']}",
+                                            "width": record.get("width"), "height": record.get("height")}
+            else:
+                # 历史图片在第一次出现在feed中时补生成
+                self._ensure_thumbnail(record)
+        if self.videos is not None and record.get("job_id"):
+            videos = self.videos.find_by_job(record["job_id"])
+            if videos:
+                derivatives["video"] = f"{self.videos.url_prefix}/{videos[-1]['path']}"
+        return derivatives
+
+    def _item(self, record: dict) -> dict:
+        return {
+            "id": record["path"],
+            "job_id": record.get("job_id"),
+            "provider": record.get("provider"),
+            "url": f"{self.store.url_prefix}/{record['path']}",
+            "width": record.get("width"),
+            "height": record.get("height"),
+            "size": record.get("size"),
+            "created_at": record["created_at"],
+            "derivatives": self._derivatives(record),
+        }
+
+    # ---------- 分页 ----------
+
+    def _page(self, cursor: str, since: float, limit: int) -> dict:
+        if cursor:
+            records, has_more = self.store.find_after(*decode_cursor(cursor), limit=limit, predicate=self.visible)
+        elif since is not None:
+            records, has_more = self.store.find_after(since, "", limit=limit, predicate=self.visible)
+        else:
+            # 第一次请求：最新的limit张
+            records, has_more = self.store.tail(limit, predicate=self.visible), False
+        return {
+            "items": [self._item(record) for record in records],
+            # 没有新内容时cursor不变，下次继续从这里等；feed还是空的时从头开始
+            "next_cursor": encode_cursor(records[-1]) if records else cursor or f"{since or 0.0!r}:",
+            "has_more": has_more,
+        }
+
+    def etag(self, version: int, cursor: str, since: float, limit: int) -> str:
+        key = hashlib.md5(f"{cursor}|{since}|{limit}".encode("utf-8")).hexdigest()[:12]
+        return f'"g{version}-{key}"'
+
+    async def page(self, run, cursor: str = None, since: float = None, limit: int = 50, wait: float = 0) -> tuple[dict, str]:
+        """返回 (一页结果, ETag)；wait>0且没有新图片时等待新图片或超时
+
+        run(fn, *args) 在线程池中执行取页（例如starlette的run_in_threadpool），等待期间不占用线程。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        with self.cond:
+            version = self.version
+        page = await run(self._page, cursor, since, limit)
+        if not page["items"] and wait > 0 and (cursor or since is not None):
+            waiter = (loop, asyncio.Event())
+            with self.cond:
+                self.stats["long_polls"] += 1
+                self.waiters.add(waiter)
+            try:
+                while not page["items"]:
+                    with self.cond:
+                        changed = self.version != version
+                        version = self.version
+                        # 之后的变化会重新set，不会漏掉
+                        waiter[1].clear()
+                    if changed:
+                        page = await run(self._page, cursor, since, limit)
+                        continue
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                with self.cond:
+                    self.waiters.discard(waiter)
+        with self.cond:
+            self.stats["pages"] += 1
+        return page, self.etag(version, cursor, since, limit)
+
+    def not_modified(self):
+        with self.cond:
+            self.stats["not_modified"] += 1
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return {
+                "version": self.version,
+                "pending_thumbnails": len(self.pending_thumbnails),
+                "waiting": len(self.waiters),
+                **self.stats,
+            }
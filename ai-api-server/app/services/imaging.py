@@ -0,0 +1,283 @@
+"""
+上传provider之前的原图预处理
+
+应用EXIF方向、去掉元数据、按provider的目标分辨率缩小，并重新编码为优化过的JPEG。
+处理在进程池中执行，结果按 (原图摘要, 目标尺寸) 缓存到原图缓存目录。
+
+生成prompt只关心人物（面部特征、发型、服装），原图大部分却是背景。开启主体裁剪时先用OpenCV自带的
+Haar级联检测人脸，裁到包含头肩和上半身的区域再缩放，provider的上传和推理都更快；没检测到人脸时使用完整画面。
+检测同样在进程池中执行，结果按原图摘要缓存。
+
+工作进程异常退出（例如被OOM杀掉）后进程池会整体损坏，这时丢弃旧进程池、重建并重试一次。
+等待结果有超时（不超过任务剩余的截止时间），超时后主体检测退回完整画面，预处理退回未处理的原图。
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from app.services.clients.lazy import is_available
+
+# 各provider的目标长边像素，可通过环境变量覆盖，例如 TONGYI_INPUT_MAX_SIDE=768
+DEFAULT_MAX_SIDE = {
+    "tongyi": 1024,
+    "gemini": 1024,
+    "vidu": 1024,
+}
+JPEG_QUALITY = int(os.getenv("PREFLIGHT_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("PREFLIGHT_WORKERS", "2"))
+# 单张原图预处理（主体检测 + 各尺寸缩放）最长等待的时间
+PREFLIGHT_TIMEOUT = float(os.getenv("PREFLIGHT_TIMEOUT_SECONDS", "20"))
+# 主体裁剪需要opencv-python-headless（4.x，自带Haar级联模型）
+SUBJECT_CROP = os.getenv("PREFLIGHT_CROP", "1") == "1" and is_available("cv2")
+DETECT_MAX_SIDE = 640  # 检测在缩小后的灰度图上进行
+# 以人脸框的宽/高为单位向四周扩展：左右各1.2倍，向上0.8倍，向下2.5倍（肩膀和上衣）
+CROP_PADDING = (1.2, 0.8, 1.2, 2.5)
+# 裁剪后仍占画面这么大比例时不裁，直接用完整画面
+MAX_CROP_AREA = 0.85
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_subject_cache = OrderedDict()  # 原图摘要 -> 裁剪框（画面比例）或None
+_subject_lock = threading.Lock()
+SUBJECT_CACHE_SIZE = 4096
+subject_stats = {"detections": 0, "cache_hits": 0, "cropped": 0, "full_frame": 0, "errors": 0,
+                 "detect_ms_total": 0.0, "area_ratio_total": 0.0}
+
+_cascades = None
+
+
+def provider_max_side(provider: str) -> int:
+    return int(os.getenv(f"{provider.upper()}_INPUT_MAX_SIDE", DEFAULT_MAX_SIDE.get(provider, 1024)))
+
+
+def _load_cascades():
+    """每个工作进程加载一次正脸和侧脸级联模型"""
+    global _cascades
+    if _cascades is None:
+        import cv2
+
+        # 并行度由进程池控制，每个进程内单线程检测
+        cv2.setNumThreads(1)
+        _cascades = [
+            cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, name))
+            for name in ("haarcascade_frontalface_default.xml", "haarcascade_profileface.xml")
+        ]
+    return _cascades
+
+
+def detect_subject(content: bytes) -> tuple[float, float, float, float]:
+    """检测画面中的人物，返回裁剪框 (left, top, right, bottom)，以画面宽高的比例表示；没找到返回None（在子进程中执行）"""
+    import cv2
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    image = Image.open(BytesIO(content))
+    image.draft("L", (DETECT_MAX_SIDE, DETECT_MAX_SIDE))
+    image = ImageOps.exif_transpose(image).convert("L")
+    image.thumbnail((DETECT_MAX_SIDE, DETECT_MAX_SIDE))
+    gray = cv2.equalizeHist(np.asarray(image))
+    height, width = gray.shape
+    # 主体的脸至少占短边的1/12；不扫描更小的尺度，检测快一倍以上
+    min_face = max(24, min(width, height) // 12)
+
+    faces = []
+    for cascade in _load_cascades():
+        found = cascade.detectMultiScale(gray, scaleFactor=1.15, minNeighbors=5, minSize=(min_face, min_face))
+        faces = [tuple(int(v) for v in face) for face in found]
+        if faces:
+            break
+    if not faces:
+        return None
+
+    # 只保留主体：面积不到最大人脸四分之一的（背景里的路人）忽略
+    largest = max(w * h for _, _, w, h in faces)
+    faces = [face for face in faces if face[2] * face[3] * 4 >= largest]
+    left = min(x for x, _, _, _ in faces)
+    top = min(y for _, y, _, _ in faces)
+    right = max(x + w for x, _, w, _ in faces)
+    bottom = max(y + h for _, y, _, h in faces)
+    face_w = max(w for _, _, w, _ in faces)
+    face_h = max(h for _, _, _, h in faces)
+    pad_left, pad_top, pad_right, pad_bottom = CROP_PADDING
+    box = (
+        max(0.0, (left - pad_left * face_w) / width),
+        max(0.0, (top - pad_top * face_h) / height),
+        min(1.0, (right + pad_right * face_w) / width),
+        min(1.0, (bottom + pad_bottom * face_h) / height),
+    )
+    if (box[2] - box[0]) * (box[3] - box[1]) > MAX_CROP_AREA:
+        return None
+    return box
+
+
+def normalize_image(content: bytes, max_side: int, quality: int = JPEG_QUALITY, crop_box: tuple = None) -> bytes:
+    """应用EXIF方向、去元数据、按crop_box裁剪、缩小到max_side并重新编码为JPEG（在子进程中执行）"""
+    # PIL只在工作进程中需要，不拖慢主进程启动
+    from PIL import Image, ImageOps
+
+    source = Image.open(BytesIO(content))
+    image = ImageOps.exif_transpose(source)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if crop_box is not None:
+        width, height = image.size
+        left, top, right, bottom = crop_box
+        image = image.crop((round(left * width), round(top * height), round(right * width), round(bottom * height)))
+    # thumbnail只缩小不放大，并保持宽高比
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    output = BytesIO()
+    # 不传exif参数即不写入任何元数据
+    image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    data = output.getvalue()
+
+    # 已经足够小、且不带任何元数据的JPEG（例如photo-app压缩过的480p图）直接用原图
+    if (crop_box is None and source.format == "JPEG" and not source.getexif() and max(source.size) <= max_side
+            and len(content) <= len(data)):
+        return content
+    return data
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        return _pool
+
+
+def _discard_pool(broken: ProcessPoolExecutor):
+    """丢弃已损坏的进程池，下次使用时重建"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+            print("⚠️ 图片处理进程池已损坏（工作进程异常退出），重建")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(fn, *args) -> tuple:
+    pool = _get_pool()
+    try:
+        return pool, pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        pool = _get_pool()
+        return pool, pool.submit(fn, *args)
+
+
+def submit(fn, *args):
+    """在图片处理进程池中执行fn（本地卡通化和缩略图也共用这个进程池）"""
+    return _submit(fn, *args)[1]
+
+
+def _result(submitted: tuple, fn, args: tuple, timeout: float):
+    pool, future = submitted
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # 还在排队的直接取消；已经开始的只能让它在工作进程里跑完
+        future.cancel()
+        raise
+    except BrokenProcessPool:
+        # 只重试一次：同一张图再次让工作进程退出时把异常交给调用方
+        _discard_pool(pool)
+        return _submit(fn, *args)[1].result(timeout=timeout)
+
+
+def run(fn, *args, timeout: float = None):
+    """在进程池中执行fn并等待结果；工作进程在执行中退出时重建进程池重试一次，超时抛出TimeoutError"""
+    return _result(_submit(fn, *args), fn, args, timeout)
+
+
+def subject_box(content: bytes, digest: str, timeout: float = None) -> tuple:
+    """原图的主体裁剪框，按摘要缓存；检测失败或超时时返回None（使用完整画面）"""
+    with _subject_lock:
+        if digest in _subject_cache:
+            _subject_cache.move_to_end(digest)
+            subject_stats["cache_hits"] += 1
+            return _subject_cache[digest]
+    started = time.perf_counter()
+    try:
+        box = run(detect_subject, content, timeout=timeout)
+    except FutureTimeoutError:
+        print(f"⚠️ 主体检测超过{timeout:.1f}秒，使用完整画面")
+        with _subject_lock:
+            subject_stats["errors"] += 1
+        return None
+    except Exception as e:
+        print(f"⚠️ 主体检测失败: {e}，使用完整画面")
+        with _subject_lock:
+            subject_stats["errors"] += 1
+        return None
+    with _subject_lock:
+        subject_stats["detections"] += 1
+        subject_stats["detect_ms_total"] += (time.perf_counter() - started) * 1000
+        if box is None:
+            subject_stats["full_frame"] += 1
+        else:
+            subject_stats["cropped"] += 1
+            subject_stats["area_ratio_total"] += (box[2] - box[0]) * (box[3] - box[1])
+        _subject_cache[digest] = box
+        while len(_subject_cache) > SUBJECT_CACHE_SIZE:
+            _subject_cache.popitem(last=False)
+    return box
+
+
+def subject_crop_snapshot() -> dict:
+    with _subject_lock:
+        detections = subject_stats["detections"]
+        return {
+            "enabled": SUBJECT_CROP,
+            "detections": detections,
+            "cache_hits": subject_stats["cache_hits"],
+            "cropped": subject_stats["cropped"],
+            "full_frame": subject_stats["full_frame"],
+            "errors": subject_stats["errors"],
+            "avg_detect_ms": round(subject_stats["detect_ms_total"] / detections, 1) if detections else None,
+            # 裁剪后保留的画面面积比例（只统计裁剪了的图片）
+            "avg_area_ratio": round(subject_stats["area_ratio_total"] / subject_stats["cropped"], 3)
+            if subject_stats["cropped"] else None,
+        }
+
+
+def normalize_for_providers(content: bytes, providers: list[str], store, timeout: float = None) -> dict[str, str]:
+    """为每个provider生成预处理后的图片，返回 {provider: 图片URL}
+
+    store为原图存储后端（本地分片目录或S3）；目标尺寸相同的provider共用一份结果，缓存命中时不再重新处理。
+    timeout为整个预处理最长等待的秒数（默认PREFLIGHT_TIMEOUT），超时抛出TimeoutError，调用方改用原图。
+    """
+    expires_at = time.monotonic() + min(timeout if timeout is not None else PREFLIGHT_TIMEOUT, PREFLIGHT_TIMEOUT)
+
+    def remaining() -> float:
+        return max(0.0, expires_at - time.monotonic())
+
+    digest = hashlib.sha256(content).hexdigest()[:24]
+    sizes = {provider: provider_max_side(provider) for provider in providers}
+    crop_box = subject_box(content, digest, remaining()) if SUBJECT_CROP else None
+    prefix = "norm" if crop_box is None else "crop"
+
+    file_names = {}
+    submitted = {}
+    for max_side in sorted(set(sizes.values())):
+        file_name = f"{prefix}_{digest}_{max_side}.jpg"
+        file_names[max_side] = file_name
+        if not store.exists(file_name):
+            args = (content, max_side, JPEG_QUALITY, crop_box)
+            submitted[max_side] = (_submit(normalize_image, *args), args)
+
+    for max_side, (pair, args) in submitted.items():
+        data = _result(pair, normalize_image, args, remaining())
+        store.save_bytes(file_names[max_side], data, provider="original")
+        cropped = "" if crop_box is None else f"，裁剪到主体（{(crop_box[2] - crop_box[0]) * (crop_box[3] - crop_box[1]):.0%}画面）"
+        print(f"🗜️ 预处理原图: {len(content) // 1024}KB → {len(data) // 1024}KB (长边≤{max_side}{cropped})")
+
+    return {provider: store.url_for(file_names[max_side]) for provider, max_side in sizes.items()}
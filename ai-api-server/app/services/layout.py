@@ -0,0 +1,253 @@
+"""
+按哈希前缀分片的目录布局 + 追加写入的manifest索引
+
+文件不再平铺在一个目录里，而是放到 root/{md5(文件名)前两位}/文件名 下（256个分片）。
+每写入一个文件就向 root/manifest.jsonl 追加一条记录（任务ID、provider、大小、尺寸、创建时间），
+启动时把manifest读入内存，按任务或时间范围查询时不需要遍历目录树。
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from io import BytesIO
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# 迁移旧文件时根据文件名前缀推断provider
+PREFIX_PROVIDERS = {
+    "cartoon_": "tongyi",
+    "gemini_": "gemini",
+    "vidu_": "vidu",
+    "original_": "original",
+    "norm_": "original",
+    "crop_": "original",
+    "local_": "local",
+}
+
+
+def shard_of(file_name: str) -> str:
+    return hashlib.md5(file_name.encode("utf-8")).hexdigest()[:2]
+
+
+def image_dimensions(data: bytes) -> tuple:
+    """只读图片头部获取尺寸，无法识别时返回(None, None)"""
+    try:
+        from PIL import Image
+        with Image.open(BytesIO(data)) as image:
+            return image.size
+    except Exception:
+        return None, None
+
+
+class ShardedStore:
+    """一个分片目录及其manifest索引"""
+
+    def __init__(self, root: str, url_prefix: str):
+        self.root = root
+        self.url_prefix = url_prefix
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.records = {}  # 相对路径 -> 记录
+        self.by_job = {}  # job_id -> [相对路径]
+        self.timeline = []  # [(created_at, 相对路径)]，按时间排序
+        self.listeners = []  # 每登记一条记录后调用 listener(record)，用于增量feed
+        os.makedirs(root, exist_ok=True)
+        self._load_manifest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._apply(record)
+
+    def _apply(self, record: dict):
+        path = record["path"]
+        self._remove(path)
+        if record.get("op") == "delete":
+            return
+        self.records[path] = record
+        bisect.insort(self.timeline, (record["created_at"], path))
+        if record.get("job_id"):
+            self.by_job.setdefault(record["job_id"], []).append(path)
+
+    def _remove(self, path: str):
+        old = self.records.pop(path, None)
+        if old is None:
+            return
+        index = bisect.bisect_left(self.timeline, (old["created_at"], path))
+        if index < len(self.timeline) and self.timeline[index] == (old["created_at"], path):
+            self.timeline.pop(index)
+        if path in self.by_job.get(old.get("job_id"), []):
+            self.by_job[old["job_id"]].remove(path)
+
+    def _append(self, record: dict):
+        with self.lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._apply(record)
+        for listener in self.listeners:
+            try:
+                listener(record)
+            except Exception as e:
+                print(f"⚠️ manifest监听器出错: {e}")
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def relative_path(self, file_name: str) -> str:
+        return f"{shard_of(file_name)}/{file_name}"
+
+    def path_for(self, file_name: str) -> str:
+        return os.path.join(self.root, shard_of(file_name), file_name)
+
+    def url_for(self, file_name: str) -> str:
+        return f"{self.url_prefix}/{self.relative_path(file_name)}"
+
+    def file_name_for_url(self, url: str) -> str:
+        """url指向本目录中的文件时返回文件名，否则返回None"""
+        if not url.startswith(self.url_prefix + "/"):
+            return None
+        return os.path.basename(url.split("?", 1)[0]) or None
+
+    def exists(self, file_name: str) -> bool:
+        return os.path.exists(self.path_for(file_name))
+
+    def save_bytes(self, file_name: str, data: bytes, job_id: str = None, provider: str = None) -> str:
+        """原子写入文件并登记到manifest，返回对外URL"""
+        file_path = self.path_for(file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # 先写临时文件再改名，避免读到写了一半的图片
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+
+        width, height = image_dimensions(data)
+        self.record(file_name, len(data), width, height, job_id=job_id, provider=provider)
+        return self.url_for(file_name)
+
+    def save_stream(self, file_name: str, chunks, job_id: str = None, provider: str = None) -> str:
+        """把分块数据流式写入文件（用于视频等大文件），不在内存中拼接整个文件"""
+        file_path = self.path_for(file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.record(file_name, size, job_id=job_id, provider=provider)
+        return self.url_for(file_name)
+
+    def record(self, file_name: str, size: int, width: int = None, height: int = None,
+               job_id: str = None, provider: str = None):
+        """只向manifest登记文件（文件本身可能存放在其他存储后端）"""
+        self._append({
+            "path": self.relative_path(file_name),
+            "job_id": job_id,
+            "provider": provider,
+            "size": size,
+            "width": width,
+            "height": height,
+            "created_at": time.time(),
+        })
+
+    def mark(self, file_name: str, **fields):
+        """更新一条记录的字段（例如把本地预览标记为最终结果）；记录以当前时间重新登记，移到时间线末尾"""
+        relative = self.relative_path(file_name)
+        with self.lock:
+            record = self.records.get(relative)
+        if record is not None:
+            self._append({**record, **fields, "created_at": time.time()})
+
+    def delete(self, file_path: str):
+        """删除文件并在manifest中登记删除；文件不存在时抛出FileNotFoundError"""
+        os.remove(file_path)
+        self.forget(file_path)
+
+    def forget(self, file_path: str):
+        """文件被外部删除（例如配额清理）后，在manifest中追加删除记录"""
+        relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.root)).replace(os.sep, "/")
+        if relative in self.records:
+            self._append({"op": "delete", "path": relative, "created_at": time.time()})
+
+    def find_by_job(self, job_id: str) -> list[dict]:
+        with self.lock:
+            return [self.records[path] for path in self.by_job.get(job_id, [])]
+
+    def find_between(self, start: float = 0, end: float = None, limit: int = 1000) -> list[dict]:
+        """按创建时间范围查询，结果按时间升序"""
+        with self.lock:
+            left = bisect.bisect_left(self.timeline, (start, ""))
+            right = len(self.timeline) if end is None else bisect.bisect_right(self.timeline, (end, "\uffff"))
+            return [self.records[path] for _, path in self.timeline[left:right][:limit]]
+
+    def find_after(self, created_at: float, path: str = "", limit: int = 100, predicate=None) -> tuple[list[dict], bool]:
+        """按时间线顺序返回 (created_at, path) 之后的记录，最多limit条；第二个返回值表示后面是否还有"""
+        with self.lock:
+            index = bisect.bisect_right(self.timeline, (created_at, path))
+            records = []
+            for _, record_path in self.timeline[index:]:
+                record = self.records[record_path]
+                if predicate is not None and not predicate(record):
+                    continue
+                if len(records) == limit:
+                    return records, True
+                records.append(record)
+            return records, False
+
+    def tail(self, limit: int = 100, predicate=None) -> list[dict]:
+        """时间线上最新的limit条记录（按时间升序）"""
+        with self.lock:
+            records = []
+            for _, record_path in reversed(self.timeline):
+                record = self.records[record_path]
+                if predicate is None or predicate(record):
+                    records.append(record)
+                    if len(records) == limit:
+                        break
+            return records[::-1]
+
+    def migrate_flat_files(self) -> int:
+        """把根目录下平铺的旧文件移动到分片目录并补登manifest，返回迁移的文件数"""
+        moved = 0
+        for entry in sorted(os.scandir(self.root), key=lambda e: e.name):
+            if not entry.is_file() or entry.name == MANIFEST_NAME or entry.name.endswith(".tmp"):
+                continue
+            target = self.path_for(entry.name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(entry.path, target)
+
+            with open(target, "rb") as f:
+                width, height = image_dimensions(f.read())
+            provider = next((p for prefix, p in PREFIX_PROVIDERS.items() if entry.name.startswith(prefix)), None)
+            stat = os.stat(target)
+            self._append({
+                "path": self.relative_path(entry.name),
+                "job_id": None,
+                "provider": provider,
+                "size": stat.st_size,
+                "width": width,
+                "height": height,
+                "created_at": stat.st_mtime,
+                "legacy_path": entry.name,
+            })
+            moved += 1
+        return moved
@@ -0,0 +1,267 @@
+"""
+按需开启的采样profiler
+
+后台线程每隔interval秒对所有线程的Python调用栈（sys._current_frames）采样一次，
+不需要插桩，也不需要重启进程；开启期间的开销约为一次采样耗时 / 采样间隔（结果中的overhead）。
+每个样本带上所属线程名和生成任务ID（任务线程通过 tag_thread 标记），
+结果可以导出为collapsed stacks（flamegraph.pl / speedscope都能直接打开）或speedscope JSON，
+并附带每个线程的墙钟时间拆分：采样到的墙钟时间、线程CPU时间（Linux下读/proc），
+以及据此估算的阻塞等待比例（没有CPU时间时退化为按栈顶函数名判断）。
+"""
+
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+# 线程ident -> 任务ID
+_thread_tags = {}
+
+# 每隔多少次采样读取一次各线程的CPU时间
+CPU_READ_EVERY = 10
+
+# 栈顶函数是这些名字时，认为线程在阻塞等待（锁、IO、sleep）而不是在执行Python代码
+WAITING_FUNCTIONS = {
+    "wait", "wait_for", "sleep", "select", "poll", "epoll", "acquire", "_wait_for_tstate_lock",
+    "recv", "recv_into", "readinto", "read", "accept", "get", "result", "join", "_worker",
+    "connect", "create_connection", "getaddrinfo", "do_handshake", "sendall",
+}
+
+
+def tag_thread(task_id: str = None):
+    """把当前线程的样本标记为属于某个任务（None表示清除）"""
+    ident = threading.get_ident()
+    if task_id is None:
+        _thread_tags.pop(ident, None)
+    else:
+        _thread_tags[ident] = task_id
+
+
+def current_tag() -> str:
+    return _thread_tags.get(threading.get_ident())
+
+
+def _thread_cpu_seconds(native_id: int) -> float:
+    """读取Linux下单个线程的用户态+内核态CPU时间，其他平台返回None"""
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ProfileSession:
+    def __init__(self, interval: float, seconds: float = None, jobs: int = None, max_seconds: float = 600):
+        self.id = uuid.uuid4().hex[:12]
+        self.interval = interval
+        self.seconds = seconds
+        self.jobs = jobs
+        self.max_seconds = max_seconds
+        self.jobs_finished = 0
+        self.stacks = Counter()  # (线程名, 任务ID, 栈帧元组) -> 样本数
+        self.thread_samples = Counter()  # 线程标签 -> 样本数
+        self.thread_waiting = Counter()  # 线程标签 -> 栈顶像是阻塞等待的样本数
+        self.thread_cpu = {}  # 线程标签 -> [首次读到的CPU时间, 最近一次读到的CPU时间]
+        self.tasks = set()  # 采样期间出现过的任务ID
+        self.samples = 0
+        self.sampling_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self._stop = threading.Event()
+
+    # ---------- 采样 ----------
+
+    def start(self):
+        self.started_at = time.time()
+        threading.Thread(target=self._run, name=f"profiler-{self.id}", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def job_finished(self):
+        self.jobs_finished += 1
+        if self.jobs and self.jobs_finished >= self.jobs:
+            self.stop()
+
+    def _read_cpu(self, threads: dict):
+        for ident, (label, native_id) in threads.items():
+            cpu = _thread_cpu_seconds(native_id) if native_id else None
+            if cpu is None:
+                continue
+            if label in self.thread_cpu:
+                self.thread_cpu[label][1] = cpu
+            else:
+                self.thread_cpu[label] = [cpu, cpu]
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = self.started_at + (self.seconds or self.max_seconds)
+        threads = {}
+        while not self._stop.is_set() and time.time() < deadline:
+            started = time.perf_counter()
+            # 线程池里的线程经常同名，用 名字#native_id 区分
+            threads = {
+                thread.ident: (f"{thread.name}#{thread.native_id}", thread.native_id)
+                for thread in threading.enumerate()
+                if thread.ident != own
+            }
+            new_threads = {ident: info for ident, info in threads.items() if info[0] not in self.thread_cpu}
+            self._read_cpu(threads if self.samples % CPU_READ_EVERY == 0 else new_threads)
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                label = threads.get(ident, (f"thread-{ident}#?", None))[0]
+                task_id = _thread_tags.get(ident)
+                if task_id:
+                    self.tasks.add(task_id)
+                self.stacks[(label.rsplit("#", 1)[0], task_id, tuple(stack))] += 1
+                self.thread_samples[label] += 1
+                if stack and stack[-1][0] in WAITING_FUNCTIONS:
+                    self.thread_waiting[label] += 1
+            self.samples += 1
+            self.sampling_seconds += time.perf_counter() - started
+            self._stop.wait(self.interval)
+        self._read_cpu(threads)
+        self.finished_at = time.time()
+        self.done.set()
+
+    # ---------- 导出 ----------
+
+    @staticmethod
+    def _frame_name(frame: tuple) -> str:
+        name, file_name, line = frame
+        return f"{name} ({os.path.basename(file_name)}:{line})"
+
+    def collapsed(self) -> str:
+        """每行一个栈：线程;task:ID;外层帧;...;内层帧 样本数"""
+        lines = []
+        for (thread_name, task_id, stack), count in self.stacks.most_common():
+            parts = [thread_name.replace(";", ":")]
+            if task_id:
+                parts.append(f"task:{task_id}")
+            parts.extend(self._frame_name(frame).replace(";", ":") for frame in stack)
+            lines.append(f"{';'.join(parts)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict:
+        """speedscope文件格式：每个线程一个sampled profile，任务ID作为最外层的伪帧"""
+        frames = []
+        frame_index = {}
+
+        def index_of(key: tuple, name: str, file_name: str = None, line: int = None) -> int:
+            if key not in frame_index:
+                frame_index[key] = len(frames)
+                frame = {"name": name}
+                if file_name:
+                    frame.update(file=file_name, line=line)
+                frames.append(frame)
+            return frame_index[key]
+
+        profiles = {}
+        for (thread_name, task_id, stack), count in self.stacks.items():
+            sample = []
+            if task_id:
+                sample.append(index_of(("task", task_id), f"task:{task_id}"))
+            sample.extend(index_of(frame, frame[0], frame[1], frame[2]) for frame in stack)
+            profile = profiles.setdefault(thread_name, {"samples": [], "weights": []})
+            profile["samples"].append(sample)
+            profile["weights"].append(count * self.interval)
+
+        duration = (self.finished_at or time.time()) - self.started_at
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"ai-api-server profile {self.id}",
+            "exporter": "gosim-wonderland ai-api-server",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": duration,
+                    "samples": profile["samples"],
+                    "weights": profile["weights"],
+                }
+                for thread_name, profile in sorted(profiles.items())
+            ],
+        }
+
+    def threads(self) -> dict:
+        """每个线程的墙钟时间拆分：采样到的时长、消耗的CPU时间、阻塞等待的比例"""
+        breakdown = {}
+        for label, samples in self.thread_samples.most_common():
+            wall = samples * self.interval
+            cpu = None
+            if label in self.thread_cpu:
+                first, last = self.thread_cpu[label]
+                cpu = last - first
+            if cpu is not None and wall:
+                waiting = max(0.0, 1 - cpu / wall)
+            else:
+                waiting = self.thread_waiting[label] / samples
+            breakdown[label] = {
+                "samples": samples,
+                "wall_seconds": round(wall, 3),
+                "cpu_seconds": None if cpu is None else round(cpu, 3),
+                "waiting_ratio": round(waiting, 3),
+            }
+        return breakdown
+
+    def summary(self) -> dict:
+        duration = (self.finished_at or time.time()) - self.started_at
+        return {
+            "profile_id": self.id,
+            "running": not self.done.is_set(),
+            "interval_ms": self.interval * 1000,
+            "seconds": self.seconds,
+            "jobs": self.jobs,
+            "jobs_finished": self.jobs_finished,
+            "duration_seconds": round(duration, 3),
+            "samples": self.samples,
+            # 采样线程自身占用的时间比例
+            "overhead": round(self.sampling_seconds / duration, 4) if duration else None,
+            "tasks": sorted(self.tasks),
+        }
+
+
+class Profiler:
+    """同一时间只允许一个采样会话；保留最近完成的会话供查询"""
+
+    def __init__(self, keep: int = 5):
+        self.lock = threading.Lock()
+        self.active = None
+        self.sessions = {}
+        self.keep = keep
+
+    def start(self, interval: float, seconds: float = None, jobs: int = None, max_seconds: float = 600) -> ProfileSession:
+        with self.lock:
+            if self.active is not None and not self.active.done.is_set():
+                raise RuntimeError(f"已有采样会话在运行: {self.active.id}")
+            session = ProfileSession(interval, seconds=seconds, jobs=jobs, max_seconds=max_seconds)
+            self.active = session
+            self.sessions[session.id] = session
+            while len(self.sessions) > self.keep:
+                self.sessions.pop(next(iter(self.sessions)))
+        session.start()
+        return session
+
+    def get(self, profile_id: str) -> ProfileSession:
+        with self.lock:
+            return self.sessions.get(profile_id)
+
+    def job_finished(self):
+        """生成任务结束时调用，按任务数采样的会话据此停止"""
+        session = self.active
+        if session is not None and not session.done.is_set():
+            session.job_finished()
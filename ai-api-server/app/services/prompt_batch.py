@@ -0,0 +1,142 @@
+"""
+prompt优化的微批处理
+
+突发流量下每个任务各发一次Gemini请求，请求本身的开销和限流额度都被浪费。
+这里把window秒内（或凑满max_batch个）到达的prompt合并成一次调用，要求模型返回同样长度的JSON数组，
+再把结果分发给各自等待的任务；同一批中相同的prompt只发送一次。
+批量调用失败或返回格式不对时，这一批退回逐个调用，不影响任务拿到结果。
+"""
+
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class _PendingPrompt:
+    def __init__(self, prompt: str, key: str):
+        self.prompt = prompt
+        self.key = key
+        self.enqueued_at = time.perf_counter()
+        self.future = Future()
+
+
+class PromptBatcher:
+    """收集短时间窗口内的prompt，合并成一次批量调用"""
+
+    def __init__(self, batch_fn: Callable[[list[str], str], list[str]], single_fn: Callable[[str, str], str],
+                 window: float = 0.05, max_batch: int = 16, workers: int = 4):
+        self.batch_fn = batch_fn  # (prompts, key) -> 同样长度的结果列表，失败时抛异常
+        self.single_fn = single_fn  # (prompt, key) -> 结果，自行处理失败
+        self.window = window
+        self.max_batch = max_batch
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prompt-batch")
+        self._thread = None
+        self.stats = {
+            "batches": 0, "prompts": 0, "deduplicated": 0, "batch_failures": 0, "fallback_calls": 0,
+            "batch_calls": 0, "batch_call_ms_total": 0.0,
+        }
+        self.batch_sizes = Counter()
+        self.waits_ms = deque(maxlen=1000)  # 从提交到发出请求的等待时间
+
+    def submit(self, prompt: str, key: str) -> Future:
+        item = _PendingPrompt(prompt, key)
+        with self.cond:
+            self.queue.append(item)
+            self.cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect_loop, name="prompt-batcher", daemon=True)
+                self._thread.start()
+        return item.future
+
+    def _collect_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue)
+                # 窗口从这一批第一个prompt到达时开始计时
+                close_at = self.queue[0].enqueued_at + self.window
+                while len(self.queue) < self.max_batch:
+                    remaining = close_at - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                key = self.queue[0].key
+                batch = []
+                rest = deque()
+                while self.queue and len(batch) < self.max_batch:
+                    item = self.queue.popleft()
+                    (batch if item.key == key else rest).append(item)
+                self.queue.extendleft(reversed(rest))
+            self.executor.submit(self._execute, batch)
+
+    def _execute(self, batch: list[_PendingPrompt]):
+        # 任务已经放弃等待（例如复用了近似重复的结果）的prompt不再发送
+        batch = [item for item in batch if item.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        now = time.perf_counter()
+        prompts = list(dict.fromkeys(item.prompt for item in batch))
+        with self.cond:
+            self.stats["batches"] += 1
+            self.stats["prompts"] += len(batch)
+            self.stats["deduplicated"] += len(batch) - len(prompts)
+            self.batch_sizes[len(batch)] += 1
+            self.waits_ms.extend((now - item.enqueued_at) * 1000 for item in batch)
+
+        if len(prompts) == 1:
+            self._run_single(prompts[0], batch[0].key, batch)
+            return
+        started = time.perf_counter()
+        try:
+            results = self.batch_fn(prompts, batch[0].key)
+            if len(results) != len(prompts):
+                raise ValueError(f"批量结果数量不匹配: 期望{len(prompts)}个，实际{len(results)}个")
+        except Exception as e:
+            print(f"⚠️ 批量prompt优化失败（{len(prompts)}个）: {e}，逐个重试")
+            with self.cond:
+                self.stats["batch_failures"] += 1
+                self.stats["fallback_calls"] += len(prompts)
+            for prompt in prompts:
+                self.executor.submit(self._run_single, prompt, batch[0].key, [i for i in batch if i.prompt == prompt])
+            return
+        with self.cond:
+            self.stats["batch_calls"] += 1
+            self.stats["batch_call_ms_total"] += (time.perf_counter() - started) * 1000
+        optimized = dict(zip(prompts, results))
+        for item in batch:
+            item.future.set_result(optimized[item.prompt])
+
+    def _run_single(self, prompt: str, key: str, items: list[_PendingPrompt]):
+        try:
+            result = self.single_fn(prompt, key)
+        except Exception as e:
+            for item in items:
+                item.future.set_exception(e)
+            return
+        for item in items:
+            item.future.set_result(result)
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            waits = sorted(self.waits_ms)
+            batches = self.stats["batches"]
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "queued": len(self.queue),
+                "batches": batches,
+                "prompts": self.stats["prompts"],
+                "deduplicated": self.stats["deduplicated"],
+                "avg_batch_size": round(self.stats["prompts"] / batches, 2) if batches else None,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "batch_failures": self.stats["batch_failures"],
+                "fallback_calls": self.stats["fallback_calls"],
+                "avg_batch_call_ms": round(self.stats["batch_call_ms_total"] / self.stats["batch_calls"], 1)
+                if self.stats["batch_calls"] else None,
+                "avg_wait_ms": round(sum(waits) / len(waits), 2) if waits else None,
+                "p95_wait_ms": round(waits[int(len(waits) * 0.95)], 2) if waits else None,
+                "max_wait_ms": round(waits[-1], 2) if waits else None,
+            }
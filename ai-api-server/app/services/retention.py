@@ -0,0 +1,164 @@
+"""
+磁盘配额与过期清理
+
+为每个受管目录配置字节配额和最长保留时间，后台线程定期扫描：
+先删除超过保留时间未被访问的文件，再按访问时间从旧到新（LRU）删除，直到用量回落到配额的低水位。
+正在执行的任务引用的文件始终受保护。
+
+文件不在本地磁盘上的目录（例如S3原图存储）通过entries_fn列出文件、delete_fn删除，按同样的策略清理。
+"""
+
+import os
+import threading
+import time
+from typing import Callable
+
+
+class RetentionPolicy:
+    def __init__(self, name: str, path: str, max_bytes: int = 0, max_age: float = 0, low_watermark: float = 0.9,
+                 skip_names: tuple = (), on_evict: Callable[[str], None] = None,
+                 entries_fn: Callable[[], list] = None, delete_fn: Callable[[str], None] = None):
+        self.name = name
+        self.path = path
+        self.max_bytes = max_bytes  # 0表示不限制容量
+        self.max_age = max_age  # 秒，超过这么久未被访问即删除，0表示不按时间清理
+        self.low_watermark = low_watermark
+        self.skip_names = set(skip_names)  # 永不清理的文件名（例如manifest）
+        self.on_evict = on_evict  # 文件被删除后的回调
+        self.entries_fn = entries_fn  # 返回 [(路径, 大小, 修改时间)]，None表示扫描path目录
+        self.delete_fn = delete_fn  # 删除一个文件，None表示os.remove
+
+
+class RetentionManager:
+    """按目录执行配额/过期策略，维护访问时间索引"""
+
+    def __init__(self, policies: list[RetentionPolicy], protected_fn: Callable[[], set] = lambda: set(), interval: float = 60):
+        self.policies = policies
+        self.protected_fn = protected_fn
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.access_times = {}  # 绝对路径 -> 最近访问时间
+        self.stats = {
+            policy.name: {"evicted_files": 0, "reclaimed_bytes": 0, "used_bytes": 0, "file_count": 0}
+            for policy in policies
+        }
+        self.last_run = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, path: str):
+        """记录一次访问（缓存命中、被任务使用时调用）"""
+        with self.lock:
+            self.access_times[os.path.abspath(path)] = time.time()
+
+    def _scan(self, root: str, skip_names: set = frozenset()) -> list[tuple[str, int, float, float]]:
+        """返回 [(路径, 大小, 修改时间, 最近访问时间)]"""
+        entries = []
+        for dirpath, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if file_name in skip_names:
+                    continue
+                path = os.path.join(dirpath, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                abs_path = os.path.abspath(path)
+                # 很多磁盘以noatime挂载，索引中没有记录时退回mtime
+                accessed = self.access_times.get(abs_path, max(stat.st_atime, stat.st_mtime))
+                entries.append((abs_path, stat.st_size, stat.st_mtime, accessed))
+        return entries
+
+    def _listed(self, policy: RetentionPolicy) -> list[tuple[str, int, float, float]]:
+        entries = []
+        for path, size, modified in policy.entries_fn():
+            abs_path = os.path.abspath(path)
+            entries.append((abs_path, size, modified, self.access_times.get(abs_path, modified)))
+        return entries
+
+    def _evict(self, policy: RetentionPolicy, path: str, size: int) -> bool:
+        try:
+            (policy.delete_fn or os.remove)(path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"⚠️ 清理文件失败 {path}: {e}")
+            return False
+        with self.lock:
+            self.access_times.pop(path, None)
+            stats = self.stats[policy.name]
+            stats["evicted_files"] += 1
+            stats["reclaimed_bytes"] += size
+        if policy.on_evict is not None:
+            policy.on_evict(path)
+        return True
+
+    def enforce(self, policy: RetentionPolicy):
+        if policy.entries_fn is None and not os.path.isdir(policy.path):
+            return
+        protected = {os.path.basename(name) for name in self.protected_fn()}
+        now = time.time()
+        entries = self._listed(policy) if policy.entries_fn else self._scan(policy.path, policy.skip_names)
+        used = sum(size for _, size, _, _ in entries)
+        remaining = len(entries)
+        kept = []
+
+        for path, size, modified, accessed in entries:
+            if os.path.basename(path) in protected:
+                continue
+            if policy.max_age and now - accessed > policy.max_age:
+                if self._evict(policy, path, size):
+                    used -= size
+                    remaining -= 1
+                continue
+            kept.append((accessed, path, size))
+
+        if policy.max_bytes and used > policy.max_bytes:
+            target = policy.max_bytes * policy.low_watermark
+            for accessed, path, size in sorted(kept):
+                if used <= target:
+                    break
+                if self._evict(policy, path, size):
+                    used -= size
+                    remaining -= 1
+
+        with self.lock:
+            self.stats[policy.name]["used_bytes"] = used
+            self.stats[policy.name]["file_count"] = remaining
+
+    def run_once(self):
+        for policy in self.policies:
+            try:
+                self.enforce(policy)
+            except Exception as e:
+                print(f"⚠️ 目录清理失败 {policy.name}: {e}")
+        self.last_run = time.time()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                self.run_once()
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=loop, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "last_run": self.last_run,
+                "directories": {
+                    policy.name: {
+                        **self.stats[policy.name],
+                        "max_bytes": policy.max_bytes,
+                        "max_age_seconds": policy.max_age,
+                    }
+                    for policy in self.policies
+                },
+            }
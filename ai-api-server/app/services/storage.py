@@ -0,0 +1,137 @@
+"""
+原图存储后端
+
+local: 写入本地分片目录（ShardedStore），provider通过8080端口的静态服务拉取。
+s3:    写入S3兼容的对象存储（AWS S3 / MinIO / OSS等），provider通过预签名GET URL直接拉取，
+       AI服务器不再充当带宽中转。大文件自动走multipart上传。
+
+两种后端对外接口一致：save_bytes / exists / url_for / path_for / file_name_for_url / delete / forget /
+find_by_job / find_between。S3后端的对象不在本地磁盘上，配额清理按manifest列出对象（entries），删除时同时删除远端对象。
+"""
+
+import os
+from io import BytesIO
+from urllib.parse import unquote, urlparse
+
+from app.services.clients.lazy import load
+from app.services.layout import ShardedStore, image_dimensions
+
+
+class S3Storage:
+    """S3兼容对象存储后端，manifest仍然记录在本地索引中"""
+
+    def __init__(self, bucket: str, index: ShardedStore, key_prefix: str = "", endpoint_url: str = None,
+                 region: str = None, access_key: str = None, secret_key: str = None,
+                 presign_expires: int = 3600, multipart_threshold: int = 8 * 1024 * 1024):
+        boto3 = load("boto3")
+        botocore_config = load("botocore.config")
+        transfer = load("boto3.s3.transfer")
+
+        self.bucket = bucket
+        self.index = index
+        self.key_prefix = key_prefix.strip("/")
+        self.presign_expires = presign_expires
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            # MinIO等自建服务通常不支持虚拟主机风格的bucket域名
+            config=botocore_config.Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        )
+        self.transfer_config = transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+        )
+
+    def key_for(self, file_name: str) -> str:
+        relative = self.index.relative_path(file_name)
+        return f"{self.key_prefix}/{relative}" if self.key_prefix else relative
+
+    def path_for(self, file_name: str) -> str:
+        """对象在本地布局下对应的路径（不存在于磁盘上），用于配额清理记录访问时间和删除"""
+        return self.index.path_for(file_name)
+
+    def exists(self, file_name: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key_for(file_name))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def save_bytes(self, file_name: str, data: bytes, job_id: str = None, provider: str = None) -> str:
+        """上传对象（超过阈值时自动分片上传）并登记manifest，返回预签名GET URL"""
+        self.client.upload_fileobj(
+            BytesIO(data), self.bucket, self.key_for(file_name),
+            ExtraArgs={"ContentType": "image/jpeg" if file_name.endswith(".jpg") else "image/png"},
+            Config=self.transfer_config,
+        )
+        width, height = image_dimensions(data)
+        self.index.record(file_name, len(data), width, height, job_id=job_id, provider=provider)
+        return self.url_for(file_name)
+
+    def url_for(self, file_name: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.key_for(file_name)},
+            ExpiresIn=self.presign_expires,
+        )
+
+    def file_name_for_url(self, url: str) -> str:
+        """url是本bucket中对象的（预签名）URL时返回文件名，否则返回None"""
+        path = unquote(urlparse(url).path)
+        file_name = os.path.basename(path)
+        if not file_name or not path.endswith("/" + self.key_for(file_name)):
+            return None
+        return file_name
+
+    def entries(self) -> list[tuple[str, int, float]]:
+        """manifest中登记的所有对象：[(本地布局下的路径, 大小, 创建时间)]"""
+        with self.index.lock:
+            return [
+                (os.path.join(self.index.root, record["path"]), record.get("size") or 0, record["created_at"])
+                for record in self.index.records.values()
+            ]
+
+    def delete(self, file_path: str):
+        """删除远端对象并在manifest中登记删除，file_path为path_for返回的路径"""
+        file_name = os.path.basename(file_path)
+        self.client.delete_object(Bucket=self.bucket, Key=self.key_for(file_name))
+        self.index.forget(self.index.path_for(file_name))
+
+    def forget(self, file_path: str):
+        self.index.forget(file_path)
+
+    def find_by_job(self, job_id: str) -> list[dict]:
+        return self.index.find_by_job(job_id)
+
+    def find_between(self, start: float = 0, end: float = None, limit: int = 1000) -> list[dict]:
+        return self.index.find_between(start, end, limit)
+
+
+def create_original_storage(root: str, public_url: str):
+    """根据STORAGE_BACKEND环境变量创建原图存储后端，默认local"""
+    index = ShardedStore(root, public_url)
+    backend = os.getenv("STORAGE_BACKEND", "local")
+    if backend == "local":
+        return index
+    if backend == "s3":
+        bucket = os.getenv("S3_BUCKET")
+        if not bucket:
+            raise ValueError("STORAGE_BACKEND=s3 需要配置 S3_BUCKET")
+        print(f"🪣 原图存储使用S3兼容后端: {os.getenv('S3_ENDPOINT_URL', 'AWS')}/{bucket}")
+        return S3Storage(
+            bucket,
+            index,
+            key_prefix=os.getenv("S3_KEY_PREFIX", "original-photos"),
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            region=os.getenv("S3_REGION"),
+            access_key=os.getenv("S3_ACCESS_KEY_ID"),
+            secret_key=os.getenv("S3_SECRET_ACCESS_KEY"),
+            presign_expires=int(os.getenv("S3_PRESIGN_EXPIRES", "3600")),
+            multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8")) * 1024 * 1024,
+        )
+    raise ValueError(f"未知的STORAGE_BACKEND: {backend}")
@@ -0,0 +1,133 @@
+"""
+provider输出图片的快速校验
+
+provider偶尔返回空白、几乎纯色或只解码出一半的图片，原来都算作成功，要等管理员手动拒绝后从头重新生成。
+保存之前先做几项检查，没通过的输出当作本次尝试失败，立即进入同一任务的下一次尝试：
+
+- 解码完整性：完整解码一遍，截断的PNG/JPEG会在这里报错；底部是解码器填充的均匀灰色条带也算截断
+- 尺寸：短边太小、宽高比过于极端、文件小到不可能是正常图片
+- 内容：在缩小到约256像素的灰度图上计算标准差、64级直方图的熵，以及最多的一级亮度占多少像素
+
+统计全部是NumPy的整体运算，除解码外每张图不到1毫秒。阈值可以配置，拒绝原因按类别计数。
+"""
+
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+
+STATS_MAX_SIDE = 256
+HISTOGRAM_BINS = 64
+TRUNCATED_BAND = 0.08  # 检查底部这个比例的行是否是解码器填充的灰色
+
+
+class OutputRejected(Exception):
+    """输出图片没有通过校验；reason为拒绝原因的类别"""
+
+    def __init__(self, reason: str, detail: str = ""):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+
+
+class OutputValidator:
+    def __init__(self, enabled: bool = True, min_bytes: int = 2048, min_side: int = 256, max_aspect: float = 2.5,
+                 min_std: float = 4.0, min_entropy: float = 2.0, max_dominant: float = 0.95):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.min_side = min_side
+        self.max_aspect = max_aspect
+        self.min_std = min_std  # 灰度标准差（0~255）
+        self.min_entropy = min_entropy  # 64级亮度直方图的熵（bit），纯色图为0
+        self.max_dominant = max_dominant  # 最多的一级亮度占全部像素的比例
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.rejected = Counter()
+        self.check_ms_total = 0.0
+        self.max_check_ms = 0.0
+
+    def inspect(self, data: bytes) -> dict:
+        """解码并计算统计量；无法完整解码时抛出OutputRejected"""
+        import numpy as np
+        from PIL import Image
+
+        if len(data) < self.min_bytes:
+            raise OutputRejected("too_small", f"{len(data)}字节")
+        try:
+            image = Image.open(BytesIO(data))
+            image.load()
+        except Exception as e:
+            raise OutputRejected("decode_failed", str(e)[:200])
+
+        width, height = image.size
+        # reduce是整数倍的盒式缩小，比resize快得多
+        factor = max(1, max(width, height) // STATS_MAX_SIDE)
+        gray = np.asarray((image.reduce(factor) if factor > 1 else image).convert("L"), dtype=np.uint8)
+        histogram = np.bincount(gray.ravel() >> 2, minlength=HISTOGRAM_BINS) / gray.size
+        nonzero = histogram[histogram > 0]
+        band = gray[-max(1, int(gray.shape[0] * TRUNCATED_BAND)):]
+        return {
+            "width": width,
+            "height": height,
+            "std": float(gray.std()),
+            "entropy": float(-(nonzero * np.log2(nonzero)).sum()),
+            "dominant": float(histogram.max()),
+            "band_std": float(band.std()),
+            "band_mean": float(band.mean()),
+        }
+
+    def _reason(self, stats: dict) -> tuple:
+        width, height = stats["width"], stats["height"]
+        if min(width, height) < self.min_side:
+            return "too_small", f"{width}×{height}"
+        if max(width, height) / min(width, height) > self.max_aspect:
+            return "bad_aspect", f"{width}×{height}"
+        if stats["std"] < self.min_std:
+            return "blank", f"标准差{stats['std']:.1f}"
+        if stats["entropy"] < self.min_entropy:
+            return "low_entropy", f"熵{stats['entropy']:.2f}bit"
+        if stats["dominant"] > self.max_dominant:
+            return "near_uniform", f"{stats['dominant']:.0%}像素为同一亮度"
+        # 截断的JPEG在宽容模式下解码时，缺失部分被填成均匀的中灰色
+        if stats["band_std"] < 0.5 and abs(stats["band_mean"] - 128) < 2:
+            return "truncated", "底部为均匀灰色"
+        return None, None
+
+    def check(self, data: bytes) -> dict:
+        """校验一张输出图片，没通过时抛出OutputRejected；返回统计量"""
+        if not self.enabled:
+            return {}
+        started = time.perf_counter()
+        try:
+            stats = self.inspect(data)
+            reason, detail = self._reason(stats)
+            if reason is not None:
+                raise OutputRejected(reason, detail)
+        except OutputRejected as e:
+            self._record(started, e.reason)
+            raise
+        self._record(started, None)
+        return stats
+
+    def _record(self, started: float, reason: str):
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.checked += 1
+            self.check_ms_total += elapsed
+            self.max_check_ms = max(self.max_check_ms, elapsed)
+            if reason is not None:
+                self.rejected[reason] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "checked": self.checked,
+                "rejected": sum(self.rejected.values()),
+                "reasons": dict(self.rejected.most_common()),
+                "avg_check_ms": round(self.check_ms_total / self.checked, 2) if self.checked else None,
+                "max_check_ms": round(self.max_check_ms, 2),
+                "thresholds": {
+                    "min_bytes": self.min_bytes, "min_side": self.min_side, "max_aspect": self.max_aspect,
+                    "min_std": self.min_std, "min_entropy": self.min_entropy, "max_dominant": self.max_dominant,
+                },
+            }
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+批量重新生成脚本
+把original-photos中积压的原图提交到AI服务器的批量接口，逐条打印结果。
+
+用法:
+    # 重跑目录下所有原图
+    python3 batch_reprocess.py ../original-photos
+    # 从photo-app数据库中取出pending/failed的照片重跑，并回写结果
+    python3 batch_reprocess.py --from-db ../photo-app/data/wonderland.db
+    # 中断后用同样的命令（或同一个--batch-id）重新运行即可续跑
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+import requests
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def collect_items_from_paths(paths: list[str], prompt: str) -> list[dict]:
+    """从文件、目录或文件列表（每行一个文件名）中收集条目"""
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.extend(
+                name for name in sorted(os.listdir(path))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif path.lower().endswith(IMAGE_EXTENSIONS):
+            file_names.append(os.path.basename(path))
+        elif os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                file_names.extend(os.path.basename(line.strip()) for line in f if line.strip())
+        else:
+            print(f"⚠️ 跳过无法识别的路径: {path}")
+    return [{"id": name, "original_file": name, "prompt": prompt} for name in file_names]
+
+
+def collect_items_from_db(db_path: str, statuses: list[str], prompt: str) -> list[dict]:
+    """从photo-app数据库中取出指定状态的照片"""
+    conn = sqlite3.connect(db_path)
+    try:
+        placeholders = ",".join("?" for _ in statuses)
+        rows = conn.execute(
+            f"SELECT id, original_url, caption FROM photos WHERE status IN ({placeholders}) ORDER BY created_at",
+            statuses,
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {"id": photo_id, "original_file": os.path.basename(original_url), "prompt": caption or prompt}
+        for photo_id, original_url, caption in rows
+    ]
+
+
+def update_db(db_path: str, photo_id: str, record: dict):
+    """把生成结果回写到photo-app数据库"""
+    conn = sqlite3.connect(db_path)
+    try:
+        if record["status"] == "success" and record.get("image_paths"):
+            conn.execute(
+                "UPDATE photos SET cartoon_url = ?, status = 'completed', processing_error = NULL WHERE id = ?",
+                (record["image_paths"][0], photo_id),
+            )
+        elif record["status"] == "failed":
+            conn.execute(
+                "UPDATE photos SET status = 'failed', processing_error = ? WHERE id = ?",
+                ("AI生成失败", photo_id),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量重新生成卡通图片（支持断点续跑）")
+    parser.add_argument("paths", nargs="*", help="原图文件、目录或文件列表")
+    parser.add_argument("--from-db", help="photo-app数据库路径，重跑其中pending/failed的照片")
+    parser.add_argument("--statuses", default="pending,failed", help="配合--from-db使用的状态列表")
+    parser.add_argument("--server", default="http://127.0.0.1:8000", help="AI服务器地址")
+    parser.add_argument("--batch-id", help="批量任务ID，默认由条目列表推导")
+    parser.add_argument("--concurrency", type=int, default=4, help="最大并发数")
+    parser.add_argument("--prompt", default="", help="没有caption时使用的prompt")
+    args = parser.parse_args()
+
+    items = collect_items_from_paths(args.paths, args.prompt)
+    if args.from_db:
+        items += collect_items_from_db(args.from_db, args.statuses.split(","), args.prompt)
+    if not items:
+        print("❌ 没有需要处理的照片")
+        sys.exit(1)
+
+    payload = {"items": items, "concurrency": args.concurrency}
+    if args.batch_id:
+        payload["batch_id"] = args.batch_id
+
+    print(f"📦 提交 {len(items)} 张照片到 {args.server}")
+    with requests.post(f"{args.server}/batch/generate-images/", json=payload, stream=True, timeout=(10, None)) as response:
+        if response.status_code != 200:
+            print(f"❌ 提交失败: {response.status_code} - {response.text[:200]}")
+            sys.exit(1)
+
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["type"] == "start":
+                print(f"🚀 batch_id: {event['batch_id']}（中断后使用 --batch-id {event['batch_id']} 续跑）")
+            elif event["type"] == "item":
+                icon = {"success": "✅", "skipped": "⏭️", "failed": "❌"}[event["status"]]
+                detail = event.get("image_paths") or event.get("error", "")
+                print(f"{icon} {event['key']}: {detail}")
+                if args.from_db and event["status"] != "skipped":
+                    update_db(args.from_db, event["key"], event)
+            elif event["type"] == "done":
+                print(f"🏁 完成: 成功 {event['success']}，失败 {event['failed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+生成任务表现报告
+读取AI服务器写入的事件日志（../event-log，Parquet），统计任意时间范围内的
+端到端延迟分位数、几次尝试成功、各provider的成功占比和耗时、重试等待占用的时间。
+
+用法:
+    python3 event_report.py                                   # 全部事件
+    python3 event_report.py --last 6h                         # 最近6小时
+    python3 event_report.py --since "2026-10-19 09:00" --until "2026-10-19 18:00"
+    python3 event_report.py --last 1d --json > report.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+from app.services.events import load_events, summarize
+
+UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value: str) -> float:
+    """接受 "2026-10-19 09:00"、"2026-10-19T09:00:00" 或Unix时间戳"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def parse_duration(value: str) -> float:
+    if value[-1] in UNITS:
+        return float(value[:-1]) * UNITS[value[-1]]
+    return float(value)
+
+
+def format_percentiles(stats: dict) -> str:
+    if not stats:
+        return "-"
+    return (f"p50 {stats['p50'] / 1000:.1f}s  p90 {stats['p90'] / 1000:.1f}s  "
+            f"p95 {stats['p95'] / 1000:.1f}s  p99 {stats['p99'] / 1000:.1f}s  max {stats['max'] / 1000:.1f}s  (n={stats['count']})")
+
+
+def print_report(report: dict, since: float, until: float):
+    window = " ~ ".join(
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(t)) if t else "…" for t in (since, until)
+    )
+    print(f"📊 时间范围: {window}")
+    print(f"任务 {report['jobs']} 个，尝试 {report['attempts']} 次，成功率 {report['success_rate'] or 0:.1%}")
+    print(f"状态: {', '.join(f'{k} {v}' for k, v in report['status'].items()) or '-'}")
+    print()
+    print(f"端到端延迟（成功）: {format_percentiles(report['latency_ms']['success'])}")
+    print(f"端到端延迟（全部）: {format_percentiles(report['latency_ms']['all'])}")
+    print(f"等待prompt优化:     {format_percentiles(report['prompt_wait_ms'])}")
+    sleep = report["sleep"]
+    if sleep["share_of_job_time"] is not None:
+        print(f"重试等待: 共 {sleep['total_seconds']}s，占任务总时长 {sleep['share_of_job_time']:.1%}")
+    print()
+    print("几次尝试成功: " + (", ".join(f"第{k}次 {v}" for k, v in sorted(report["attempts_to_success"].items())) or "-"))
+    print("成功的prompt变体: " + (", ".join(f"#{k} {v}" for k, v in sorted(report["prompt_variant_success"].items())) or "-"))
+    print("成功provider占比: " + (", ".join(f"{k} {v:.1%}" for k, v in report["provider_share"].items()) or "-"))
+    print()
+    print(f"{'provider':<10}{'尝试':>6}{'成功率':>8}  单次耗时")
+    for provider, stats in report["providers"].items():
+        print(f"{provider:<10}{stats['attempts']:>6}{stats['success_rate']:>8.1%}  {format_percentiles(stats['latency_ms'])}")
+        if stats["error_kinds"]:
+            print(f"{'':<16}失败类别: {', '.join(f'{k} {v}' for k, v in stats['error_kinds'].items())}")
+        for error, count in stats["top_errors"].items():
+            print(f"{'':<16}✗ {count} × {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成任务表现报告")
+    parser.add_argument("--dir", default="../event-log", help="事件日志目录")
+    parser.add_argument("--since", help="开始时间（含）")
+    parser.add_argument("--until", help="结束时间（不含）")
+    parser.add_argument("--last", help="最近一段时间，例如 30m、6h、2d")
+    parser.add_argument("--json", action="store_true", help="输出JSON")
+    args = parser.parse_args()
+
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    if args.last:
+        since = (until or time.time()) - parse_duration(args.last)
+
+    table = load_events(args.dir, since, until)
+    if table.num_rows == 0:
+        print("⚠️ 时间范围内没有事件", file=sys.stderr)
+    report = summarize(table)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, since, until)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+目录布局迁移脚本
+把 ai-photos 和 original-photos-cache 中平铺的旧文件移动到哈希分片目录，并补登manifest。
+迁移前请先停止AI服务器。
+
+用法:
+    python3 migrate_layout.py
+    # 同时把数据库中的cartoon_url改写为新路径（可以指定多个数据库）
+    python3 migrate_layout.py --db ../photo-app/data/wonderland.db --db ../display-app/data/wonderland.db
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.layout import ShardedStore  # noqa: E402
+
+AI_PHOTOS_DIR = "../ai-photos"
+ORIGINAL_PHOTOS_DIR = "../original-photos-cache"
+
+
+def rewrite_db_urls(db_path: str, store: ShardedStore) -> int:
+    """把 /ai-photos/{文件名} 形式的cartoon_url改写为分片路径"""
+    conn = sqlite3.connect(db_path)
+    updated = 0
+    try:
+        rows = conn.execute("SELECT id, cartoon_url FROM photos WHERE cartoon_url LIKE '/ai-photos/%'").fetchall()
+        for photo_id, cartoon_url in rows:
+            file_name = cartoon_url[len("/ai-photos/"):]
+            if "/" in file_name:
+                continue  # 已经是分片路径
+            conn.execute("UPDATE photos SET cartoon_url = ? WHERE id = ?", (store.url_for(file_name), photo_id))
+            updated += 1
+        conn.commit()
+    finally:
+        conn.close()
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把平铺的图片目录迁移为分片布局")
+    parser.add_argument("--db", action="append", default=[], help="需要改写cartoon_url的数据库")
+    args = parser.parse_args()
+    db_paths = [os.path.abspath(path) for path in args.db]
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    ai_photos_store = ShardedStore(AI_PHOTOS_DIR, "/ai-photos")
+    original_cache_store = ShardedStore(ORIGINAL_PHOTOS_DIR, "")
+
+    print(f"📦 ai-photos: 迁移 {ai_photos_store.migrate_flat_files()} 个文件")
+    print(f"📦 original-photos-cache: 迁移 {original_cache_store.migrate_flat_files()} 个文件")
+
+    for db_path in db_paths:
+        if not os.path.exists(db_path):
+            print(f"⚠️ 数据库不存在: {db_path}")
+            continue
+        print(f"🗄️ {db_path}: 改写 {rewrite_db_urls(db_path, ai_photos_store)} 条cartoon_url")
+
+
+if __name__ == "__main__":
+    main()
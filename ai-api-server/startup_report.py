@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+启动耗时报告
+用 python -X importtime 导入 app.main，按顶层包汇总各模块的导入耗时。
+
+用法:
+    python3 startup_report.py            # 只统计服务启动时真正导入的模块
+    python3 startup_report.py --with-sdks # 同时统计延迟加载的provider SDK
+    python3 startup_report.py --top 30
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+SDK_MODULES = ["requests", "PIL.Image", "dashscope", "google.genai"]
+
+
+def collect_import_times(statement: str) -> list[tuple[str, int, int]]:
+    """返回 [(模块名, 自身耗时us, 累计耗时us)]"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True, text=True, env={**os.environ, "PREWARM_SDKS": "0"},
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        sys.exit(result.returncode)
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI服务器启动耗时报告")
+    parser.add_argument("--with-sdks", action="store_true", help="同时导入延迟加载的SDK")
+    parser.add_argument("--top", type=int, default=15, help="显示前N个顶层包")
+    args = parser.parse_args()
+
+    statement = "import app.main"
+    if args.with_sdks:
+        statement += "; " + "; ".join(f"import {name}" for name in SDK_MODULES)
+
+    rows = collect_import_times(statement)
+    by_package = defaultdict(int)
+    for name, self_us, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+    total_us = sum(by_package.values())
+
+    print(f"⏱️ 导入总耗时: {total_us / 1000:.1f}ms（{len(rows)} 个模块）")
+    print(f"{'包':<28}{'耗时(ms)':>10}{'占比':>8}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{package:<28}{self_us / 1000:>10.1f}{self_us / total_us:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server'
 import { writeFile, mkdir } from 'fs/promises'
+import { randomUUID } from 'crypto'
 import path from 'path'
 import { PhotoService } from '@/lib/db-operations'
 import sharp from 'sharp'
@@ -56,6 +57,60 @@ async function compressImageTo480p(buffer: Buffer): Promise<Buffer> {
   }
 }
 
+// AI服务器重启时，没做完的任务会在重启后沿用原task_id继续执行，这里按task_id轮询结果
+const AI_SERVER_URL = 'http://127.0.0.1:8000'
+const RESUME_POLL_INTERVAL_MS = 5000
+const RESUME_POLL_TIMEOUT_MS = 15 * 60 * 1000
+
+function markAIFailed(photoId: string, processingError: string) {
+  photoService.updatePhoto(photoId, {
+    status: 'failed',
+    processing_error: processingError
+  })
+}
+
+// 把AI服务器返回的结果写入照片记录
+function applyAIResult(photoId: string, aiResult: { status?: string; image_paths?: string[] }) {
+  if (aiResult.status === 'success' && aiResult.image_paths && aiResult.image_paths.length > 0) {
+    photoService.updatePhoto(photoId, {
+      cartoon_url: aiResult.image_paths[0],
+      status: 'completed'
+    })
+  } else {
+    markAIFailed(photoId, 'AI生成失败')
+  }
+}
+
+// 请求发出后连接被断开（AI服务器在处理中重启）时任务可能已写入checkpoint；
+// 连接被拒绝等其他错误说明任务没有开始，不会被恢复
+function isConnectionReset(error: unknown): boolean {
+  const code = (error as { cause?: { code?: string } })?.cause?.code
+  return code === 'ECONNRESET' || code === 'UND_ERR_SOCKET'
+}
+
+// 在后台轮询重启后恢复执行的任务；服务器还没起来或任务还在执行时继续等，超时后照片保持pending
+async function pollResumedTask(photoId: string, taskId: string) {
+  const startedAt = Date.now()
+  while (Date.now() - startedAt < RESUME_POLL_TIMEOUT_MS) {
+    await new Promise(resolve => setTimeout(resolve, RESUME_POLL_INTERVAL_MS))
+    try {
+      const response = await fetch(`${AI_SERVER_URL}/task-status/${taskId}`)
+      if (!response.ok) {
+        continue
+      }
+      const status = await response.json()
+      if (status.status === 'success' || status.status === 'failed') {
+        console.log(`♻️ 恢复的AI任务 ${taskId} 已结束: ${status.status}`)
+        applyAIResult(photoId, status)
+        return
+      }
+    } catch {
+      // AI服务器还在重启
+    }
+  }
+  console.log(`AI任务 ${taskId} 在${RESUME_POLL_TIMEOUT_MS / 60000}分钟内没有结果，照片保持pending状态`)
+}
+
 // 构建优化的AI prompt
 function buildOptimizedPrompt(userCaption: string): string {
   // 基础的杭州GOSIM开源主题prompt
@@ -126,9 +181,10 @@ export async function POST(request: NextRequest) {
     
     // 根据用户选择决定是否调用AI服务
     if (useAI) {
-      // 用户选择AI处理
+      // 用户选择AI处理；自带task_id，AI服务器中途重启时可以用它查询恢复后的结果
+      const taskId = randomUUID()
       try {
-        const aiResponse = await fetch('http://127.0.0.1:8000/generate-image/', {
+        const aiResponse = await fetch(`${AI_SERVER_URL}/generate-image/`, {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
@@ -136,28 +192,35 @@ export async function POST(request: NextRequest) {
           body: JSON.stringify({
             model_name: 'qwen-image-edit',
             prompt: buildOptimizedPrompt(caption),
-            base_image_url: `http://localhost:80${originalUrl}`
+            base_image_url: `http://localhost:80${originalUrl}`,
+            session_id: userSession, // 同一会话的连拍近似重复可以复用结果
+            task_id: taskId
           })
         })
         
         const aiResult = await aiResponse.json()
         
-        if (aiResult.status === 'success' && aiResult.image_paths?.length > 0) {
-          // 更新数据库，存储AI生成的结果
-          photoService.updatePhoto(photo.id, {
-            cartoon_url: aiResult.image_paths[0],
-            status: 'completed'
-          })
+        if (aiResponse.status === 503) {
+          if (aiResult.detail?.resumable) {
+            // 任务已写入checkpoint，AI服务器重启后继续执行：保持pending并在后台等待结果
+            console.log(`AI服务器正在重启，任务 ${taskId} 将在重启后继续`)
+            void pollResumedTask(photo.id, taskId)
+          } else {
+            // 任务没有开始，也不会在重启后恢复
+            console.log(`AI服务不可用: ${JSON.stringify(aiResult.detail)}`)
+            markAIFailed(photo.id, 'AI服务暂时不可用')
+          }
         } else {
-          // AI处理失败
-          photoService.updatePhoto(photo.id, {
-            status: 'failed',
-            processing_error: 'AI生成失败'
-          })
+          applyAIResult(photo.id, aiResult)
         }
       } catch (error) {
         console.error('AI处理错误:', error)
-        // AI服务不可用，保持pending状态，稍后可以重试
+        if (isConnectionReset(error)) {
+          // 连接在等待中断开（例如AI服务器重启）：任务可能已写入checkpoint，保持pending并在后台等待结果
+          void pollResumedTask(photo.id, taskId)
+        } else {
+          markAIFailed(photo.id, 'AI服务不可用')
+        }
       }
     } else {
       // 用户选择直接显示原图，不使用AI处理
@@ -2,6 +2,15 @@
 
 echo "🤖 启动 AI API 服务器..."
 
+# 启动配置: dev(默认，代码修改自动重载) / prod(无重载进程，重启更快)
+PROFILE="${1:-dev}"
+if [ "$PROFILE" = "prod" ]; then
+    # SIGTERM后在途任务最多排空DRAIN_SECONDS秒，这里再留出当前尝试收尾的时间
+    UVICORN_ARGS="--host 0.0.0.0 --port 8000 --timeout-graceful-shutdown ${AI_SERVER_SHUTDOWN_TIMEOUT:-90}"
+else
+    UVICORN_ARGS="--reload --host 0.0.0.0 --port 8000"
+fi
+
 # 进入ai-api-server目录
 cd ai-api-server
 
@@ -28,12 +37,12 @@ else
 fi
 
 sleep 2
-echo "🚀 启动AI API服务器 (端口 8000)..."
+echo "🚀 启动AI API服务器 (端口 8000, 配置: $PROFILE)..."
 # 启动主API服务器
 if command -v python3.11 >/dev/null 2>&1; then
-    python3.11 -m uvicorn app.main:app --reload --host 0.0.0.0 --port 8000
+    python3.11 -m uvicorn app.main:app $UVICORN_ARGS
 elif command -v python3 >/dev/null 2>&1; then
-    python3 -m uvicorn app.main:app --reload --host 0.0.0.0 --port 8000
+    python3 -m uvicorn app.main:app $UVICORN_ARGS
 else
     echo "❌ 找不到Python，请先安装Python3"
     exit 1
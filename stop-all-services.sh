@@ -8,6 +8,13 @@ pkill -f "node.*8081" || true
 pkill -f "node.*8082" || true
 pkill -f "uvicorn.*8000" || true
 
+# AI服务器收到SIGTERM后会先排空在途任务（DRAIN_SECONDS，默认30秒），等它退出
+for i in $(seq 1 60); do
+    pgrep -f "uvicorn.*8000" > /dev/null || break
+    [ "$i" = "1" ] && echo "⏳ 等待AI服务器完成在途任务..."
+    sleep 1
+done
+
 echo "✅ 所有服务已停止"
 
 # 显示进程状态